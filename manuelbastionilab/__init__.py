@@ -200,6 +200,7 @@ def sync_character_to_props():
     #It's important to avoid problems with Blender undo system
     global the_humanoid
     the_humanoid.sync_character_data_to_obj_props()
+    the_humanoid.invalidate_update_stages()
     the_humanoid.update_character()
 
 def realtime_update(self, context):
@@ -208,27 +209,48 @@ def realtime_update(self, context):
     """
     global the_humanoid
     if the_humanoid.bodydata_realtime_activated:
-        #time1 = time.time()
         scn = bpy.context.scene
-        the_humanoid.update_character(category_name = scn.morphingCategory, mode="update_realtime")
-        the_humanoid.sync_gui_according_measures()
-        #print("realtime_update: {0}".format(time.time()-time1))
+        the_humanoid.request_realtime_update(scn.morphingCategory)
+
+realtime_update_running = False
+
+@persistent
+def realtime_update_handler(dummy):
+    """
+    Blender 2.78 has no timers: scene_update_post is called at
+    each cycle of the event loop, so it applies the slider changes
+    and the trailing update when the slider is still.
+    The update changes the scene, that calls the handler again:
+    these calls are skipped.
+    """
+    global the_humanoid, realtime_update_running
+    if realtime_update_running or not the_humanoid:
+        return
+    if not the_humanoid.has_data or not the_humanoid.has_pending_updates():
+        return
+    realtime_update_running = True
+    try:
+        the_humanoid.process_realtime_updates()
+    finally:
+        realtime_update_running = False
+
+bpy.app.handlers.scene_update_post.append(realtime_update_handler)
 
 def age_update(self, context):
     global the_humanoid
     if the_humanoid.metadata_realtime_activated:
         time1 = time.time()
-        the_humanoid.calculate_transformation("AGE")
+        the_humanoid.calculate_transformation("AGE", realtime=True)
 
 def mass_update(self, context):
     global the_humanoid
     if the_humanoid.metadata_realtime_activated:
-        the_humanoid.calculate_transformation("FAT")
+        the_humanoid.calculate_transformation("FAT", realtime=True)
 
 def tone_update(self, context):
     global the_humanoid
     if the_humanoid.metadata_realtime_activated:
-        the_humanoid.calculate_transformation("MUSCLE")
+        the_humanoid.calculate_transformation("MUSCLE", realtime=True)
 
 def modifiers_update(self, context):
     sync_character_to_props()
@@ -1086,6 +1108,7 @@ class ResetExpressions(bpy.types.Operator):
             "neutral.json")
 
         the_humanoid.load_character(filepath, reset_string = "Expression", reset_unassigned=False)
+        the_humanoid.unload_expressions()
 
     def execute(self, context):
         self.reset_expression()
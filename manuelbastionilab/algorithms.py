@@ -13,14 +13,24 @@
 #You should have received a copy of the GNU General Public License
 #along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import mathutils
+import numpy
 import itertools
 import random
 import time
 import logging
 import os
-import bpy
 import json
+import threading
+import collections
+import copy
+#bpy and mathutils are not available outside Blender: the
+#pure math functions of this module are used by the headless evaluator
+try:
+    import bpy
+    import mathutils
+except ImportError:
+    bpy = None
+    mathutils = None
 lab_logger = logging.getLogger('manuelbastionilab_logger')
 
 def simple_path(input_path, use_basename = True, max_len=50):
@@ -61,6 +71,136 @@ def length_of_strip(vertices_coords, indices, axis="ALL"):
         strip_length += full_dist(v1,v2, axis)
     return(strip_length)
 
+def add_weighted_morphs(form, morphs, weights):
+    """
+    Add to form (n,3) the sum of weight*deltas of the morphs,
+    given as a list of (indices, deltas), in a single scatter-add.
+    Return the stacked indices of the modified verts.
+    """
+    if not morphs:
+        return numpy.zeros(0, dtype=numpy.int32)
+    all_indices = numpy.concatenate([m_data[0] for m_data in morphs])
+    all_deltas = numpy.concatenate([m_data[1] for m_data in morphs])
+    counts = [len(m_data[0]) for m_data in morphs]
+    delta_weights = numpy.repeat(numpy.array(weights, dtype=numpy.float64), counts)
+    for axis in range(3):
+        form[:,axis] += numpy.bincount(
+            all_indices,
+            weights=all_deltas[:,axis]*delta_weights,
+            minlength=len(form))
+    return all_indices
+
+def compile_measures(measures_data):
+    """
+    Convert the measures database (name: list of vert indices)
+    in flat arrays: each segment of each strip is a pair
+    (seg_start, seg_end) of vert indices, seg_measure is the
+    index of its measure and seg_axis is 0,1,2 for the measures
+    along X,Y,Z or -1 for the full length.
+    """
+    names = sorted(measures_data.keys())
+    seg_start = []
+    seg_end = []
+    seg_measure = []
+    seg_axis = []
+    seg_indptr = [0]
+    for m_index, measure_name in enumerate(names):
+        indices = measures_data[measure_name]
+        axis = "XYZ".find(measure_name[-1])
+        n_segments = max(0, len(indices)-1)
+        seg_start.extend(indices[:-1])
+        seg_end.extend(indices[1:])
+        seg_measure.extend([m_index]*n_segments)
+        seg_axis.extend([axis]*n_segments)
+        seg_indptr.append(seg_indptr[-1]+n_segments)
+    return {
+        "names": names,
+        "seg_start": numpy.array(seg_start, dtype=numpy.int32),
+        "seg_end": numpy.array(seg_end, dtype=numpy.int32),
+        "seg_measure": numpy.array(seg_measure, dtype=numpy.int32),
+        "seg_axis": numpy.array(seg_axis, dtype=numpy.int32),
+        "seg_indptr": numpy.array(seg_indptr, dtype=numpy.int64)}
+
+def length_of_segments(vertices_coords, seg_start, seg_end, seg_axis):
+    seg_vectors = vertices_coords[seg_end].astype(numpy.float64)-vertices_coords[seg_start]
+    lengths = numpy.sqrt((seg_vectors*seg_vectors).sum(axis=1))
+    on_axis = numpy.flatnonzero(seg_axis >= 0)
+    lengths[on_axis] = numpy.abs(seg_vectors[on_axis, seg_axis[on_axis]])
+    return lengths
+
+def calculate_compiled_measures(vertices_coords, c_measures, measures_mask=None):
+    """
+    Return the array of the values of the compiled measures. If
+    measures_mask is given, only the masked measures are calculated
+    and the others are 0.
+    """
+    seg_start = c_measures["seg_start"]
+    seg_end = c_measures["seg_end"]
+    seg_measure = c_measures["seg_measure"]
+    seg_axis = c_measures["seg_axis"]
+    if measures_mask is not None:
+        segments = numpy.flatnonzero(measures_mask[seg_measure])
+        seg_start = seg_start[segments]
+        seg_end = seg_end[segments]
+        seg_measure = seg_measure[segments]
+        seg_axis = seg_axis[segments]
+    lengths = length_of_segments(vertices_coords, seg_start, seg_end, seg_axis)
+    return numpy.bincount(seg_measure, weights=lengths, minlength=len(c_measures["names"]))
+
+def calculate_compiled_measure(vertices_coords, c_measures, m_index):
+    start = c_measures["seg_indptr"][m_index]
+    end = c_measures["seg_indptr"][m_index+1]
+    lengths = length_of_segments(
+        vertices_coords,
+        c_measures["seg_start"][start:end],
+        c_measures["seg_end"][start:end],
+        c_measures["seg_axis"][start:end])
+    return float(lengths.sum())
+
+def bounded_least_squares(matrix_a, vector_b, lower, upper, max_iterations=100):
+    """
+    Return x that minimizes |matrix_a*x - vector_b| with
+    lower <= x <= upper (bounded-variable least squares, active set).
+    lower must be <= 0 <= upper: the search starts from x = 0.
+    """
+    matrix_a = numpy.asarray(matrix_a, dtype=numpy.float64)
+    vector_b = numpy.asarray(vector_b, dtype=numpy.float64)
+    lower = numpy.asarray(lower, dtype=numpy.float64)
+    upper = numpy.asarray(upper, dtype=numpy.float64)
+    n_vars = matrix_a.shape[1]
+    x_sol = numpy.zeros(n_vars)
+    free = numpy.ones(n_vars, dtype=bool)
+    for iteration in range(max_iterations):
+        x_new = x_sol.copy()
+        if free.any():
+            residual = vector_b - matrix_a[:,~free].dot(x_sol[~free])
+            x_new[free] = numpy.linalg.lstsq(matrix_a[:,free], residual, rcond=-1)[0]
+        out_of_bounds = free & ((x_new < lower) | (x_new > upper))
+        if out_of_bounds.any():
+            #Move toward the solution until the first bound,
+            #then fix the variables that reached it
+            step = x_new-x_sol
+            limits = numpy.where(step < 0, lower-x_sol, upper-x_sol)
+            ratios = numpy.ones(n_vars)
+            moving = out_of_bounds & (step != 0)
+            ratios[moving] = limits[moving]/step[moving]
+            alpha = max(0.0, min(1.0, ratios[moving].min()))
+            x_sol = numpy.clip(x_sol+alpha*step, lower, upper)
+            at_bound = free & ((x_sol <= lower+1e-12) | (x_sol >= upper-1e-12))
+            at_bound |= out_of_bounds & (ratios <= alpha+1e-12)
+            free &= ~at_bound
+            x_sol[at_bound] = numpy.where(step[at_bound] < 0, lower[at_bound], upper[at_bound])
+        else:
+            x_sol = x_new
+            #Release the fixed variable with the largest gradient
+            #that points inside the bounds
+            gradient = matrix_a.T.dot(matrix_a.dot(x_sol)-vector_b)
+            releasable = ~free & (((x_sol <= lower) & (gradient < 0)) | ((x_sol >= upper) & (gradient > 0)))
+            if not releasable.any():
+                break
+            free[numpy.argmax(numpy.abs(gradient)*releasable)] = True
+    return x_sol
+
 def function_modifier_a(val_x):
     val_y = 0.0
     if val_x > 0.5:
@@ -160,6 +300,76 @@ def smart_combo(prefix, morph_values):
                 print(names[i], weights[i])
     return (names, weights)
 
+def smart_combo_names(prefix, n_values):
+    """
+    The names generated by smart_combo for a modifier with n_values
+    properties. They depend only on the modifier, so they can be stored.
+    """
+    names = []
+    for n_data in itertools.product(*[["max", "min"]]*n_values):
+        names.append(prefix+"_"+'-'.join(n_data))
+    return names
+
+smart_combo_indices = {}
+
+def smart_combo_weights(morph_values):
+    """
+    Vectorized version of the weights of smart_combo: morph_values
+    is the list of the [val1, val2] pairs of the properties.
+    """
+    morph_values = numpy.array(morph_values, dtype=numpy.float64).reshape(-1,2)
+    n_values = len(morph_values)
+    if n_values not in smart_combo_indices:
+        smart_combo_indices[n_values] = numpy.array(
+            list(itertools.product([0, 1], repeat=n_values)),
+            dtype=numpy.int32).reshape(-1, n_values)
+    combo_indices = smart_combo_indices[n_values]
+
+    weights = morph_values[numpy.arange(n_values), combo_indices].sum(axis=1)
+    factor = morph_values.max()
+    best_val = weights.max()
+    toll = 1.5
+    weights = numpy.maximum(0, weights-best_val/toll)
+    summ = weights.sum()
+    if summ != 0:
+        weights = factor*(weights/summ)
+    return weights
+
+def compile_transformation(tr_data, prop_names):
+    """
+    Compile the rows [name_part, coeff_1, coeff_2] of an age, mass
+    or tone table for the given properties. Return the list of the
+    affected properties and the arrays of their coefficients (sum of
+    the rows with name_part in the property name).
+    """
+    affected_props = []
+    coefficients = []
+    for prop in prop_names:
+        coeff_1 = 0.0
+        coeff_2 = 0.0
+        is_affected = False
+        for tr_parameter in tr_data:
+            if tr_parameter[0] in prop:
+                coeff_1 += tr_parameter[1]
+                coeff_2 += tr_parameter[2]
+                is_affected = True
+        if is_affected:
+            affected_props.append(prop)
+            coefficients.append((coeff_1, coeff_2))
+    coefficients = numpy.array(coefficients, dtype=numpy.float64).reshape(-1,2)
+    return (affected_props, coefficients[:,0], coefficients[:,1])
+
+def transformation_deltas(c_transformation, value, previous_value):
+    """
+    Return the array of the changes of the affected properties when
+    the transformation goes from previous_value to value. The
+    negative values use the first coefficient, the positive the second.
+    """
+    affected_props, coefficients_1, coefficients_2 = c_transformation
+    delta_1 = max(0.0, -value) - max(0.0, -previous_value)
+    delta_2 = max(0.0, value) - max(0.0, previous_value)
+    return coefficients_1*delta_1 + coefficients_2*delta_2
+
 def is_excluded(property_name, excluded_properties):
     for excluded_property in excluded_properties:
         if excluded_property in property_name:
@@ -212,6 +422,82 @@ def polygon_forma(list_of_verts):
         form_factors.append(factor)
     return form_factors
 
+def compile_joints(joints_data):
+    """
+    Stack the vertex lists of the joints ("<bone>_head" and
+    "<bone>_tail") in a CSR layout: the verts of the joint n are
+    indices[indptr[n]:indptr[n+1]]. Joints without verts are skipped.
+    """
+    names = []
+    indptr = [0]
+    indices_list = []
+    if joints_data:
+        for joint_name in sorted(joints_data.keys()):
+            joint_verts = joints_data[joint_name]
+            if len(joint_verts) == 0:
+                lab_logger.warning("Joint {0} has no verts".format(joint_name))
+                continue
+            names.append(joint_name)
+            indices_list.extend(joint_verts)
+            indptr.append(len(indices_list))
+    indices = numpy.array(indices_list, dtype=numpy.int32)
+    bone_names = []
+    bone_ends = []
+    for joint_name in names:
+        bone_name, bone_end = joint_name.rsplit("_", 1)
+        bone_names.append(bone_name)
+        bone_ends.append(bone_end)
+    return {
+        "names": names,
+        "bone_names": bone_names,
+        "bone_ends": bone_ends,
+        "indptr": numpy.array(indptr, dtype=numpy.int64),
+        "indices": indices,
+        "counts": numpy.diff(numpy.array(indptr, dtype=numpy.int64))}
+
+def calculate_joints(vertices_coords, c_joints):
+    """
+    Return the (n_joints, 3) array of the joint positions,
+    the average centers of the verts of each joint.
+    """
+    if len(c_joints["names"]) == 0:
+        return numpy.zeros((0,3))
+    joints_coords = numpy.asarray(vertices_coords, dtype=numpy.float64)[c_joints["indices"]]
+    sums = numpy.add.reduceat(joints_coords, c_joints["indptr"][:-1], axis=0)
+    return sums/c_joints["counts"][:,numpy.newaxis]
+
+def joints_of_verts(c_joints, verts_indices):
+    """
+    Return the bool mask of the joints that
+    depend on at least one of the verts.
+    """
+    if len(c_joints["names"]) == 0:
+        return numpy.zeros(0, dtype=bool)
+    verts_indices = numpy.asarray(verts_indices, dtype=numpy.int64)
+    verts_mask = numpy.zeros(int(c_joints["indices"].max())+1, dtype=bool)
+    verts_mask[verts_indices[verts_indices < len(verts_mask)]] = True
+    return numpy.logical_or.reduceat(verts_mask[c_joints["indices"]], c_joints["indptr"][:-1])
+
+def weight_buckets(verts_indices, weights):
+    """
+    Group the verts by weight, so all the verts with the same weight
+    are added to a vertex group with a single call. If a vert is
+    repeated, its last weight is used, as with sequential REPLACE.
+    Return the list of (weight, list of vert indices).
+    """
+    if len(verts_indices) == 0:
+        return []
+    unique_indices, last_positions = numpy.unique(numpy.asarray(verts_indices)[::-1], return_index=True)
+    last_weights = numpy.asarray(weights)[::-1][last_positions]
+    order = numpy.argsort(last_weights, kind='mergesort')
+    sorted_weights = last_weights[order]
+    sorted_indices = unique_indices[order]
+    starts = [0]+(numpy.flatnonzero(numpy.diff(sorted_weights))+1).tolist()
+    ends = starts[1:]+[len(sorted_weights)]
+    sorted_weights = sorted_weights.tolist()
+    sorted_indices = sorted_indices.tolist()
+    return [(sorted_weights[start], sorted_indices[start:end]) for start, end in zip(starts, ends)]
+
 def average_center(verts_coords):
 
     n_verts = len(verts_coords)
@@ -227,46 +513,71 @@ def linear_interpolation_y(xa,xb,ya,yb,y):
     return (((xa-xb)*y)+(xb*ya)-(xa*yb))/(ya-yb)
 
 
-def correct_morph(base_form, current_form, morph_deltas, bboxes):
+def compile_bboxes(bbox_keys, bbox_boxes, n_verts):
+    """
+    Return the (n_verts,6) table of the bounding box verts of
+    each vert, -1 for the verts without bounding box.
+    """
+    bbox_table = numpy.full((n_verts,6), -1, dtype=numpy.int32)
+    in_range = bbox_keys < n_verts
+    bbox_table[bbox_keys[in_range]] = bbox_boxes[in_range]
+    return bbox_table
+
+def bounding_box_extents(verts_coo, bbox_indices, roundness=4):
+    """
+    Vectorized bounding_box: the (k,3) sizes of the boxes
+    defined by the (k,6) array of vert indices.
+    """
+    corners = verts_coo[bbox_indices].astype(numpy.float64)
+    return numpy.round(corners.max(axis=1)-corners.min(axis=1), roundness)
+
+def correct_morphs_deltas(current_form, morphs_deltas, bbox_table, base_extents):
+    """
+    Scale the deltas of all the morphs, given as a list of
+    (indices, deltas), by the ratio between the current and
+    the base size of the bounding box of each vert, in a single pass.
+    base_extents are the sizes of the boxes in the base form.
+    """
     time1 = time.time()
-    new_morph_deltas = []
-    for d_data in morph_deltas:
-
-        idx = d_data[0]        
-
-        if str(idx) in bboxes:
-            indices = bboxes[str(idx)]
-            current_bounding_box = bounding_box(current_form, indices)
-            if current_bounding_box:
-                base_bounding_box = bounding_box(base_form, indices)
-                if base_bounding_box:
-
-                    if base_bounding_box[0] != 0:
-                        scale_x = current_bounding_box[0]/base_bounding_box[0]
-                    else:
-                        scale_x = 1
-
-                    if base_bounding_box[1] != 0:
-                        scale_y = current_bounding_box[1]/base_bounding_box[1]
-                    else:
-                        scale_y = 1
-
-                    if base_bounding_box[2] != 0:
-                        scale_z = current_bounding_box[2]/base_bounding_box[2]
-                    else:
-                        scale_z = 1
-
-                    delta_x = d_data[1][0] * scale_x
-                    delta_y = d_data[1][1] * scale_y
-                    delta_z = d_data[1][2] * scale_z
-
-                    newd = mathutils.Vector((delta_x, delta_y, delta_z))
-                    new_morph_deltas.append([idx, newd])
-        else:
-            new_morph_deltas.append(d_data)            
-            lab_logger.warning("Index {0} not in bounding box database".format(idx))
-    lab_logger.info("Morphing corrected in {0} secs".format(time.time()-time1))
-    return new_morph_deltas
+    if not morphs_deltas:
+        return []
+    n_verts = len(current_form)
+    all_indices = numpy.concatenate([m_deltas[0] for m_deltas in morphs_deltas])
+    all_deltas = numpy.concatenate([m_deltas[1] for m_deltas in morphs_deltas]).astype(numpy.float64)
+    counts = [len(m_deltas[0]) for m_deltas in morphs_deltas]
+
+    boxes = bbox_table[all_indices]
+    missing = boxes[:,0] < 0
+    broken = (boxes >= n_verts).any(axis=1) & ~missing
+    to_scale = numpy.flatnonzero(~missing & ~broken)
+    if missing.any():
+        lab_logger.warning("{0} indices not in bounding box database".format(int(missing.sum())))
+    if broken.any():
+        lab_logger.warning("{0} bounding boxes with indices out of range".format(int(broken.sum())))
+
+    #Each box is measured once, even if shared by many morphs
+    scaled_verts, inverse = numpy.unique(all_indices[to_scale], return_inverse=True)
+    current_extents = bounding_box_extents(current_form, bbox_table[scaled_verts])
+    base_sizes = base_extents[scaled_verts]
+    scales = numpy.ones(current_extents.shape)
+    nonzero = base_sizes != 0
+    scales[nonzero] = current_extents[nonzero]/base_sizes[nonzero]
+    all_deltas[to_scale] *= scales[inverse]
+
+    keep = ~broken
+    corrected = []
+    start = 0
+    for count in counts:
+        m_keep = keep[start:start+count]
+        corrected.append((
+            all_indices[start:start+count][m_keep].astype(numpy.int32),
+            all_deltas[start:start+count][m_keep].astype(numpy.float32)))
+        start += count
+    lab_logger.info("{0} morphings corrected in {1} secs".format(len(corrected), time.time()-time1))
+    return corrected
+
+def correct_morph(current_form, morph_deltas, bbox_table, base_extents):
+    return correct_morphs_deltas(current_form, [morph_deltas], bbox_table, base_extents)[0]
 
 
 def check_name_structure(obj_name):
@@ -396,6 +707,63 @@ def load_json_data(json_path, data_info=None):
         return None
         
         
+#Parsed library files (presets, phenotypes, expressions, poses),
+#validated with size and mtime of the file
+JSON_CACHE_SIZE = 256
+json_cache = collections.OrderedDict()
+json_cache_lock = threading.Lock()
+
+def load_cached_json_data(json_path, data_info=None, copy_data=True):
+    """
+    Same as load_json_data, but the parsed data are stored in a
+    LRU cache. The caller gets a copy, so it can modify it freely,
+    unless copy_data is False (only to fill the cache).
+    """
+    json_path = os.path.abspath(json_path)
+    if not os.path.isfile(json_path):
+        return load_json_data(json_path, data_info)
+    f_stat = os.stat(json_path)
+    file_stamp = (f_stat.st_size, f_stat.st_mtime)
+    with json_cache_lock:
+        cached_data = json_cache.get(json_path)
+        if cached_data and cached_data[0] == file_stamp:
+            json_cache.move_to_end(json_path)
+            if copy_data:
+                return copy.deepcopy(cached_data[1])
+            return cached_data[1]
+    j_database = load_json_data(json_path, data_info)
+    if j_database is not None:
+        with json_cache_lock:
+            json_cache[json_path] = (file_stamp, j_database)
+            json_cache.move_to_end(json_path)
+            while len(json_cache) > JSON_CACHE_SIZE:
+                json_cache.popitem(last=False)
+        if copy_data:
+            return copy.deepcopy(j_database)
+    return j_database
+
+def prefetch_json_folders(folder_paths):
+    """
+    Parse the json files of the folders in a background thread,
+    so the first selection of an item doesn't read the disk.
+    """
+    def prefetch():
+        time1 = time.time()
+        n_files = 0
+        for folder_path in folder_paths:
+            if os.path.isdir(folder_path):
+                for file_name in sorted(os.listdir(folder_path)):
+                    if os.path.splitext(file_name)[1] == ".json":
+                        load_cached_json_data(os.path.join(folder_path, file_name), copy_data=False)
+                        n_files += 1
+        lab_logger.info("Prefetched {0} library files in {1} secs".format(n_files, time.time()-time1))
+
+    prefetch_thread = threading.Thread(target=prefetch, name="manuelbastionilab_prefetch")
+    prefetch_thread.daemon = True
+    prefetch_thread.start()
+    return prefetch_thread
+
+
 def unselect_all():
     for obj in bpy.data.objects:
         obj.select = False
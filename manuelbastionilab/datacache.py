@@ -0,0 +1,790 @@
+#ManuelbastioniLAB - Copyright (C) 2015-2017 Manuel Bastioni
+#Official site: www.manuelbastioni.com
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#This module doesn't use bpy, so the databases can be compiled
+#outside Blender too: python datacache.py <data_folder>
+#Other character files (for example scanned bodies) can be added
+#to the automodelling library with:
+#python datacache.py ingest <data_folder> <bodies_folder> <json_folder_or_file>...
+
+import os
+import sys
+import json
+import time
+import hashlib
+import logging
+import tempfile
+import numpy
+
+lab_logger = logging.getLogger('manuelbastionilab_logger')
+
+CACHE_VERSION = 1
+CACHE_ENV_VAR = "MANUELBASTIONILAB_CACHE"
+MANIFEST_NAME = "manifest.json"
+
+
+def get_user_cache_root():
+    """
+    Return the cache folder of the user: LOCALAPPDATA on Windows,
+    Library/Caches on macOS, XDG_CACHE_HOME or ~/.cache on the others.
+    It's the same inside and outside Blender, so the databases compiled
+    from the command line are found by the addon.
+    """
+    if sys.platform.startswith("win"):
+        cache_root = os.environ.get("LOCALAPPDATA")
+    elif sys.platform == "darwin":
+        cache_root = os.path.join(os.path.expanduser("~"), "Library", "Caches")
+    else:
+        cache_root = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    if not cache_root or cache_root.startswith("~"):
+        return None
+    return os.path.join(cache_root, "manuelbastionilab")
+
+
+def get_cache_dir(data_path):
+    """
+    Return the folder of the compiled databases: the path in the
+    environment variable MANUELBASTIONILAB_CACHE or a folder in the
+    cache of the user, one for each data folder. The addon folder
+    is not used, since it can be read only or replaced by an update.
+    If the folder is not writeable, the system temp folder is used.
+    """
+    data_key = hashlib.sha1(os.path.abspath(data_path).encode("utf-8")).hexdigest()[:12]
+    cache_dir = os.environ.get(CACHE_ENV_VAR)
+    if not cache_dir:
+        cache_root = get_user_cache_root()
+        if cache_root:
+            cache_dir = os.path.join(cache_root, data_key)
+    if cache_dir:
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            if os.access(cache_dir, os.W_OK):
+                return cache_dir
+        except OSError:
+            pass
+    cache_dir = os.path.join(tempfile.gettempdir(), "manuelbastionilab_cache", data_key)
+    lab_logger.warning("Cache folder not writeable, using {0}".format(cache_dir))
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    return cache_dir
+
+
+def get_pack_name(source_path):
+    """
+    Build the pack name from the last two parts of the source path,
+    for example "human_female_base01/morphs.json" -> "human_female_base01__morphs"
+    """
+    folder_name = os.path.basename(os.path.dirname(source_path))
+    file_root = os.path.splitext(os.path.basename(source_path))[0]
+    return folder_name+"__"+file_root
+
+
+def file_hash(filepath):
+    sha = hashlib.sha1()
+    with open(filepath, "rb") as s_file:
+        for chunk in iter(lambda: s_file.read(1048576), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def source_signature(filepath, with_hash=True):
+    if not os.path.isfile(filepath):
+        return None
+    f_stat = os.stat(filepath)
+    signature = {"size": f_stat.st_size, "mtime": f_stat.st_mtime}
+    if with_hash:
+        signature["sha1"] = file_hash(filepath)
+    return signature
+
+
+def is_source_unchanged(stored_signature, filepath):
+    """
+    Fast check on size and mtime. Only if they are different
+    the content hash is compared. Return a tuple (unchanged, touched),
+    where touched means same content with a new mtime.
+    """
+    current_signature = source_signature(filepath, with_hash=False)
+    if stored_signature is None or current_signature is None:
+        return (stored_signature == current_signature, False)
+    if stored_signature["size"] != current_signature["size"]:
+        return (False, False)
+    if stored_signature["mtime"] == current_signature["mtime"]:
+        return (True, False)
+    if stored_signature.get("sha1") == file_hash(filepath):
+        return (True, True)
+    return (False, False)
+
+
+def read_manifest(pack_dir):
+    manifest_path = os.path.join(pack_dir, MANIFEST_NAME)
+    if os.path.isfile(manifest_path):
+        try:
+            with open(manifest_path, "r") as m_file:
+                return json.load(m_file)
+        except (OSError, ValueError):
+            lab_logger.warning("Corrupted cache manifest in {0}".format(os.path.basename(pack_dir)))
+    return None
+
+
+def get_tmp_path(file_path):
+    """
+    Temporary file in the same folder, unique for the process,
+    to be moved on file_path with os.replace.
+    """
+    return "{0}.{1}.tmp".format(file_path, os.getpid())
+
+
+def write_manifest(pack_dir, manifest):
+    manifest_path = os.path.join(pack_dir, MANIFEST_NAME)
+    tmp_path = get_tmp_path(manifest_path)
+    with open(tmp_path, "w") as m_file:
+        json.dump(manifest, m_file)
+    os.replace(tmp_path, manifest_path)
+
+
+def save_array(array_path, array_data):
+    """
+    Write the .npy file with a rename, because other sessions
+    may have the old file memory-mapped: overwriting it in place
+    would change the data under them.
+    """
+    tmp_path = get_tmp_path(array_path)
+    try:
+        with open(tmp_path, "wb") as a_file:
+            numpy.save(a_file, numpy.ascontiguousarray(array_data))
+        os.replace(tmp_path, array_path)
+    except OSError:
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def load_pack(cache_dir, pack_name, source_paths, use_mmap=True):
+    """
+    Return (arrays, meta) of a compiled pack, or None if the pack
+    doesn't exist or it is older than its source files.
+    The arrays are memory-mapped in read only mode.
+    """
+    pack_dir = os.path.join(cache_dir, pack_name)
+    manifest = read_manifest(pack_dir)
+    if not manifest:
+        return None
+    if manifest.get("version") != CACHE_VERSION:
+        return None
+    stored_sources = manifest.get("sources", [])
+    if len(stored_sources) != len(source_paths):
+        return None
+
+    touched = False
+    for stored_signature, source_path in zip(stored_sources, source_paths):
+        unchanged, source_touched = is_source_unchanged(stored_signature, source_path)
+        if not unchanged:
+            lab_logger.info("Cache {0} is out of date".format(pack_name))
+            return None
+        touched = touched or source_touched
+
+    mmap_mode = None
+    if use_mmap:
+        mmap_mode = 'r'
+    arrays = {}
+    try:
+        for array_name in manifest["arrays"]:
+            array_path = os.path.join(pack_dir, array_name+".npy")
+            arrays[array_name] = numpy.load(array_path, mmap_mode=mmap_mode, allow_pickle=False)
+    except (OSError, ValueError, KeyError):
+        lab_logger.warning("Cache {0} can't be read".format(pack_name))
+        return None
+
+    if touched:
+        #Same content but new mtime: store it to skip the hash next time
+        manifest["sources"] = [source_signature(s_path) for s_path in source_paths]
+        try:
+            write_manifest(pack_dir, manifest)
+        except OSError:
+            pass
+    return (arrays, manifest.get("meta", {}))
+
+
+def save_pack(cache_dir, pack_name, source_paths, arrays, meta=None):
+    """
+    Store the arrays as raw .npy files. The files are replaced,
+    not overwritten, and the manifest is written at the end, so
+    an interrupted write leaves an invalid pack.
+    """
+    pack_dir = os.path.join(cache_dir, pack_name)
+    manifest_path = os.path.join(pack_dir, MANIFEST_NAME)
+    try:
+        if not os.path.isdir(pack_dir):
+            os.makedirs(pack_dir)
+        if os.path.isfile(manifest_path):
+            os.remove(manifest_path)
+        for array_name, array_data in arrays.items():
+            save_array(os.path.join(pack_dir, array_name+".npy"), array_data)
+        manifest = {
+            "version": CACHE_VERSION,
+            "sources": [source_signature(s_path) for s_path in source_paths],
+            "arrays": sorted(arrays.keys()),
+            "meta": meta or {}}
+        write_manifest(pack_dir, manifest)
+        return True
+    except OSError as err:
+        lab_logger.warning("Cannot write the cache {0}: {1}".format(pack_name, err))
+        return False
+
+
+def read_json(json_path, data_info="Json data"):
+    if not os.path.isfile(json_path):
+        lab_logger.warning("File not found: {0}".format(os.path.basename(json_path)))
+        return None
+    time1 = time.time()
+    j_database = None
+    try:
+        with open(json_path, "r") as j_file:
+            j_database = json.load(j_file)
+    except ValueError:
+        lab_logger.warning("Errors in json file: {0}".format(os.path.basename(json_path)))
+    lab_logger.info("{0} loaded from {1} in {2} secs".format(data_info, os.path.basename(json_path), time.time()-time1))
+    return j_database
+
+
+def vertices_to_arrays(verts):
+    return {"vertices": numpy.array(verts, dtype=numpy.float32).reshape(-1,3)}, {}
+
+
+def morphs_to_arrays(m_data):
+    """
+    Stack all the morphs of a database in a CSR layout:
+    the deltas of the morph n are indices[indptr[n]:indptr[n+1]]
+    and deltas[indptr[n]:indptr[n+1]].
+    """
+    names = list(m_data.keys())
+    indptr = numpy.zeros(len(names)+1, dtype=numpy.int64)
+    indices_list = []
+    deltas_list = []
+    for n, morph_name in enumerate(names):
+        d_data = numpy.array(m_data[morph_name], dtype=numpy.float64).reshape(-1,4)
+        indices_list.append(d_data[:,0].astype(numpy.int32))
+        deltas_list.append(d_data[:,1:].astype(numpy.float32))
+        indptr[n+1] = indptr[n]+len(d_data)
+    if names:
+        indices = numpy.concatenate(indices_list)
+        deltas = numpy.concatenate(deltas_list)
+    else:
+        indices = numpy.zeros(0, dtype=numpy.int32)
+        deltas = numpy.zeros((0,3), dtype=numpy.float32)
+    arrays = {"indptr": indptr, "indices": indices, "deltas": deltas}
+    return arrays, {"names": names}
+
+
+def arrays_to_morphs(arrays, meta):
+    """
+    Return a list of (morph_name, indices, deltas). The arrays
+    of each morph are views of the stacked arrays.
+    """
+    morphs = []
+    indptr = arrays["indptr"]
+    for n, morph_name in enumerate(meta["names"]):
+        start = int(indptr[n])
+        end = int(indptr[n+1])
+        morphs.append((morph_name, arrays["indices"][start:end], arrays["deltas"][start:end]))
+    return morphs
+
+
+def bboxes_to_arrays(b_data):
+    keys = numpy.array([int(k) for k in b_data.keys()], dtype=numpy.int32)
+    boxes = numpy.array(list(b_data.values()), dtype=numpy.int32).reshape(-1,6)
+    return {"keys": keys, "boxes": boxes}, {}
+
+
+def vgroups_to_arrays(g_data):
+    """
+    Stack the vertex groups in a CSR layout, like the morphs.
+    The entries without weight (plain vert index) have NaN weight.
+    """
+    names = sorted(g_data.keys())
+    indptr = numpy.zeros(len(names)+1, dtype=numpy.int64)
+    indices_list = []
+    weights_list = []
+    for n, group_name in enumerate(names):
+        for vert_data in g_data[group_name]:
+            if type(vert_data) == list:
+                indices_list.append(vert_data[0])
+                weights_list.append(vert_data[1])
+            else:
+                indices_list.append(vert_data)
+                weights_list.append(numpy.nan)
+        indptr[n+1] = len(indices_list)
+    arrays = {
+        "indptr": indptr,
+        "indices": numpy.array(indices_list, dtype=numpy.int32),
+        "weights": numpy.array(weights_list, dtype=numpy.float64)}
+    return arrays, {"names": names}
+
+
+def load_compiled(json_path, cache_dir, to_arrays, data_info="Json data"):
+    """
+    Return (arrays, meta) from the compiled pack of json_path.
+    If the pack is missing or out of date, the json is parsed,
+    converted with to_arrays and stored in the cache.
+    """
+    time1 = time.time()
+    pack_name = get_pack_name(json_path)
+    pack = load_pack(cache_dir, pack_name, [json_path])
+    if pack:
+        lab_logger.info("{0} loaded from compiled cache {1} in {2} secs".format(data_info, pack_name, time.time()-time1))
+        return pack
+    j_data = read_json(json_path, data_info)
+    if j_data is None:
+        return None
+    arrays, meta = to_arrays(j_data)
+    save_pack(cache_dir, pack_name, [json_path], arrays, meta)
+    return (arrays, meta)
+
+
+def load_vertices(json_path, cache_dir):
+    pack = load_compiled(json_path, cache_dir, vertices_to_arrays, "Vertices data")
+    if pack:
+        return pack[0]["vertices"]
+    return None
+
+
+def load_morphs(json_path, cache_dir):
+    pack = load_compiled(json_path, cache_dir, morphs_to_arrays, "Morph data")
+    if pack:
+        return arrays_to_morphs(*pack)
+    return None
+
+
+def load_vgroups(json_path, cache_dir):
+    return load_compiled(json_path, cache_dir, vgroups_to_arrays, "Vertgroups data")
+
+
+def load_morph_names(json_path, cache_dir):
+    """
+    Return the names of the morphs in the database. With a valid
+    pack only the manifest is read, the deltas stay on disk.
+    """
+    pack = load_compiled(json_path, cache_dir, morphs_to_arrays, "Morph data")
+    if pack:
+        return list(pack[1]["names"])
+    return None
+
+
+def load_bboxes(json_path, cache_dir):
+    """
+    Return the arrays (keys, boxes): the vert indices and
+    the (n,6) indices of their bounding box verts.
+    """
+    pack = load_compiled(json_path, cache_dir, bboxes_to_arrays, "Bounding box data")
+    if pack:
+        return (pack[0]["keys"], pack[0]["boxes"])
+    return None
+
+
+BODY_SECTIONS = ("proportions", "structural", "metaproperties", "materialproperties")
+BODY_LIBRARY_VERSION = 2
+BODY_LIBRARY_INDEX = "library.json"
+#The removed rows are dropped when they are more than this fraction
+BODY_LIBRARY_COMPACT_RATIO = 0.5
+
+
+def get_body_files(bodies_path):
+    body_files = []
+    if os.path.isdir(bodies_path):
+        for database_file in sorted(os.listdir(bodies_path)):
+            if os.path.splitext(database_file)[1] == ".json":
+                body_files.append(database_file)
+    return body_files
+
+
+def get_body_library_path(cache_dir, bodies_path):
+    return os.path.join(cache_dir, "body_library__"+os.path.basename(os.path.normpath(bodies_path)))
+
+
+class BodyLibrary:
+    """
+    Append-only index of the bodies used by the automodelling.
+    Each section of the character json (proportions, structural,
+    meta and material properties) is a raw float64 file with one
+    row for body, NaN where a value is missing. New bodies are
+    appended, modified bodies are rewritten in place and deleted
+    bodies are only marked as removed. The files are rewritten,
+    without the removed rows, when the bodies add new value names
+    or when the removed rows are too many.
+    The bodies are keyed by their path relative to root_path, so
+    the library is still valid if the data folder is moved.
+    """
+
+    def __init__(self, library_path, root_path):
+        self.library_path = library_path
+        self.root_path = os.path.abspath(root_path)
+        self.index_path = os.path.join(library_path, BODY_LIBRARY_INDEX)
+        self.reset()
+        self.load()
+
+    def reset(self):
+        self.sections = dict((section, []) for section in BODY_SECTIONS)
+        self.matrices = dict((section, numpy.zeros((0,0))) for section in BODY_SECTIONS)
+        self.bodies = []
+        #True for the bodies not removed, kept with the bodies
+        self.active_bodies = numpy.zeros(0, dtype=bool)
+        self.source_index = {}
+
+    def get_source_key(self, source):
+        """
+        Path relative to the root, or absolute
+        for the files outside the root.
+        """
+        source = os.path.abspath(source)
+        rel_path = os.path.relpath(source, self.root_path)
+        if rel_path == os.pardir or rel_path.startswith(os.pardir+os.sep):
+            return source
+        return rel_path.replace(os.sep, "/")
+
+    def get_source_path(self, source_key):
+        if os.path.isabs(source_key):
+            return source_key
+        return os.path.join(self.root_path, *source_key.split("/"))
+
+    def get_section_path(self, section):
+        return os.path.join(self.library_path, section+".bin")
+
+    def load(self):
+        if not os.path.isfile(self.index_path):
+            return False
+        try:
+            with open(self.index_path, "r") as i_file:
+                library_index = json.load(i_file)
+            if library_index.get("version") != BODY_LIBRARY_VERSION:
+                return False
+            n_rows = len(library_index["bodies"])
+            matrices = {}
+            for section in BODY_SECTIONS:
+                n_columns = len(library_index["sections"][section])
+                #Rows after the ones in the index are an interrupted append
+                s_data = numpy.fromfile(self.get_section_path(section), dtype=numpy.float64, count=n_rows*n_columns)
+                if len(s_data) != n_rows*n_columns:
+                    raise ValueError("Truncated section "+section)
+                matrices[section] = s_data.reshape(n_rows, n_columns)
+        except (OSError, ValueError, KeyError) as err:
+            lab_logger.warning("Body library {0} can't be read: {1}".format(os.path.basename(self.library_path), err))
+            self.reset()
+            return False
+        self.sections = library_index["sections"]
+        self.matrices = matrices
+        self.bodies = library_index["bodies"]
+        self.active_bodies = numpy.array([not body["removed"] for body in self.bodies], dtype=bool)
+        self.source_index = dict((body["source"], b_index) for b_index, body in enumerate(self.bodies))
+        return True
+
+    def save_index(self):
+        library_index = {
+            "version": BODY_LIBRARY_VERSION,
+            "sections": self.sections,
+            "bodies": self.bodies}
+        tmp_path = get_tmp_path(self.index_path)
+        with open(tmp_path, "w") as i_file:
+            json.dump(library_index, i_file)
+        os.replace(tmp_path, self.index_path)
+
+    def compact(self):
+        """
+        Drop the rows of the removed bodies. The
+        section files must be rewritten after it.
+        """
+        active_rows = numpy.nonzero(self.active_bodies)[0]
+        for section in BODY_SECTIONS:
+            self.matrices[section] = self.matrices[section][active_rows]
+        self.bodies = [self.bodies[b_index] for b_index in active_rows.tolist()]
+        self.active_bodies = numpy.ones(len(self.bodies), dtype=bool)
+        self.source_index = dict((body["source"], b_index) for b_index, body in enumerate(self.bodies))
+
+    def set_removed(self, b_index, removed):
+        self.bodies[b_index]["removed"] = removed
+        self.active_bodies[b_index] = not removed
+
+    def body_to_rows(self, body_data):
+        rows = {}
+        for section in BODY_SECTIONS:
+            row = numpy.full(len(self.sections[section]), numpy.nan)
+            column_index = dict((v_name, i) for i, v_name in enumerate(self.sections[section]))
+            for v_name, value in body_data.get(section, {}).items():
+                row[column_index[v_name]] = value
+            rows[section] = row
+        return rows
+
+    def add_value_names(self, body_data):
+        """
+        Add the value names of the body to the sections.
+        Return True if the columns are changed.
+        """
+        columns_changed = False
+        for section in BODY_SECTIONS:
+            new_names = set(body_data.get(section, {}).keys())-set(self.sections[section])
+            if new_names:
+                n_rows = len(self.bodies)
+                self.sections[section] = self.sections[section]+sorted(new_names)
+                self.matrices[section] = numpy.hstack(
+                    (self.matrices[section], numpy.full((n_rows, len(new_names)), numpy.nan)))
+                columns_changed = True
+        return columns_changed
+
+    def write_sections(self, changed_rows, n_stored_rows, rewrite=False):
+        if not os.path.isdir(self.library_path):
+            os.makedirs(self.library_path)
+        for section in BODY_SECTIONS:
+            s_path = self.get_section_path(section)
+            s_matrix = numpy.ascontiguousarray(self.matrices[section], dtype=numpy.float64)
+            if rewrite or not os.path.isfile(s_path):
+                s_matrix.tofile(s_path)
+                continue
+            row_size = s_matrix.shape[1]*s_matrix.itemsize
+            with open(s_path, "r+b") as s_file:
+                for b_index in changed_rows:
+                    if b_index < n_stored_rows:
+                        s_file.seek(b_index*row_size)
+                        s_file.write(s_matrix[b_index].tobytes())
+                s_file.seek(n_stored_rows*row_size)
+                s_file.truncate()
+                s_file.write(s_matrix[n_stored_rows:].tobytes())
+
+    def get_json_files(self, paths):
+        json_files = []
+        for path in paths:
+            if os.path.isdir(path):
+                json_files.extend(os.path.join(path, b_file) for b_file in get_body_files(path))
+            elif os.path.splitext(path)[1] == ".json":
+                json_files.append(path)
+        return [os.path.abspath(j_path) for j_path in json_files]
+
+    def ingest(self, paths, remove_missing=False):
+        """
+        Add to the library the character json files in paths
+        (folders or files). The files already in the library are
+        read again only if changed. Return the number of new or
+        updated bodies.
+        """
+        time1 = time.time()
+        n_stored_rows = len(self.bodies)
+        changed_rows = []
+        rewrite = not os.path.isfile(self.index_path)
+        index_changed = False
+        new_bodies = []
+        for source in self.get_json_files(paths):
+            b_index = self.source_index.get(self.get_source_key(source))
+            if b_index is not None:
+                body = self.bodies[b_index]
+                unchanged, touched = is_source_unchanged(body["signature"], source)
+                if unchanged:
+                    if touched:
+                        body["signature"] = source_signature(source)
+                        index_changed = True
+                    if body["removed"]:
+                        #The file is back
+                        self.set_removed(b_index, False)
+                        index_changed = True
+                    continue
+            body_data = read_json(source, "Body data")
+            if not body_data or "proportions" not in body_data:
+                lab_logger.info("File {0} does not contain proportions".format(os.path.basename(source)))
+                continue
+            new_bodies.append((b_index, source, body_data))
+
+        for b_index, source, body_data in new_bodies:
+            rewrite = self.add_value_names(body_data) or rewrite
+        appended_rows = dict((section, []) for section in BODY_SECTIONS)
+        for b_index, source, body_data in new_bodies:
+            rows = self.body_to_rows(body_data)
+            source_key = self.get_source_key(source)
+            body = {
+                "name": os.path.basename(source),
+                "source": source_key,
+                "signature": source_signature(source),
+                "version": body_data.get("manuellab_vers"),
+                "removed": False}
+            if b_index is None:
+                b_index = len(self.bodies)
+                self.bodies.append(body)
+                self.source_index[source_key] = b_index
+                for section in BODY_SECTIONS:
+                    appended_rows[section].append(rows[section])
+            else:
+                self.bodies[b_index] = body
+                self.active_bodies[b_index] = True
+                for section in BODY_SECTIONS:
+                    self.matrices[section][b_index] = rows[section]
+            changed_rows.append(b_index)
+        for section in BODY_SECTIONS:
+            if appended_rows[section]:
+                self.matrices[section] = numpy.vstack([self.matrices[section]]+appended_rows[section])
+        n_appended = len(self.bodies)-len(self.active_bodies)
+        if n_appended > 0:
+            self.active_bodies = numpy.concatenate((self.active_bodies, numpy.ones(n_appended, dtype=bool)))
+
+        if remove_missing:
+            for b_index, body in enumerate(self.bodies):
+                if not body["removed"] and not os.path.isfile(self.get_source_path(body["source"])):
+                    self.set_removed(b_index, True)
+                    index_changed = True
+
+        n_removed = len(self.bodies)-self.get_bodies_number()
+        if n_removed > 0 and (rewrite or n_removed > len(self.bodies)*BODY_LIBRARY_COMPACT_RATIO):
+            self.compact()
+            rewrite = True
+            index_changed = True
+
+        if changed_rows or index_changed:
+            try:
+                self.write_sections(changed_rows, n_stored_rows, rewrite)
+                self.save_index()
+            except OSError as err:
+                lab_logger.warning("Cannot write the body library {0}: {1}".format(os.path.basename(self.library_path), err))
+        lab_logger.info("{0} bodies added to the library {1} in {2} secs".format(
+            len(changed_rows), os.path.basename(self.library_path), time.time()-time1))
+        return len(changed_rows)
+
+    def sync(self, bodies_path):
+        """
+        Update the library with the new and modified files of
+        the bodies folder, and remove the deleted files.
+        """
+        return self.ingest([bodies_path], remove_missing=True)
+
+    def get_bodies_number(self):
+        return int(numpy.count_nonzero(self.active_bodies))
+
+    def query(self, proportions, score_weights, tolerance=0.025, n_results=None):
+        """
+        Return the list of (score, source path) of the bodies, the best
+        first. The score of a body is the sum of the weights of its
+        proportions that differ less than tolerance from the given ones.
+        """
+        proportion_names = self.sections["proportions"]
+        #The columns not used have NaN value and zero weight,
+        #so the matrix is compared without copying the columns
+        current_proportions = numpy.full(len(proportion_names), numpy.nan)
+        weights = numpy.zeros(len(proportion_names))
+        for p_index, p_name in enumerate(proportion_names):
+            if p_name in proportions:
+                if p_name != "body_height_Z":
+                    current_proportions[p_index] = proportions[p_name]
+                    weights[p_index] = score_weights[p_name]
+            else:
+                lab_logger.warning("Measure {0} not present in inner proportions database".format(p_name))
+
+        #NaN (proportion not in the body) is not a match
+        differences = self.matrices["proportions"]-current_proportions
+        numpy.abs(differences, out=differences)
+        with numpy.errstate(invalid='ignore'):
+            matches = differences <= tolerance
+        body_scores = matches.dot(weights).reshape(-1)
+        best_bodies = numpy.nonzero(self.active_bodies)[0]
+        if n_results and n_results < len(best_bodies):
+            #Only the bodies with score not lower than the n-th best are
+            #sorted. All the ties are kept, so the order is the same
+            best_scores = body_scores[best_bodies]
+            min_score = numpy.partition(best_scores, len(best_scores)-n_results)[len(best_scores)-n_results]
+            best_bodies = best_bodies[best_scores >= min_score]
+        best_bodies = best_bodies[numpy.argsort(-body_scores[best_bodies], kind='mergesort')]
+        if n_results:
+            best_bodies = best_bodies[:n_results]
+        return [(float(body_scores[b_index]), self.get_source_path(self.bodies[b_index]["source"])) for b_index in best_bodies.tolist()]
+
+    def get_body(self, source):
+        """
+        Rebuild the character data of a body, in the format
+        of the json written by Humanoid.save_character.
+        """
+        b_index = self.source_index.get(self.get_source_key(source))
+        if b_index is None or self.bodies[b_index]["removed"]:
+            return None
+        body_data = {}
+        if self.bodies[b_index]["version"] is not None:
+            body_data["manuellab_vers"] = self.bodies[b_index]["version"]
+        for section in BODY_SECTIONS:
+            values = self.matrices[section][b_index].tolist()
+            body_data[section] = dict(
+                (v_name, value) for v_name, value in zip(self.sections[section], values) if value == value)
+        return body_data
+
+
+def load_body_library(bodies_path, cache_dir):
+    """
+    Return the body library of the bodies folder,
+    updated with the changes of the folder.
+    """
+    body_library = BodyLibrary(get_body_library_path(cache_dir, bodies_path), bodies_path)
+    body_library.sync(bodies_path)
+    return body_library
+
+
+def get_character_databases(data_path, character_name):
+    """
+    Return the list of (json_path, converter) used by the
+    morphing engine of the character.
+    """
+    character_type = character_name.split("_")[0]
+    gender_type = character_name.split("_")[1]
+    shared_prefix = character_type+"_"+gender_type
+    return [
+        (os.path.join(data_path, character_name, "vertices.json"), vertices_to_arrays),
+        (os.path.join(data_path, "shared_morphs", shared_prefix+"_morphs.json"), morphs_to_arrays),
+        (os.path.join(data_path, character_name, "morphs.json"), morphs_to_arrays),
+        (os.path.join(data_path, character_name, "extra_morphs.json"), morphs_to_arrays),
+        (os.path.join(data_path, "shared_morphs", shared_prefix+"_morphs_extra.json"), morphs_to_arrays),
+        (os.path.join(data_path, character_name, "expressions.json"), morphs_to_arrays),
+        (os.path.join(data_path, "shared_bboxes", shared_prefix+"_bbox.json"), bboxes_to_arrays),
+        (os.path.join(data_path, "shared_vgroups", shared_prefix+"_vgroups.json"), vgroups_to_arrays)]
+
+
+def compile_databases(data_path, cache_dir=None):
+    """
+    Compile the databases of all the characters listed in characters.json
+    """
+    time1 = time.time()
+    if not cache_dir:
+        cache_dir = get_cache_dir(data_path)
+    characters = read_json(os.path.join(data_path, "characters.json"), "Characters definition")
+    n_packs = 0
+    if characters:
+        for character_name in characters["character_list"]:
+            for json_path, to_arrays in get_character_databases(data_path, character_name):
+                if os.path.isfile(json_path):
+                    if load_compiled(json_path, cache_dir, to_arrays):
+                        n_packs += 1
+    shared_bodies_path = os.path.join(data_path, "shared_bodies")
+    if os.path.isdir(shared_bodies_path):
+        for bodies_folder in sorted(os.listdir(shared_bodies_path)):
+            bodies_path = os.path.join(shared_bodies_path, bodies_folder)
+            if os.path.isdir(bodies_path):
+                load_body_library(bodies_path, cache_dir)
+                n_packs += 1
+    lab_logger.info("Compiled {0} databases in {1} secs".format(n_packs, time.time()-time1))
+    return n_packs
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) > 4 and sys.argv[1] == "ingest":
+        data_path = sys.argv[2]
+        bodies_path = os.path.join(data_path, "shared_bodies", sys.argv[3])
+        body_library = load_body_library(bodies_path, get_cache_dir(data_path))
+        body_library.ingest(sys.argv[4:])
+    elif len(sys.argv) > 1:
+        compile_databases(sys.argv[1])
+    else:
+        print("Usage: python datacache.py <data_folder>")
+        print("       python datacache.py ingest <data_folder> <bodies_folder> <json_folder_or_file>...")
@@ -0,0 +1,271 @@
+#ManuelbastioniLAB - Copyright (C) 2015-2017 Manuel Bastioni
+#Official site: www.manuelbastioni.com
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#This module doesn't use bpy: it builds the vertices of a character
+#from a character json (the file written by "save character")
+#in a plain python process:
+#python headless.py <character_name> <character.json> [output.npy]
+#It also precomputes the caches used at session start:
+#python headless.py precompute [data_folder] [cache_folder]
+#Without cache_folder, the folder of datacache.get_cache_dir is used.
+#The faces are stored in the .blend file, so only the vertex
+#coordinates (in the order of the lab mesh) are produced.
+
+import os
+import sys
+import json
+import time
+import logging
+import numpy
+
+if __package__:
+    from . import algorithms, datacache
+else:
+    import algorithms
+    import datacache
+
+lab_logger = logging.getLogger('manuelbastionilab_logger')
+
+TRANSFORMATION_IDS = {
+    "AGE": ("age_data", "character_age", "last_character_age"),
+    "FAT": ("fat_data", "character_mass", "last_character_mass"),
+    "MUSCLE": ("muscle_data", "character_tone", "last_character_tone")}
+
+
+def get_data_path():
+    return os.path.join(os.path.dirname(os.path.realpath(__file__)), "data")
+
+
+def get_character_paths(character_name, data_path):
+    """
+    Return the paths of the databases used for the character.
+    The morph databases are in the loading order of MorphingEngine,
+    so the overwrites are the same.
+    """
+    character_type = character_name.split("_")[0]
+    gender_type = character_name.split("_")[1]
+    shared_prefix = character_type+"_"+gender_type
+    character_label = character_name[:len(character_name)-2]
+    return {
+        "vertices": os.path.join(data_path, character_name, "vertices.json"),
+        "morphs": [
+            os.path.join(data_path, "shared_morphs", shared_prefix+"_morphs.json"),
+            os.path.join(data_path, character_name, "morphs.json"),
+            os.path.join(data_path, character_name, "extra_morphs.json"),
+            os.path.join(data_path, "shared_morphs", shared_prefix+"_morphs_extra.json")],
+        "expressions": os.path.join(data_path, character_name, "expressions.json"),
+        "measures": os.path.join(data_path, "shared_measures", shared_prefix+"_measures.json"),
+        "transformations": os.path.join(data_path, "shared_transformations", character_label+"_transf.json")}
+
+
+class HeadlessCharacter:
+    """
+    The same evaluation of Humanoid and MorphingEngine, without
+    the Blender object: the character data are converted in morph
+    values with smart_combo and the morphs are summed to the base form.
+    """
+
+    def __init__(self, character_name, data_path=None):
+        time1 = time.time()
+        if not data_path:
+            data_path = get_data_path()
+        self.name = character_name
+        self.data_path = data_path
+        self.cache_path = datacache.get_cache_dir(data_path)
+        self.character_label = character_name[:len(character_name)-2]
+        self.paths = get_character_paths(character_name, data_path)
+
+        self.no_categories = "BasisAsymTest"
+        self.base_form = numpy.zeros((0,3), dtype=numpy.float32)
+        self.morph_data = {}
+        self.modifiers = {}
+        self.character_data = {}
+        self.character_metaproperties = {"last_character_age":0.0,
+                                        "character_age":0.0,
+                                        "last_character_mass":0.0,
+                                        "character_mass":0.0,
+                                        "last_character_tone":0.0,
+                                        "character_tone":0.0}
+        self.measures_data = {}
+
+        verts = datacache.load_vertices(self.paths["vertices"], self.cache_path)
+        if verts is not None:
+            self.base_form = numpy.array(verts, dtype=numpy.float32)
+
+        for morph_data_path in self.paths["morphs"]+[self.paths["expressions"]]:
+            m_data = datacache.load_morphs(morph_data_path, self.cache_path)
+            if m_data:
+                for morph_name, morph_indices, morph_deltas in m_data:
+                    self.morph_data[morph_name] = (morph_indices, morph_deltas)
+
+        for morph_name in self.morph_data.keys():
+            self.init_character_data(morph_name)
+
+        m_database = algorithms.load_json_data(self.paths["measures"], "Measures data")
+        if m_database:
+            self.measures_data = m_database["measures"]
+        self.compiled_measures = algorithms.compile_measures(self.measures_data)
+
+        self.transformations_data = algorithms.load_json_data(
+            self.paths["transformations"],
+            "Transformations database") or {}
+        prop_names = sorted(self.character_data.keys())
+        self.transformations_index = {}
+        for transformation_id, tr_data in self.transformations_data.items():
+            self.transformations_index[transformation_id] = algorithms.compile_transformation(tr_data, prop_names)
+
+        lab_logger.info("Headless character {0} initialized in {1} secs".format(character_name, time.time()-time1))
+
+    def __repr__(self):
+        return "Headless character {0} with {1} verts and {2} morphs".format(
+            self.name,
+            len(self.base_form),
+            len(self.morph_data))
+
+    def init_character_data(self, morph_name):
+        """
+        Same rules of Humanoid.init_character_data: the modifier
+        is the first two parts of the morph name.
+        """
+        components = morph_name.split("_")
+        if components[0][:4] not in self.no_categories:
+            if len(components) == 3:
+                modifier_name = components[0]+"_"+components[1]
+                if modifier_name not in self.modifiers:
+                    self.modifiers[modifier_name] = []
+                properties = self.modifiers[modifier_name]
+                for element in components[1].split("-"):
+                    prop = components[0]+"_" + element
+                    if prop not in properties:
+                        properties.append(prop)
+                    self.character_data[prop] = 0.5
+            else:
+                lab_logger.warning("Wrong name for morph: {0}".format(morph_name))
+
+    def reset(self):
+        for prop in self.character_data.keys():
+            self.character_data[prop] = 0.5
+        for meta_data_prop in self.character_metaproperties.keys():
+            self.character_metaproperties[meta_data_prop] = 0.0
+
+    def load_character(self, data_source):
+        """
+        Load the structural and meta properties from a
+        character json path or from its dictionary.
+        """
+        if type(data_source) == str:
+            charac_data = algorithms.load_json_data(data_source, "Character data")
+        else:
+            charac_data = data_source
+        if not charac_data:
+            return False
+        self.reset()
+
+        char_data = charac_data.get("structural", {})
+        for name in self.character_data.keys():
+            if name in char_data:
+                self.character_data[name] = char_data[name]
+        meta_data = charac_data.get("metaproperties", {})
+        for name in self.character_metaproperties.keys():
+            if name in meta_data:
+                self.character_metaproperties[name] = meta_data[name]
+        return True
+
+    def set_transformation(self, tr_type, value):
+        """
+        Change age ("AGE"), mass ("FAT") or tone ("MUSCLE"), with
+        the same linear rules of Humanoid.calculate_transformation.
+        """
+        transformation_id, meta_name, last_meta_name = TRANSFORMATION_IDS[tr_type]
+        if transformation_id not in self.transformations_index:
+            lab_logger.warning("{0} data not present".format(transformation_id))
+            return
+
+        previous_value = self.character_metaproperties[last_meta_name]
+        affected_props = self.transformations_index[transformation_id][0]
+        deltas = algorithms.transformation_deltas(self.transformations_index[transformation_id], value, previous_value)
+        for prop, delta in zip(affected_props, deltas.tolist()):
+            self.character_data[prop] = self.character_data[prop] + delta
+
+        self.character_metaproperties[meta_name] = value
+        self.character_metaproperties[last_meta_name] = value
+
+    def get_morph_weights(self):
+        morph_weights = {}
+        for modifier_name, properties in self.modifiers.items():
+            values = []
+            for prop in properties:
+                val = min(1.0, max(0.0, self.character_data[prop]))
+                values.append([algorithms.function_modifier_a(val), algorithms.function_modifier_b(val)])
+            names = algorithms.smart_combo_names(modifier_name, len(properties))
+            weights = algorithms.smart_combo_weights(values)
+            morph_weights.update(zip(names, weights.tolist()))
+        return morph_weights
+
+    def calculate_vertices(self):
+        """
+        Return the (n,3) float32 coordinates of the character.
+        """
+        form = self.base_form.astype(numpy.float64)
+        morphs = []
+        weights = []
+        for morph_name, weight in self.get_morph_weights().items():
+            if weight != 0.0 and morph_name in self.morph_data:
+                morphs.append(self.morph_data[morph_name])
+                weights.append(weight)
+        algorithms.add_weighted_morphs(form, morphs, weights)
+        return form.astype(numpy.float32)
+
+    def calculate_measures(self, vert_coords=None):
+        if vert_coords is None:
+            vert_coords = self.calculate_vertices()
+        measures_values = algorithms.calculate_compiled_measures(vert_coords, self.compiled_measures)
+        return dict(zip(self.compiled_measures["names"], measures_values.tolist()))
+
+
+def precompute(data_path=None, cache_dir=None):
+    """
+    Compile the databases and the body libraries of all the
+    characters, for example in a build pipeline, so the session
+    start only loads them. Return the number of compiled packs.
+    """
+    if not data_path:
+        data_path = get_data_path()
+    return datacache.compile_databases(data_path, cache_dir)
+
+
+def evaluate_character(character_name, data_source, data_path=None):
+    """
+    Return the vertices and the measures of the
+    character described by the json data_source.
+    """
+    character = HeadlessCharacter(character_name, data_path)
+    character.load_character(data_source)
+    verts = character.calculate_vertices()
+    return verts, character.calculate_measures(verts)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) > 1 and sys.argv[1] == "precompute":
+        precompute(*sys.argv[2:4])
+    elif len(sys.argv) > 2:
+        verts, measures = evaluate_character(sys.argv[1], sys.argv[2])
+        if len(sys.argv) > 3:
+            numpy.save(sys.argv[3], verts)
+        print(json.dumps(measures, indent=1, sort_keys=True))
+    else:
+        print("Usage: python headless.py <character_name> <character.json> [output.npy]")
+        print("       python headless.py precompute [data_folder] [cache_folder]")
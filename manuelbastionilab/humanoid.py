@@ -20,10 +20,36 @@ import time
 import json
 import logging
 import operator
+import collections
+import numpy
 
 
 lab_logger = logging.getLogger('manuelbastionilab_logger')
 
+#Stages of update_character, in order of execution. A stage runs
+#only if the mode requests it and if its inputs changed since it
+#ran last time: the morph values for the geometry, the geometry for
+#measures, joints and normals, the internal data for the GUI syncs.
+UPDATE_STAGES = ("morphs", "geometry", "gui", "materials", "gui_metadata", "measures", "armature", "normals")
+GEOMETRY_STAGES = ("measures", "armature", "normals")
+
+UPDATE_MODES = {
+    "update_all": ("morphs", "geometry", "gui", "materials", "gui_metadata", "measures", "armature", "normals"),
+    "update_metadata": ("morphs", "geometry", "gui", "measures", "armature", "normals"),
+    "update_directly_verts": ("geometry", "gui", "measures", "armature", "normals"),
+    "update_only_morphdata": ("morphs",),
+    "update_realtime": ("morphs", "geometry"),
+    "update_secondary": ("gui", "measures", "armature", "normals"),
+    "update_transformation": ("morphs", "geometry", "gui", "measures", "armature", "normals"),
+    "update_transformation_realtime": ("morphs", "geometry"),
+    "update_changed": ("morphs", "geometry", "gui", "materials", "gui_metadata", "measures", "armature", "normals")}
+
+#Modes that upload all the verts instead of the modified ones only
+FULL_GEOMETRY_MODES = ("update_all", "update_metadata", "update_directly_verts")
+
+#Max number of value tuples with stored smart_combo weights, per modifier
+COMBO_CACHE_SIZE = 32
+
 
 class HumanModifier:
     """
@@ -34,6 +60,9 @@ class HumanModifier:
         self.name = name
         self.obj_name = obj_name
         self.properties = []
+        self.combo_names = None
+        self.combo_cache = collections.OrderedDict()
+        self.applied_values = None
 
     def get_object(self):
         """
@@ -46,6 +75,37 @@ class HumanModifier:
 
     def add(self, prop):
         self.properties.append(prop)
+        self.combo_names = None
+        self.combo_cache.clear()
+
+    def get_combo_weights(self, values):
+        """
+        Return the dict of the morph weights calculated by smart
+        combo for the tuple of the (clamped) values of the properties.
+        The results of the last COMBO_CACHE_SIZE tuples are stored.
+        Important: the returned dict is shared, don't modify it.
+        """
+        if values in self.combo_cache:
+            self.combo_cache.move_to_end(values)
+            return self.combo_cache[values]
+        morph_weights = self.calculate_combo_weights(values)
+        self.combo_cache[values] = morph_weights
+        if len(self.combo_cache) > COMBO_CACHE_SIZE:
+            self.combo_cache.popitem(last=False)
+        return morph_weights
+
+    def calculate_combo_weights(self, values):
+        """
+        Return a new dict of the smart combo morph weights for the
+        values, without storing it. Used for the temporary values.
+        """
+        if self.combo_names is None:
+            self.combo_names = algorithms.smart_combo_names(self.name, len(self.properties))
+        combo_values = []
+        for val in values:
+            combo_values.append([algorithms.function_modifier_a(val), algorithms.function_modifier_b(val)])
+        weights = algorithms.smart_combo_weights(combo_values)
+        return dict(zip(self.combo_names, weights.tolist()))
 
     def __contains__(self, prop):
         for propx in self.properties:
@@ -156,6 +216,16 @@ class Humanoid:
         self.lab_vers = list(lab_version)
         self.has_data = False
         self.name = ""
+        #The slider changes are applied by process_realtime_updates:
+        #the measures, the joints and the normals are updated when the
+        #slider is still for realtime_settle_time secs, or every
+        #secondary_update_interval secs while it moves
+        self.realtime_categories = set()
+        self.secondary_pending = False
+        self.last_realtime_request = 0.0
+        self.last_secondary_update = 0.0
+        self.realtime_settle_time = 0.25
+        self.secondary_update_interval = 0.5
         addon_directory = os.path.dirname(os.path.realpath(__file__))
         data_dir = os.path.join(addon_directory, "data")
         lab_logger.info("Looking for the database in the folder {0}...".format(algorithms.simple_path(data_dir)))
@@ -283,20 +353,26 @@ class Humanoid:
             self.metadata_realtime_activated = True
             self.material_realtime_activated = True
             self.transformations_data = {}
-
-            for morph in self.m_engine.morph_data.keys():
+            self.transformations_index = {}
+            self.stages_dirty = {}
+            self.stage_timings = {}
+            self.synced_data = {}
+            self.invalidate_update_stages()
+            self.realtime_categories = set()
+            self.secondary_pending = False
+
+            for morph in self.m_engine.get_morph_names():
                 self.init_character_data(morph)
 
             lab_logger.info("Loaded {0} categories from morph database".format(
                 len(self.categories)))
             bpy.context.scene.objects.active = obj
             self.measures = self.m_engine.measures
-            self.delta_measures = {}
-            self.init_delta_measures()
             self.load_transformation_database()
             self.add_corrective_smooth_modifier()
             self.mat_engine.add_subdivision_modifier()
             self.mat_engine.add_displacement_modifier()
+            self.prefetch_libraries()
             self.has_data = True
 
         else:
@@ -341,8 +417,30 @@ class Humanoid:
             return bpy.data.objects[self.name]
         return None
 
+    def prefetch_libraries(self):
+        """
+        Presets, phenotypes, expressions and poses are
+        parsed in background after the initialization.
+        """
+        algorithms.prefetch_json_folders([
+            self.preset_path,
+            self.ethnic_path,
+            self.expression_path,
+            self.pose_path,
+            self.restposes_path])
+
     def load_transformation_database(self):
+        """
+        The age, mass and tone tables are compiled in the coefficients
+        of the properties they change, so a transformation doesn't
+        search the properties at each slider change.
+        """
         self.transformations_data = algorithms.load_json_data(self.shared_transform_data_path, "Transformations database")
+        self.transformations_index = {}
+        if self.transformations_data:
+            prop_names = sorted(self.character_data.keys())
+            for transformation_id, tr_data in self.transformations_data.items():
+                self.transformations_index[transformation_id] = algorithms.compile_transformation(tr_data, prop_names)
 
     def get_categories(self):
         categories = self.categories.values()
@@ -385,6 +483,7 @@ class Humanoid:
 
     def reset_category(self, categ):
         time1 = time.time()
+        self.apply_realtime_changes()
         obj = self.get_object()
         category = self.get_category(categ)
         for prop in category.get_all_properties():
@@ -420,12 +519,11 @@ class Humanoid:
 
 
 
-    def automodelling(self,use_measures_from_GUI=False, use_measures_from_dict=None, use_measures_from_current_obj=False, mix=False):
+    def automodelling(self,use_measures_from_GUI=False, use_measures_from_dict=None, use_measures_from_current_obj=False, mix=False, n_samples=3):
 
         if self.m_engine.measures_database_exist:
             time2 = time.time()
             obj = self.get_object()
-            n_samples = 3
 
             if use_measures_from_GUI:
                 convert_to_inch = getattr(obj, "use_inch",False)
@@ -447,24 +545,25 @@ class Humanoid:
                 wished_measures["body_height_Z"] = total_height_Z
 
             if use_measures_from_current_obj:
-                current_shape_verts = []
-                for vert in obj.data.vertices:
-                    current_shape_verts.append(vert.co.copy())
+                current_shape_verts = self.m_engine.read_mesh_coords()
                 wished_measures = self.m_engine.calculate_measures(vert_coords=current_shape_verts)
 
             if use_measures_from_dict:
                 wished_measures = use_measures_from_dict
 
             self.m_engine.calculate_proportions(wished_measures)
-            similar_characters_data  = self.m_engine.compare_data_proportions()
+            time3 = time.time()
+            similar_characters_data  = self.m_engine.compare_data_proportions(n_samples)
+            lab_logger.info("{0} similar bodies found in {1} secs".format(
+                len(similar_characters_data), time.time()-time3))
 
             best_character = similar_characters_data[0]
             filepath = best_character[1]
-            self.load_character(filepath)
+            self.load_character(self.m_engine.get_body_character(filepath))
 
             for char_data in similar_characters_data[1:n_samples]:
                 filepath = char_data[1]
-                self.load_character(filepath, mix = True)
+                self.load_character(self.m_engine.get_body_character(filepath), mix = True)
 
 
             self.measure_fitting(wished_measures, mix)
@@ -473,7 +572,7 @@ class Humanoid:
             lab_logger.info("Human fitting in {0} secs".format(time.time()-time2))
 
     def clean_verts_to_process(self):
-        self.m_engine.verts_to_update.clear()
+        self.m_engine.clear_dirty_verts()
 
     def update_displacement(self):
         obj = self.get_object()
@@ -558,9 +657,12 @@ class Humanoid:
 
     def update_materials(self, update_textures_nodes = True):
         obj = self.get_object()
+        gui_props = []
         for prop in self.character_material_properties.keys():
             if hasattr(obj, prop):
                 self.character_material_properties[prop] = getattr(obj, prop)
+                gui_props.append(prop)
+        self.record_gui_values("materials", gui_props)
         self.mat_engine.update_shaders(self.character_material_properties, update_textures_nodes)
 
     def correct_expressions(self, correct_all=False):
@@ -585,6 +687,7 @@ class Humanoid:
 
     def reset_character(self):
         time1 = time.time()
+        self.apply_realtime_changes()
         obj = self.get_object()
         self.reset_metadata()
         for category in self.get_categories():
@@ -603,6 +706,12 @@ class Humanoid:
             self.character_metaproperties[meta_data_prop]=0.0
 
 
+    def unload_expressions(self):
+        """
+        Free the expression morphs, if no expression is applied.
+        """
+        return self.m_engine.unload_expressions()
+
     def reset_mesh(self):
         self.m_engine.reset()
 
@@ -689,18 +798,25 @@ class Humanoid:
 
 
 
-    def sync_obj_props_to_character_data(self):
+    def sync_obj_props_to_character_data(self, only_changed=False):
         obj = self.get_object()
         self.bodydata_realtime_activated = False
+        synced_props = self.synced_data.get("gui")
+        if not only_changed or self.stages_dirty.get("gui", True) or synced_props is None:
+            synced_props = {}
         for prop,value in self.character_data.items():
-            setattr(obj, prop, value)
+            if synced_props.get(prop) != value:
+                setattr(obj, prop, value)
 
     def sync_character_data_to_obj_props(self):
         obj = self.get_object()
         self.bodydata_realtime_activated = False
+        gui_props = []
         for prop in obj.keys():
             if prop in self.character_data:
                 self.character_data[prop] = getattr(obj,prop)
+                gui_props.append(prop)
+        self.record_gui_values("gui", gui_props)
 
 
     def sync_internal_data_with_mesh(self):
@@ -720,124 +836,196 @@ class Humanoid:
             if hasattr(obj, measure_name):
                 setattr(obj, measure_name, measure_val*conversion_factor)
 
-    def update_character(self, category_name = None, mode = "update_all"):
+    def invalidate_update_stages(self, stages=UPDATE_STAGES):
+        """
+        Force the stages to run at the next update_character,
+        for example when the object may be out of sync (undo).
+        """
+        for stage in stages:
+            self.stages_dirty[stage] = True
+
+    def get_stage_data(self, stage):
+        """
+        Internal data pushed to the object by the GUI stages.
+        """
+        if stage == "gui":
+            return self.character_data
+        if stage == "materials":
+            return self.character_material_properties
+        if stage == "gui_metadata":
+            return self.character_metaproperties
+        return None
+
+    def is_stage_to_run(self, stage, requested_stages):
+        if stage not in requested_stages:
+            return False
+        if self.stages_dirty.get(stage, True):
+            return True
+        stage_data = self.get_stage_data(stage)
+        if stage_data is not None:
+            return stage_data != self.synced_data.get(stage)
+        return False
+
+    def record_gui_values(self, stage, props):
+        """
+        The props are read from the GUI, so the GUI already shows
+        them: store them in the snapshot of the stage, otherwise the
+        stage would skip them when they are set back to the old value.
+        """
+        synced_props = self.synced_data.get(stage)
+        if synced_props is not None:
+            stage_data = self.get_stage_data(stage)
+            for prop in props:
+                synced_props[prop] = stage_data[prop]
+
+    def run_update_stage(self, stage, stage_function, *args, **kwargs):
+        time1 = time.time()
+        stage_function(*args, **kwargs)
+        self.stage_timings[stage] = time.time()-time1
+        self.stages_dirty[stage] = False
+        stage_data = self.get_stage_data(stage)
+        if stage_data is not None:
+            self.synced_data[stage] = dict(stage_data)
+
+    def update_morphs_stage(self, category_name, sync_morphdata, modifiers=None):
+        if modifiers is not None:
+            self.combine_all_morphings(modifiers)
+        elif category_name:
+            category = self.categories[category_name]
+            modified_modifiers = []
+            for modifier in category.get_modifiers():
+                if modifier.is_changed(self.character_data):
+                    modified_modifiers.append(modifier)
+            for modifier in modified_modifiers:
+                if sync_morphdata:
+                    modifier.sync_modifier_data_to_obj_prop(self.character_data)
+                    self.record_gui_values("gui", modifier.get_properties())
+            self.combine_all_morphings(modified_modifiers)
+        else:
+            all_modifiers = []
+            for category in self.get_categories():
+                all_modifiers.extend(category.get_modifiers())
+            self.combine_all_morphings(all_modifiers, add_vertices_to_update=True)
+        if len(self.m_engine.get_dirty_verts()) > 0:
+            self.invalidate_update_stages(["geometry"])
+
+    def update_character(self, category_name = None, mode = "update_all", modifiers = None):
         time1 = time.time()
         obj = self.get_object()
+        requested_stages = UPDATE_MODES[mode]
+        if mode not in ("update_realtime", "update_secondary"):
+            #The pending slider changes are not in character_data yet.
+            #The methods that modify character_data apply them before,
+            #otherwise the slider values would overwrite the new data
+            self.apply_realtime_changes()
+        #Timings of the stages run by this call only
+        self.stage_timings = {}
+
+        #The modified verts of a previous call are lost: if the
+        #geometry is still pending, all the verts are uploaded
+        update_all_verts = mode in FULL_GEOMETRY_MODES or self.stages_dirty["geometry"]
         self.clean_verts_to_process()
-
-        if mode == "update_all":
-            update_directly_verts = False
-            update_geometry_all = True
-            update_geometry_selective = False
-            update_armature = True
-            update_normals = True
-            update_proxy = False
-            update_measures = True
-            sync_morphdata = False
-            sync_GUI = True
-            sync_GUI_metadata = True
-            sync_GUI_materials = True
-
-        if mode == "update_metadata":
-            update_directly_verts = False
-            update_geometry_all = True
-            update_geometry_selective = False
-            update_armature = True
-            update_normals = True
-            update_proxy = False
-            update_measures = True
-            sync_morphdata = False
-            sync_GUI = True
-            sync_GUI_metadata = False
-            sync_GUI_materials = False
-
         if mode == "update_directly_verts":
-            update_directly_verts = True
-            update_geometry_all = False
-            update_geometry_selective = False
-            update_armature = True
-            update_normals = True
-            update_proxy = False
-            update_measures = True
-            sync_morphdata = False
-            sync_GUI = True
-            sync_GUI_metadata = False
-            sync_GUI_materials = False
-
-        if mode == "update_only_morphdata":
-            update_directly_verts = False
-            update_geometry_all = False
-            update_geometry_selective = False
-            update_armature = False
-            update_normals = False
-            update_proxy = False
-            update_measures = False
-            sync_morphdata = False
-            sync_GUI = False
-            sync_GUI_metadata = False
-            sync_GUI_materials = False
-
-        if mode == "update_realtime":
-            update_directly_verts = False
-            update_geometry_all = False
-            update_geometry_selective = True
-            update_armature = True
-            update_normals = False
-            update_proxy = False
-            update_measures = False
-            sync_morphdata = True
-            sync_GUI = False
-            sync_GUI_metadata = False
-            sync_GUI_materials = False
-
-
-        if update_directly_verts:
-            self.m_engine.update(update_all_verts=True)
-        else:
-            if category_name:
-                category = self.categories[category_name]
-                modified_modifiers = []
-                for modifier in category.get_modifiers():
-                    if modifier.is_changed(self.character_data):
-                        modified_modifiers.append(modifier)
-                for modifier in modified_modifiers:
-                    if sync_morphdata:
-                        modifier.sync_modifier_data_to_obj_prop(self.character_data)
-                    self.combine_morphings(modifier)
-            else:
-                for category in self.get_categories():
-                    for modifier in category.get_modifiers():
-                        self.combine_morphings(modifier, add_vertices_to_update=True)
-
-        if update_geometry_all:
-            self.m_engine.update(update_all_verts=True)
-        if update_geometry_selective:
-            self.m_engine.update(update_all_verts=False)
-        if sync_GUI:
-            self.sync_obj_props_to_character_data()
-        if sync_GUI_materials:
-            self.sync_obj_props_to_character_materials()
-            self.update_materials()
-
-        if sync_GUI_metadata:
-            self.sync_obj_props_to_character_metadata()
-        if update_measures:
-            self.sync_gui_according_measures()
-        if update_armature:
-            self.armat.fit_joints()
-        if update_normals:
-            obj.data.calc_normals()
-        if update_proxy:
-            self.fit_proxy()
+            self.invalidate_update_stages(["geometry"])
+
+        if "morphs" in requested_stages:
+            self.run_update_stage("morphs", self.update_morphs_stage, category_name, mode == "update_realtime", modifiers)
+        if self.is_stage_to_run("geometry", requested_stages):
+            self.run_update_stage("geometry", self.m_engine.update, update_all_verts=update_all_verts)
+            geometry_stages = GEOMETRY_STAGES
+            if not update_all_verts and not self.armat.are_joints_affected(self.m_engine.get_dirty_verts()):
+                #The modified verts don't move any joint
+                geometry_stages = [stage for stage in GEOMETRY_STAGES if stage != "armature"]
+            self.invalidate_update_stages(geometry_stages)
+        if self.is_stage_to_run("gui", requested_stages):
+            self.run_update_stage("gui", self.sync_obj_props_to_character_data, only_changed=True)
+        if self.is_stage_to_run("materials", requested_stages):
+            self.run_update_stage("materials", self.update_materials_stage)
+        if self.is_stage_to_run("gui_metadata", requested_stages):
+            self.run_update_stage("gui_metadata", self.sync_obj_props_to_character_metadata)
+        if self.is_stage_to_run("measures", requested_stages):
+            self.run_update_stage("measures", self.sync_gui_according_measures)
+        if self.is_stage_to_run("armature", requested_stages):
+            self.run_update_stage("armature", self.armat.fit_joints)
+        if self.is_stage_to_run("normals", requested_stages):
+            self.run_update_stage("normals", obj.data.calc_normals)
 
         animation_source = self.armat.get_source_armature()
         if animation_source:
             animation_source.hide = True
 
-        #lab_logger.debug("Character updated in {0} secs".format(time.time()-time1))
+        lab_logger.debug("Character updated ({0}) in {1} secs. Stages: {2}".format(
+            mode, time.time()-time1, self.format_stage_timings()))
+
+    def get_stage_timings(self):
+        """
+        Return the dict stage: secs of the stages
+        run by the last update_character.
+        """
+        return dict(self.stage_timings)
+
+    def format_stage_timings(self):
+        return ", ".join("{0} {1:.4f}".format(stage, self.stage_timings[stage])
+            for stage in UPDATE_STAGES if stage in self.stage_timings)
+
+    def request_realtime_update(self, category_name):
+        """
+        Called by the slider callbacks. The changes are applied
+        by process_realtime_updates, so a burst of slider
+        events costs a single update.
+        """
+        self.realtime_categories.add(category_name)
+        self.last_realtime_request = time.time()
+
+    def has_pending_updates(self):
+        return bool(self.realtime_categories) or self.secondary_pending
+
+    def defer_secondary_update(self):
+        """
+        The stages after the geometry will run in the
+        trailing update of process_realtime_updates.
+        """
+        self.secondary_pending = True
+        self.last_realtime_request = time.time()
+
+    def apply_realtime_changes(self):
+        """
+        Apply the pending slider changes. Call it before
+        modifying character_data from code.
+        """
+        if not self.realtime_categories:
+            return False
+        categories = self.realtime_categories
+        self.realtime_categories = set()
+        for category_name in categories:
+            self.update_character(category_name = category_name, mode = "update_realtime")
+        self.secondary_pending = True
+        return True
+
+    def process_realtime_updates(self):
+        """
+        Apply the pending slider changes to the geometry. The stages
+        that follow the geometry are deferred to a trailing update.
+        Return True if the character is updated.
+        """
+        updated = self.apply_realtime_changes()
+        if self.secondary_pending:
+            current_time = time.time()
+            is_settled = current_time-self.last_realtime_request >= self.realtime_settle_time
+            if is_settled or current_time-self.last_secondary_update >= self.secondary_update_interval:
+                self.secondary_pending = False
+                self.last_secondary_update = current_time
+                self.update_character(mode = "update_secondary")
+                updated = True
+        return updated
+
+    def update_materials_stage(self):
+        self.sync_obj_props_to_character_materials()
+        self.update_materials()
 
     def generate_character(self,random_value,prv_face,prv_body,prv_mass,prv_tone,prv_height,prv_phenotype,set_tone_and_mass,body_mass,body_tone):
         lab_logger.info("Generating character...")
+        self.apply_realtime_changes()
 
         all_props = [x for x in self.character_data.keys()]
         props_to_process = all_props.copy()
@@ -900,10 +1088,16 @@ class Humanoid:
 
 
 
-    def calculate_transformation(self, tr_type):
+    def calculate_transformation(self, tr_type, realtime=False):
+        """
+        Apply the age, mass or tone of the object. With realtime
+        (the slider callbacks) only the geometry is updated, the
+        other stages are deferred to the trailing update.
+        """
 
 
         obj = self.get_object()
+        self.apply_realtime_changes()
         #TODO automatizzare con getattr direttamente dal dizionario
 
         if tr_type == "AGE":
@@ -919,142 +1113,157 @@ class Humanoid:
             previous_tr_factor = self.character_metaproperties["last_character_tone"]
             transformation_id = "muscle_data"
 
-        if current_tr_factor >= 0:
-            transformation_2 = current_tr_factor
-            transformation_1 = 0
-        else:
-            transformation_2 = 0
-            transformation_1 = -current_tr_factor
-
-        if previous_tr_factor >= 0:
-            last_transformation_2 = previous_tr_factor
-            last_transformation_1 = 0
-        else:
-            last_transformation_2 = 0
-            last_transformation_1 = -previous_tr_factor
-
-
-        if transformation_id in self.transformations_data:
-            tr_data = self.transformations_data[transformation_id]
-
-            for prop in self.character_data:
-                for tr_parameter in tr_data:
-                    if tr_parameter[0] in prop:
-                        linear_factor = tr_parameter[1]*transformation_1 + tr_parameter[2]*transformation_2 - tr_parameter[1]*last_transformation_1 - tr_parameter[2]*last_transformation_2
-
-                        self.character_data[prop] = self.character_data[prop] + linear_factor
+        if transformation_id in self.transformations_index:
+            affected_props = self.transformations_index[transformation_id][0]
+            deltas = algorithms.transformation_deltas(
+                self.transformations_index[transformation_id],
+                current_tr_factor,
+                previous_tr_factor)
+            for prop, delta in zip(affected_props, deltas.tolist()):
+                self.character_data[prop] = self.character_data[prop] + delta
 
             if tr_type == "AGE":
-                self.character_metaproperties['character_age'] = current_tr_factor
-                self.character_metaproperties['last_character_age'] = current_tr_factor
+                meta_name = 'character_age'
             if tr_type == "FAT":
-                self.character_metaproperties['character_mass'] = current_tr_factor
-                self.character_metaproperties['last_character_mass'] = current_tr_factor
+                meta_name = 'character_mass'
             if tr_type == "MUSCLE":
-                self.character_metaproperties['character_tone'] = current_tr_factor
-                self.character_metaproperties['last_character_tone'] = current_tr_factor
-
-            self.update_character(mode = "update_metadata")
+                meta_name = 'character_tone'
+            self.character_metaproperties[meta_name] = current_tr_factor
+            self.character_metaproperties['last_'+meta_name] = current_tr_factor
+            self.record_gui_values("gui_metadata", [meta_name, 'last_'+meta_name])
+
+            if realtime:
+                self.update_character(mode = "update_transformation_realtime")
+                self.defer_secondary_update()
+            else:
+                self.update_character(mode = "update_transformation")
 
         else:
             lab_logger.warning("{0} data not present".format(transformation_id))
 
 
-    def init_delta_measures(self):
-
-        obj = self.get_object()
-        time1 = time.time()
+    def get_fitting_relations(self, wished_measures):
+        """
+        Return the measures to fit and the (modifier, prop) to use,
+        from the relations of the measures database.
+        """
+        measure_names = []
+        fitting_props = []
         for relation in self.m_engine.measures_relat_data:
-            m_name = relation[0]
+            measure_name = relation[0]
             modifier_name = relation[1]
-            for category in self.get_categories():
-                for modifier in category.get_modifiers():
-                    if modifier.name == modifier_name:
-                        for prop in modifier.get_properties():
-
-                            self.character_data[prop] = 0.0
-                            self.combine_morphings(modifier)
-                            measure1 = self.m_engine.calculate_measures(measure_name=m_name)
-
-                            self.character_data[prop] = 1.0
-                            self.combine_morphings(modifier)
-                            measure3 = self.m_engine.calculate_measures(measure_name=m_name)
-
-                            #Last measure also restores the value to 0.5
-                            self.character_data[prop] = 0.5
-                            self.combine_morphings(modifier)
-                            measure2 = self.m_engine.calculate_measures(measure_name=m_name)
-
-                            delta_name = modifier_name+prop
-
-                            delta1 = measure1-measure2
-                            delta3 = measure3-measure2
-
-                            self.delta_measures[delta_name] = [delta1,delta3]
-
-
-        lab_logger.info("Delta init in {0} secs".format(time.time()-time1))
-
-
-    def search_best_value(self,m_name,wished_measure,human_modifier,prop):
-
-        self.character_data[prop] = 0.5
-        self.combine_morphings(human_modifier)
-        measure2 = self.m_engine.calculate_measures(measure_name=m_name)
-        delta_name = human_modifier.name+prop
-
-        delta1 = self.delta_measures[delta_name][0]
-        delta3 = self.delta_measures[delta_name][1]
-
-        measure1 = measure2 + delta1
-        measure3 = measure2 + delta3
-
-        if wished_measure < measure2:
-            xa = 0
-            xb = 0.5
-            ya = measure1
-            yb = measure2
-        else:
-            xa = 0.5
-            xb = 1
-            ya = measure2
-            yb = measure3
-
-        if ya-yb != 0:
-            value = algorithms.linear_interpolation_y(xa,xb,ya,yb,wished_measure)
-
-            if value < 0:
-                value = 0
-            if value > 1:
-                value = 1
-        else:
-            value = 0.5
-        return value
-
-
-    def measure_fitting(self, wished_measures,mix = False):
-
+            if measure_name in wished_measures and measure_name in self.m_engine.measures_index:
+                for category in self.get_categories():
+                    for modifier in category.get_modifiers():
+                        if modifier.name == modifier_name:
+                            if measure_name not in measure_names:
+                                measure_names.append(measure_name)
+                            for prop in modifier.get_properties():
+                                if (modifier, prop) not in fitting_props:
+                                    fitting_props.append((modifier, prop))
+        return measure_names, fitting_props
+
+    def calculate_fitting_measures(self, measure_names, vert_coords=None):
+        measures = self.m_engine.calculate_measures(vert_coords=vert_coords)
+        return numpy.array([measures[measure_name] for measure_name in measure_names])
+
+    def calculate_measures_jacobian(self, measure_names, fitting_props, step=0.05):
+        """
+        The (measures x props) matrix of the derivatives of the measures,
+        by finite differences on the current form. Each column deforms
+        a copy of the form with the morphs of one modifier only.
+        """
+        current_measures = self.calculate_fitting_measures(measure_names)
+        jacobian = numpy.zeros((len(measure_names), len(fitting_props)))
+        for j, (modifier, prop) in enumerate(fitting_props):
+            values = self.get_modifier_values(modifier)
+            prop_index = modifier.properties.index(prop)
+            prop_step = step
+            if values[prop_index]+prop_step > 1.0:
+                prop_step = -step
+            new_values = list(values)
+            new_values[prop_index] += prop_step
+            current_weights = modifier.get_combo_weights(values)
+            #The perturbed values are used once: they don't go in the combo cache
+            new_weights = modifier.calculate_combo_weights(new_values)
+
+            morphs = []
+            delta_weights = []
+            for morph_name, weight in new_weights.items():
+                delta_weight = weight-current_weights[morph_name]
+                if delta_weight != 0.0 and morph_name in self.m_engine.morph_data:
+                    morphs.append(self.m_engine.morph_data[morph_name])
+                    delta_weights.append(delta_weight)
+            if morphs:
+                new_form = self.m_engine.final_form.astype(numpy.float64)
+                algorithms.add_weighted_morphs(new_form, morphs, delta_weights)
+                new_measures = self.calculate_fitting_measures(measure_names, new_form)
+                jacobian[:,j] = (new_measures-current_measures)/prop_step
+        return jacobian, current_measures
+
+    def apply_fitting_values(self, fitting_props, fitting_modifiers, values):
+        for (modifier, prop), value in zip(fitting_props, values.tolist()):
+            self.character_data[prop] = value
+        self.combine_all_morphings(fitting_modifiers)
+
+    def measure_fitting(self, wished_measures, mix = False, iterations = 6):
+        """
+        Fit all the properties related to the wished measures together
+        (Gauss-Newton): at each iteration the sensitivity matrix is
+        calculated and the step is solved with bounded least squares,
+        so the values stay in [0,1]. The residuals are relative to the
+        wished measures, so all the measures have the same importance.
+        """
         if self.m_engine.measures_database_exist:
-            obj = self.get_object()
             time1 = time.time()
-            for relation in self.m_engine.measures_relat_data:
-                measure_name = relation[0]
-                modifier_name = relation[1]
-                if measure_name in wished_measures:
-                    wish_measure = wished_measures[measure_name]
-
-                    for category in self.get_categories():
-                        for modifier in category.get_modifiers():
-                            if modifier.name == modifier_name:
-                                for prop in modifier.get_properties():
-
-                                    if mix:
-                                        best_val = self.search_best_value(measure_name,wish_measure,modifier,prop)
-                                        value = (self.character_data[prop]+best_val)/2
-                                        self.character_data[prop] = value
-                                    else:
-                                        self.character_data[prop] = self.search_best_value(measure_name,wish_measure,modifier,prop)
-                                self.combine_morphings(modifier)
+            self.apply_realtime_changes()
+            measure_names, fitting_props = self.get_fitting_relations(wished_measures)
+            if not fitting_props:
+                return
+            start_values = numpy.array([self.character_data[prop] for modifier, prop in fitting_props])
+            fitting_modifiers = []
+            for modifier, prop in fitting_props:
+                if modifier not in fitting_modifiers:
+                    fitting_modifiers.append(modifier)
+            wished_values = numpy.array([wished_measures[measure_name] for measure_name in measure_names])
+            scale = 1.0/numpy.maximum(numpy.abs(wished_values), 1e-6)
+
+            values = numpy.clip(start_values, 0.0, 1.0)
+            self.apply_fitting_values(fitting_props, fitting_modifiers, values)
+            residual = (wished_values-self.calculate_fitting_measures(measure_names))*scale
+            cost = residual.dot(residual)
+            for iteration in range(iterations):
+                jacobian, current_measures = self.calculate_measures_jacobian(measure_names, fitting_props)
+                value_steps = algorithms.bounded_least_squares(
+                    jacobian*scale[:,numpy.newaxis],
+                    residual,
+                    -values,
+                    1.0-values)
+
+                #The measures are not linear: the step is halved
+                #until the fitting improves
+                step_factor = 1.0
+                improved = False
+                for attempt in range(4):
+                    new_values = numpy.clip(values+step_factor*value_steps, 0.0, 1.0)
+                    self.apply_fitting_values(fitting_props, fitting_modifiers, new_values)
+                    new_residual = (wished_values-self.calculate_fitting_measures(measure_names))*scale
+                    new_cost = new_residual.dot(new_residual)
+                    if new_cost < cost:
+                        improved = True
+                        break
+                    step_factor *= 0.5
+                if not improved:
+                    self.apply_fitting_values(fitting_props, fitting_modifiers, values)
+                    break
+                if numpy.abs(new_values-values).max() < 1e-4:
+                    values = new_values
+                    break
+                values, residual, cost = new_values, new_residual, new_cost
+
+            if mix:
+                values = (start_values+values)/2
+            self.apply_fitting_values(fitting_props, fitting_modifiers, values)
 
             lab_logger.info("Measures fitting in {0} secs".format(time.time()-time1))
 
@@ -1101,14 +1310,38 @@ class Humanoid:
             output_file.close()
 
 
-    def load_character(self, data_source, reset_string = "nothing", reset_unassigned=True, mix=False, update_mode = "update_all"):
+    def get_modifiers_to_update(self, changed_props):
+        """
+        Return the modifiers with changed properties, and the ones not
+        combined since the last change of the morph engine values.
+        """
+        changed_props = set(changed_props)
+        modifiers = []
+        for category in self.get_categories():
+            for modifier in category.get_modifiers():
+                if modifier.applied_values is None or modifier.applied_values[1] != self.m_engine.values_generation:
+                    modifiers.append(modifier)
+                    continue
+                for prop in modifier.properties:
+                    if prop in changed_props:
+                        modifiers.append(modifier)
+                        break
+        return modifiers
+
+    def load_character(self, data_source, reset_string = "nothing", reset_unassigned=True, mix=False, update_mode = "update_all", full_rebuild=False):
+        """
+        Load the character data. Only the modifiers with changed
+        properties are combined again and only the modified verts
+        are uploaded, unless full_rebuild is True.
+        """
 
         obj = self.get_object()
         log_msg_type = "character data"
+        self.apply_realtime_changes()
 
         if type(data_source) == str:  #TODO: better check of types
             log_msg_type = algorithms.simple_path(data_source)
-            charac_data = algorithms.load_json_data(data_source,"Character data")
+            charac_data = algorithms.load_cached_json_data(data_source,"Character data")
         else:
             charac_data = data_source
 
@@ -1138,6 +1371,7 @@ class Humanoid:
             lab_logger.warning("No metaproperties data in  {0}".format(log_msg_type))
             meta_data = {}
 
+        previous_data = dict(self.character_data)
         if char_data != None:
             for name in self.character_data.keys():
                 if reset_string in name:
@@ -1164,7 +1398,18 @@ class Humanoid:
             if name in material_data:
                 self.character_material_properties[name] = material_data[name]
 
-        self.update_character(mode = update_mode)
+        if full_rebuild:
+            for category in self.get_categories():
+                for modifier in category.get_modifiers():
+                    modifier.applied_values = None
+            self.invalidate_update_stages()
+            self.update_character(mode = update_mode)
+        else:
+            changed_props = [name for name, value in self.character_data.items() if previous_data[name] != value]
+            lab_logger.info("{0} properties changed by {1}".format(len(changed_props), log_msg_type))
+            if update_mode == "update_all":
+                update_mode = "update_changed"
+            self.update_character(mode = update_mode, modifiers = self.get_modifiers_to_update(changed_props))
 
     def load_measures(self, filepath):
         char_data = algorithms.load_json_data(filepath, "Measures data")
@@ -1267,11 +1512,7 @@ class Humanoid:
                 if fix_intersection:
                     proxyengine.proxy_collision(obj, proxy_obj, self.m_engine.base_form, correction_factor = corr_factor)
 
-    def combine_morphings(self, modifier, refresh_only=False, add_vertices_to_update=True):
-        """
-        Mix shapekeys using smart combo algorithm.
-        """
-
+    def get_modifier_values(self, modifier):
         values = []
         for prop in modifier.properties:
             val = self.character_data[prop]
@@ -1279,18 +1520,48 @@ class Humanoid:
                 val = 1.0
             if val < 0:
                 val = 0
-            val1 = algorithms.function_modifier_a(val)
-            val2 = algorithms.function_modifier_b(val)
-            values.append([val1, val2])
-        names, weights = algorithms.smart_combo(modifier.name, values)
-        for i in range(len(names)):
-            if refresh_only:
-                self.m_engine.morph_values[names[i]] = weights[i]
-            else:
-                self.m_engine.calculate_morph(
-                    names[i],
-                    weights[i],
-                    add_vertices_to_update)
+            values.append(val)
+        return tuple(values)
+
+    def get_combo_weights(self, modifier):
+        """
+        Return the dict of the morph weights calculated by smart combo
+        algorithm for the current values of the modifier.
+        """
+        return modifier.get_combo_weights(self.get_modifier_values(modifier))
+
+    def combine_morphings(self, modifier, refresh_only=False, add_vertices_to_update=True):
+        """
+        Mix shapekeys using smart combo algorithm.
+        """
+
+        values = self.get_modifier_values(modifier)
+        morph_weights = modifier.get_combo_weights(values)
+        if refresh_only:
+            for morph_name, weight in morph_weights.items():
+                self.m_engine.morph_values[morph_name] = weight
+        else:
+            self.m_engine.calculate_morphs(morph_weights, add_vertices_to_update)
+        modifier.applied_values = (values, self.m_engine.values_generation)
+
+    def combine_all_morphings(self, modifiers, add_vertices_to_update=True):
+        """
+        Mix the shapekeys of several modifiers with a single
+        evaluation of the morph engine. The modifiers with the
+        same values of the last combination are skipped.
+        """
+
+        morph_weights = {}
+        changed_modifiers = []
+        for modifier in modifiers:
+            values = self.get_modifier_values(modifier)
+            if modifier.applied_values != (values, self.m_engine.values_generation):
+                morph_weights.update(modifier.get_combo_weights(values))
+                changed_modifiers.append((modifier, values))
+        if morph_weights:
+            self.m_engine.calculate_morphs(morph_weights, add_vertices_to_update)
+        for modifier, values in changed_modifiers:
+            modifier.applied_values = (values, self.m_engine.values_generation)
 
     def exists_source_armature(self):
         if self.armat.get_source_armature() != None:
@@ -16,22 +16,45 @@
 import os
 import bpy
 import mathutils
-from . import algorithms, proxyengine
+import numpy
+from . import algorithms, proxyengine, datacache
 import time, json
+import hashlib
 import logging
 import operator
 
 lab_logger = logging.getLogger('manuelbastionilab_logger')
 
+#Policies for the exact re-evaluation of final_form from the base
+#form and the morph values:
+#"INCREMENTAL": never, only the incremental updates (default)
+#"ALWAYS": at each update
+#"EVERY_N": every exact_eval_interval updates
+#"ON_FINALIZE": only before the finalization
+EXACT_EVAL_POLICIES = ("INCREMENTAL", "ALWAYS", "EVERY_N", "ON_FINALIZE")
+DEFAULT_EXACT_EVAL_POLICY = "INCREMENTAL"
+DEFAULT_EXACT_EVAL_INTERVAL = 50
+
 class MorphingEngine:
 
     def __init__(self, obj, data_path):
         time1 = time.time()
         if obj:
-            self.base_form = []
-            self.final_form = []
-            self.cache_form = []
+            self.base_form = numpy.zeros((0,3), dtype=numpy.float32)
+            self.final_form = numpy.zeros((0,3), dtype=numpy.float32)
+            self.cache_form = None
             self.obj_name = obj.name
+            self.cache_path = datacache.get_cache_dir(data_path)
+            #See EXACT_EVAL_POLICIES. Use set_exact_eval_policy to change it
+            self.exact_eval_policy = DEFAULT_EXACT_EVAL_POLICY
+            self.exact_eval_interval = DEFAULT_EXACT_EVAL_INTERVAL
+            self.updates_since_exact_eval = 0
+            self.edit_offset = None
+            #Weights signature of the last exact evaluation
+            self.exact_eval_signature = None
+            #Incremented when the morph values are changed without
+            #the humanoid, so the stored combinations are not valid
+            self.values_generation = 0
 
             character_type = obj.name.split("_")[0]
             gender_type = obj.name.split("_")[1]
@@ -89,20 +112,29 @@ class MorphingEngine:
                 if os.path.isfile(self.measures_data_path):
                     self.measures_database_exist = True
 
-            self.verts_to_update = set()
+            self.dirty_verts = numpy.zeros(0, dtype=bool)
             self.morph_data = {}
             self.morph_data_cache = {}
             self.forma_data = None
-            self.bbox_data = {}
+            self.bbox_table = numpy.full((0,6), -1, dtype=numpy.int32)
+            self.bbox_base_extents = numpy.zeros((0,3))
             self.morph_values = {}
             self.morph_modified_verts = {}
+            self.lazy_morphs = {}
+            self.lazy_databases = {}
             self.boundary_verts = None
             self.measures_data = {}
+            self.compiled_measures = algorithms.compile_measures({})
+            self.measures_index = {}
+            self.measures_values = None
+            self.measures_dirty_verts = numpy.zeros(0, dtype=bool)
             self.measures_relat_data = []
             self.measures_score_weights = {}
             self.body_height_Z_parts = {}
 
             self.proportions = {}
+            self.bodies_database = None
+            self.proportions_tolerance = 0.025
 
             self.init_final_form()
             self.load_vertices_database(self.vertices_path)
@@ -111,7 +143,7 @@ class MorphingEngine:
             self.load_morphs_database(self.morph_data_path)
             self.load_morphs_database(self.extra_morph_data_path) #Call this after the loading of shared morph is important for overwrite data.
             self.load_morphs_database(self.shared_morph_extra_data_path)
-            self.load_morphs_database(self.expressions_path)
+            self.register_lazy_morphs(self.expressions_path) #Expressions are loaded only when used
             self.load_bboxes_database(self.bounding_box_path)
             self.load_measures_database(self.measures_data_path)
 
@@ -125,10 +157,47 @@ class MorphingEngine:
         lab_logger.info("Databases loaded in {0} secs".format(time.time()-time1))
 
     def init_final_form(self):
+        self.final_form = self.read_mesh_coords()
+        self.exact_eval_signature = None
+        self.dirty_verts = numpy.zeros(len(self.final_form), dtype=bool)
+        self.invalidate_measures()
+
+    def mark_dirty_verts(self, indices):
+        self.dirty_verts[indices] = True
+        self.measures_dirty_verts[indices] = True
+
+    def mark_measures_dirty(self, indices):
+        """
+        Verts modified without mesh update: the
+        measures must be recalculated anyway.
+        """
+        self.measures_dirty_verts[indices] = True
+
+    def invalidate_measures(self):
+        """
+        To call when final_form is replaced: the next
+        calculate_measures recomputes all the measures.
+        """
+        self.measures_values = None
+        self.measures_dirty_verts = numpy.zeros(len(self.final_form), dtype=bool)
+
+    def get_dirty_verts(self):
+        """
+        Return the sorted indices of the verts modified since the last clean
+        """
+        return numpy.flatnonzero(self.dirty_verts)
+
+    def clear_dirty_verts(self):
+        self.dirty_verts[:] = False
+
+    def read_mesh_coords(self):
+        """
+        Return the current coordinates of the mesh as (N,3) float32 array
+        """
         obj = self.get_object()
-        self.final_form = []
-        for vert in obj.data.vertices:
-                self.final_form.append(vert.co.copy())
+        coords = numpy.empty(len(obj.data.vertices)*3, dtype=numpy.float32)
+        obj.data.vertices.foreach_get("co", coords)
+        return coords.reshape(-1,3)
 
     def __repr__(self):
         return "MorphEngine {0} with {1} morphings".format(self.obj_name, len(self.morph_data))
@@ -142,10 +211,13 @@ class MorphingEngine:
         lab_logger.warning("Database file not found: {0}".format(algorithms.simple_path(path)))
 
     def reset(self, update=True):
-        for i in range(len(self.base_form)):
-            self.final_form[i] = self.base_form[i]
+        self.final_form = self.base_form.copy()
+        self.invalidate_measures()
+        self.edit_offset = None
+        self.exact_eval_signature = None
         for morph_name in self.morph_values.keys():
             self.morph_values[morph_name] = 0.0
+        self.values_generation += 1
         if update:
             self.update(update_all_verts=True)
 
@@ -156,39 +228,110 @@ class MorphingEngine:
             self.measures_relat_data = m_database["relations"]
             self.measures_score_weights = m_database["score_weights"]
             self.body_height_Z_parts = m_database["body_height_Z_parts"]
+            self.compiled_measures = algorithms.compile_measures(self.measures_data)
+            self.measures_index = dict((m_name, m_index) for m_index, m_name in enumerate(self.compiled_measures["names"]))
+            self.measures_values = None
+
+    def load_bboxes_database(self, bounding_box_path):
+        """
+        Call after the loading of the verts: the table is indexed by
+        vert and the sizes of the base boxes are calculated once.
+        """
+        n_verts = len(self.base_form)
+        b_data = datacache.load_bboxes(bounding_box_path, self.cache_path)
+        if b_data:
+            self.bbox_table = algorithms.compile_bboxes(b_data[0], b_data[1], n_verts)
+        else:
+            self.bbox_table = numpy.full((n_verts,6), -1, dtype=numpy.int32)
+        self.bbox_base_extents = algorithms.bounding_box_extents(
+            self.base_form,
+            numpy.clip(self.bbox_table, 0, max(0, n_verts-1)))
 
-    def load_bboxes_database(self, bounding_box_path):            
-        self.bbox_data = algorithms.load_json_data(bounding_box_path,"Bounding box data")
-            
 
     def load_vertices_database(self, vertices_path):
-        verts = algorithms.load_json_data(vertices_path,"Vertices data")
-        if verts:
-            for vert_co in verts:
-                self.base_form.append(mathutils.Vector(vert_co))
+        verts = datacache.load_vertices(vertices_path, self.cache_path)
+        if verts is not None:
+            self.base_form = numpy.array(verts, dtype=numpy.float32)
 
 
     def load_morphs_database(self, morph_data_path):
         time1 = time.time()
-        m_data = algorithms.load_json_data(morph_data_path,"Morph data")
+        m_data = datacache.load_morphs(morph_data_path, self.cache_path)
         if m_data:
-            for morph_name, deltas in m_data.items():
-                morph_deltas = []
-                modified_verts = set()
-                for d_data in deltas:
-                    t_delta = mathutils.Vector(d_data[1:])
-                    morph_deltas.append([d_data[0], t_delta])
-                    modified_verts.add(d_data[0])
+            #Each morph is stored as a sparse row: the indices of the
+            #modified verts and the (n,3) array of their deltas.
+            for morph_name, morph_indices, morph_deltas in m_data:
                 if morph_name in self.morph_data:
                     lab_logger.warning("Morph {0} duplicated while loading morphs from file".format(morph_name))
 
-                self.morph_data[morph_name] = morph_deltas
+                self.morph_data[morph_name] = (morph_indices, morph_deltas)
                 self.morph_values[morph_name] = 0.0
-                self.morph_modified_verts[morph_name] = modified_verts
+                self.morph_modified_verts[morph_name] = morph_indices
+                self.lazy_morphs.pop(morph_name, None)
             lab_logger.info("Morph database {0} loaded in {1} secs".format(algorithms.simple_path(morph_data_path),time.time()-time1))
             lab_logger.info("Now local morph data contains {0} elements".format(len(self.morph_data)))
 
 
+    def register_lazy_morphs(self, morph_data_path):
+        """
+        Register the names of the morphs in the database, without
+        loading the deltas. They will be loaded the first time one
+        of them is set to a value different from 0.
+        """
+        morph_names = datacache.load_morph_names(morph_data_path, self.cache_path)
+        if morph_names:
+            self.lazy_databases[morph_data_path] = morph_names
+            for morph_name in morph_names:
+                if morph_name not in self.morph_data:
+                    self.lazy_morphs[morph_name] = morph_data_path
+                    self.morph_values[morph_name] = 0.0
+            lab_logger.info("Registered {0} lazy morphs from {1}".format(len(morph_names), algorithms.simple_path(morph_data_path)))
+
+    def load_lazy_morphs(self, morph_names=None):
+        """
+        Load the databases of the lazy morphs in the list
+        (or of all the lazy morphs), if still not loaded.
+        """
+        if morph_names is None:
+            morph_names = list(self.lazy_morphs.keys())
+        databases_to_load = set()
+        for morph_name in morph_names:
+            if morph_name in self.lazy_morphs:
+                databases_to_load.add(self.lazy_morphs[morph_name])
+        for morph_data_path in databases_to_load:
+            self.load_morphs_database(morph_data_path)
+
+    def unload_lazy_morphs(self, morph_data_path):
+        """
+        Free the deltas of a lazy database. It's possible only if
+        all its morphs are set to 0.
+        """
+        morph_names = self.lazy_databases.get(morph_data_path, [])
+        for morph_name in morph_names:
+            if self.morph_values.get(morph_name, 0.0) != 0.0:
+                lab_logger.info("Morphs of {0} in use, not unloaded".format(algorithms.simple_path(morph_data_path)))
+                return False
+        for morph_name in morph_names:
+            self.morph_data.pop(morph_name, None)
+            self.morph_modified_verts.pop(morph_name, None)
+            self.morph_data_cache.pop(morph_name, None)
+            self.lazy_morphs[morph_name] = morph_data_path
+        lab_logger.info("Morphs of {0} unloaded".format(algorithms.simple_path(morph_data_path)))
+        return True
+
+    def load_expressions(self):
+        self.load_lazy_morphs(self.lazy_databases.get(self.expressions_path, []))
+
+    def unload_expressions(self):
+        return self.unload_lazy_morphs(self.expressions_path)
+
+    def get_morph_names(self):
+        """
+        Return the names of all the morphs, loaded or not.
+        """
+        return self.morph_values.keys()
+
+
     #def apply_finishing_morph(self):
         #"""
         #Modify the Blender object in order to finish the surface.
@@ -203,21 +346,37 @@ class MorphingEngine:
         #lab_logger.info("Finishing applied in {0} secs".format(time.time()-time1))
 
     def calculate_measures(self,measure_name = None,vert_coords=None):
-
-        if not vert_coords:
-            vert_coords = self.final_form
-        measures = {}
+        """
+        Return the value of measure_name or the dict of all the measures.
+        Measuring final_form, only the measures with verts modified
+        since the previous call are recalculated.
+        """
         time1 = time.time()
         if measure_name:
-            if measure_name in self.measures_data:
-                indices =  self.measures_data[measure_name]
-                axis = measure_name[-1]
-                return algorithms.length_of_strip(vert_coords, indices, axis)
+            if measure_name in self.measures_index:
+                if vert_coords is None:
+                    vert_coords = self.final_form
+                return algorithms.calculate_compiled_measure(vert_coords, self.compiled_measures, self.measures_index[measure_name])
+            return None
+
+        if vert_coords is not None:
+            measures_values = algorithms.calculate_compiled_measures(vert_coords, self.compiled_measures)
         else:
-            for measure_name in self.measures_data.keys():
-                measures[measure_name] = self.calculate_measures(measure_name, vert_coords)
-            lab_logger.debug("Measures calculated in {0} secs".format(time.time()-time1))
-            return measures
+            if self.measures_values is None:
+                self.measures_values = algorithms.calculate_compiled_measures(self.final_form, self.compiled_measures)
+            elif self.measures_dirty_verts.any():
+                seg_dirty = self.measures_dirty_verts[self.compiled_measures["seg_start"]]
+                seg_dirty |= self.measures_dirty_verts[self.compiled_measures["seg_end"]]
+                measures_mask = numpy.zeros(len(self.compiled_measures["names"]), dtype=bool)
+                measures_mask[self.compiled_measures["seg_measure"][seg_dirty]] = True
+                if measures_mask.any():
+                    new_values = algorithms.calculate_compiled_measures(self.final_form, self.compiled_measures, measures_mask)
+                    self.measures_values[measures_mask] = new_values[measures_mask]
+            self.measures_dirty_verts[:] = False
+            measures_values = self.measures_values
+        measures = dict(zip(self.compiled_measures["names"], measures_values.tolist()))
+        lab_logger.debug("Measures calculated in {0} secs".format(time.time()-time1))
+        return measures
 
 
     def calculate_proportions(self, measures):
@@ -242,21 +401,48 @@ class MorphingEngine:
             lab_logger.info("File {0} does not contain proportions".format(algorithms.simple_path(filepath)))
 
 
-    def compare_data_proportions(self):
+    def load_bodies_database(self):
+        """
+        The bodies are indexed in the body library, updated only
+        with the new or modified files: the json files are not
+        read at each search.
+        """
+        if self.bodies_database is None:
+            self.bodies_database = datacache.load_body_library(self.bodies_data_path, self.cache_path)
+        return self.bodies_database
+
+    def compare_data_proportions(self, n_results=None):
+        """
+        Return the list of (score, filepath) of the bodies, sorted
+        by score (the best first). The scores of calculate_matching_score
+        are calculated for all the bodies with a few matrix operations.
+        """
         scores = []
         time1 = time.time()
         if os.path.isdir(self.bodies_data_path):
-            for database_file in os.listdir(self.bodies_data_path):
-                body_data, extension = os.path.splitext(database_file)
-                if "json" in extension:
-                    scores.append(self.compare_file_proportions(os.path.join(self.bodies_data_path,database_file)))
-            scores.sort(key=operator.itemgetter(0), reverse=True)
+            body_library = self.load_bodies_database()
+            time2 = time.time()
+            scores = body_library.query(
+                self.proportions, self.measures_score_weights,
+                self.proportions_tolerance, n_results)
+            lab_logger.info("Body library queried in {0} secs ({1} bodies)".format(
+                time.time()-time2, body_library.get_bodies_number()))
             lab_logger.info("Measures compared with database in {0} seconds".format(time.time()-time1))
         else:
             lab_logger.warning("Bodies database not found")
-        
+
         return scores
 
+    def get_body_character(self, filepath):
+        """
+        Return the character data of the body from the body
+        library, or the path itself if the body is not in it.
+        """
+        body_data = self.load_bodies_database().get_body(filepath)
+        if body_data is None:
+            return filepath
+        return body_data
+
     def calculate_matching_score(self, proportions):
         data_score = 0
         soglia = 0.025
@@ -275,34 +461,34 @@ class MorphingEngine:
 
 
     def correct_morphs(self, names):
-        morph_values_cache = {}
-        for morph_name in self.morph_data.keys():
-            for name in names:
-                if name in morph_name:
-                    morph_values_cache[morph_name] = self.morph_values[morph_name]#Store the values before the correction
-                    self.calculate_morph(morph_name, 0.0) #Reset the morphs to correct
-
-        for morph_name, morph_deltas in self.morph_data.items():
-            for name in names:
-                if name in morph_name: #If the morph is in the list of morph to correct
-                    if morph_name in self.morph_data_cache:
-                        morph_deltas_to_recalculate = self.morph_data_cache[morph_name]
-                    else:
-                        self.morph_data_cache[morph_name] = morph_deltas
-                        morph_deltas_to_recalculate = self.morph_data_cache[morph_name]
-                    
-                    self.morph_data[morph_name] = algorithms.correct_morph(
-                        self.base_form,
-                        self.final_form,
-                        morph_deltas_to_recalculate,
-                        self.bbox_data)
-        for morph_name in self.morph_data.keys():
-            for name in names:
-                if name in morph_name:
-                    self.calculate_morph(
-                        morph_name,
-                        morph_values_cache[morph_name])
+        self.load_lazy_morphs([morph_name for morph_name in self.lazy_morphs if algorithms.is_excluded(morph_name, names)])
+        morphs_to_correct = [morph_name for morph_name in self.morph_data.keys() if algorithms.is_excluded(morph_name, names)]
+        if not morphs_to_correct:
+            return
 
+        #Store the values before the correction and reset the morphs to correct
+        morph_values_cache = {}
+        for morph_name in morphs_to_correct:
+            morph_values_cache[morph_name] = self.morph_values[morph_name]
+        self.calculate_morphs(dict.fromkeys(morphs_to_correct, 0.0))
+
+        #The correction always starts from the original deltas
+        morphs_deltas = []
+        for morph_name in morphs_to_correct:
+            if morph_name not in self.morph_data_cache:
+                self.morph_data_cache[morph_name] = self.morph_data[morph_name]
+            morphs_deltas.append(self.morph_data_cache[morph_name])
+
+        corrected_deltas = algorithms.correct_morphs_deltas(
+            self.final_form,
+            morphs_deltas,
+            self.bbox_table,
+            self.bbox_base_extents)
+        for morph_name, morph_deltas in zip(morphs_to_correct, corrected_deltas):
+            self.morph_data[morph_name] = morph_deltas
+            self.morph_modified_verts[morph_name] = morph_deltas[0]
+
+        self.calculate_morphs(morph_values_cache)
         self.update()
 
     def convert_to_blshapekey(self, shape_key_name):
@@ -313,12 +499,14 @@ class MorphingEngine:
         sk_new.value = 0.0
         obj.use_shape_key_edit_mode = True
 
-        for i in range(len(self.final_form)):
-            sk_new.data[i].co = obj.data.vertices[i].co
+        sk_new.data.foreach_set("co", self.read_mesh_coords().ravel())
 
     def convert_all_to_blshapekeys(self):
 
         #TODO: re-enable the finishing (finish = True) after some improvements
+        self.load_expressions()
+        self.apply_exact_eval_policy(finalize=True)
+        self.update()
 
         #Reset all values (for expressions only) and create the basis key
         for morph_name in self.morph_data.keys():
@@ -328,10 +516,7 @@ class MorphingEngine:
         self.convert_to_blshapekey("basis")
 
         #Store the character in neutral expression
-        obj = self.get_object()
-        stored_vertices = []
-        for vert in obj.data.vertices:
-            stored_vertices.append(mathutils.Vector(vert.co))
+        stored_vertices = self.read_mesh_coords()
 
         lab_logger.info("Storing neutral character...OK")
         counter = 0
@@ -343,65 +528,186 @@ class MorphingEngine:
                 self.update()
                 self.convert_to_blshapekey(morph_name)
 
-                #Restore the neutral expression
-                for i in range(len(self.final_form)):
-                    self.final_form[i] = stored_vertices[i]
+                #Restore the neutral expression. The morph value is reset
+                #too, otherwise an exact evaluation would restore the expression
+                self.calculate_morph(morph_name, 0.0)
+                self.final_form = stored_vertices.copy()
+                self.exact_eval_signature = None
+                self.invalidate_measures()
                 self.update(update_all_verts=True)
+        self.values_generation += 1
         lab_logger.info("Successfully converted {0} morphs in shapekeys".format(counter))
 
 
 
-    def update(self, update_all_verts=False):
-        obj = self.get_object()
-        vertices = obj.data.vertices
-        if update_all_verts == True:
-            for i in range(len(self.final_form)):
-                vertices[i].co = self.final_form[i]
+    def get_weights_signature(self):
+        """
+        Hash of the non-zero morph values and of the edits, the
+        only inputs of the exact form.
+        """
+        sha = hashlib.sha1()
+        for morph_name in sorted(self.morph_values.keys()):
+            morph_value = self.morph_values[morph_name]
+            if morph_value != 0.0:
+                sha.update("{0}:{1!r};".format(morph_name, float(morph_value)).encode("utf-8"))
+        if self.edit_offset is not None:
+            sha.update(self.edit_offset.tobytes())
+        return sha.hexdigest()
+
+    def calculate_exact_form(self):
+        """
+        Return base_form + sum(value*deltas) for all the morphs,
+        computed from scratch in float64.
+        """
+        exact_form = self.base_form.astype(numpy.float64)
+        morphs = []
+        weights = []
+        for morph_name, morph_value in self.morph_values.items():
+            if morph_value != 0.0 and morph_name in self.morph_data:
+                morphs.append(self.morph_data[morph_name])
+                weights.append(morph_value)
+        algorithms.add_weighted_morphs(exact_form, morphs, weights)
+        if self.edit_offset is not None:
+            exact_form += self.edit_offset
+        return exact_form.astype(numpy.float32)
+
+    def evaluate_exact(self, add_vertices_to_update=True):
+        """
+        Replace final_form with the exact form, removing the
+        drift accumulated by the incremental updates. It's skipped
+        if the weights are the same of the last exact evaluation.
+        """
+        if len(self.final_form) != len(self.base_form):
+            return
+        weights_signature = self.get_weights_signature()
+        if weights_signature == self.exact_eval_signature:
+            self.updates_since_exact_eval = 0
+            return
+        exact_form = self.calculate_exact_form()
+        changed_verts = numpy.flatnonzero(numpy.any(exact_form != self.final_form, axis=1))
+        if add_vertices_to_update:
+            self.mark_dirty_verts(changed_verts)
         else:
-            for i in self.verts_to_update:
-                vertices[i].co = self.final_form[i]
+            self.mark_measures_dirty(changed_verts)
+        self.final_form = exact_form
+        self.exact_eval_signature = weights_signature
+        self.updates_since_exact_eval = 0
+
+    def set_exact_eval_policy(self, policy, interval=None):
+        if policy not in EXACT_EVAL_POLICIES:
+            lab_logger.warning("Unknown exact evaluation policy {0}. Valid policies: {1}".format(policy, EXACT_EVAL_POLICIES))
+            return False
+        if interval is not None:
+            if int(interval) < 1:
+                lab_logger.warning("Invalid exact evaluation interval {0}".format(interval))
+                return False
+            self.exact_eval_interval = int(interval)
+        self.exact_eval_policy = policy
+        self.updates_since_exact_eval = 0
+        return True
+
+    def apply_exact_eval_policy(self, finalize=False):
+        if self.exact_eval_policy == "ALWAYS":
+            self.evaluate_exact()
+        elif self.exact_eval_policy == "EVERY_N":
+            self.updates_since_exact_eval += 1
+            if finalize or self.updates_since_exact_eval >= self.exact_eval_interval:
+                self.evaluate_exact()
+        elif self.exact_eval_policy == "ON_FINALIZE":
+            if finalize:
+                self.evaluate_exact()
+
+    def store_edit_offset(self):
+        """
+        Store the difference between final_form and the exact form
+        as an edit, so it survives the exact re-evaluations.
+        """
+        self.edit_offset = None
+        offset = self.final_form.astype(numpy.float64)-self.calculate_exact_form()
+        if numpy.any(offset != 0.0):
+            self.edit_offset = offset
+
+    def update(self, update_all_verts=False):
+        """
+        Upload final_form to the mesh, if some vert is modified. The
+        whole array is copied with a single foreach_set: even for a
+        few verts it's cheaper than setting them one by one in python.
+        """
+        self.apply_exact_eval_policy()
+        if update_all_verts or len(self.get_dirty_verts()) > 0:
+            obj = self.get_object()
+            coords = numpy.ascontiguousarray(self.final_form, dtype=numpy.float32)
+            obj.data.vertices.foreach_set("co", coords.ravel())
+            obj.data.update()
 
     def copy_in_cache(self):
-        obj = self.get_object()
         self.clean_the_cache()
-        vertices = obj.data.vertices
-        for i in range(len(self.final_form)):
-            self.cache_form.append(vertices[i].co.copy())
+        self.cache_form = self.read_mesh_coords()
         lab_logger.info("Mesh cached")
 
     def copy_from_cache(self):
-        if len(self.final_form) == len(self.cache_form):
-            for i in range(len(self.final_form)):
-                self.final_form[i] = self.cache_form[i]
+        if self.cache_form is not None and len(self.final_form) == len(self.cache_form):
+            self.final_form = self.cache_form.copy()
+            self.exact_eval_signature = None
+            self.invalidate_measures()
+            if self.exact_eval_policy != "INCREMENTAL":
+                self.store_edit_offset()
             lab_logger.info("Mesh copied from cache")
         else:
             lab_logger.warning("Cached mesh not found")
 
     def clean_the_cache(self):
-        self.cache_form = []
+        self.cache_form = None
 
 
     def calculate_morph(self, morph_name, val, add_vertices_to_update=True):
 
+        if morph_name in self.lazy_morphs and val != self.morph_values[morph_name]:
+            self.load_lazy_morphs([morph_name])
         if morph_name in self.morph_data:
             real_val = val - self.morph_values[morph_name]
             if real_val != 0.0:
-                morph = self.morph_data[morph_name]
-                for d_data in morph:
-                    i = d_data[0]
-                    delta = d_data[1]
-                    self.final_form[i] = self.final_form[i] + delta*real_val
+                morph_indices, morph_deltas = self.morph_data[morph_name]
+                self.final_form[morph_indices] += morph_deltas*real_val
                 if add_vertices_to_update:
-                    self.verts_to_update = self.verts_to_update.union(self.morph_modified_verts[morph_name])
+                    self.mark_dirty_verts(self.morph_modified_verts[morph_name])
+                else:
+                    self.mark_measures_dirty(self.morph_modified_verts[morph_name])
                 self.morph_values[morph_name] = val
         else:
             lab_logger.debug("Morph data {0} not found".format(morph_name))
 
-
-
-
-
-
-
-
-
+    def calculate_morphs(self, morph_weights, add_vertices_to_update=True):
+        """
+        Apply a whole set of morph values in a single pass. The deltas
+        of all the changed morphs are stacked and scatter-added to the
+        final form, instead of walking each morph separately.
+        """
+        changed_names = []
+        changed_vals = []
+        lazy_names = []
+        for morph_name, val in morph_weights.items():
+            if morph_name in self.lazy_morphs and val != self.morph_values[morph_name]:
+                lazy_names.append(morph_name)
+        self.load_lazy_morphs(lazy_names)
+
+        for morph_name, val in morph_weights.items():
+            if morph_name in self.morph_data:
+                real_val = val - self.morph_values[morph_name]
+                if real_val != 0.0:
+                    changed_names.append(morph_name)
+                    changed_vals.append(real_val)
+            else:
+                lab_logger.debug("Morph data {0} not found".format(morph_name))
+
+        if changed_names:
+            all_indices = algorithms.add_weighted_morphs(
+                self.final_form,
+                [self.morph_data[morph_name] for morph_name in changed_names],
+                changed_vals)
+            if add_vertices_to_update:
+                self.mark_dirty_verts(all_indices)
+            else:
+                self.mark_measures_dirty(all_indices)
+            for morph_name in changed_names:
+                self.morph_values[morph_name] = morph_weights[morph_name]
@@ -41,7 +41,7 @@ def kdtree_with_basedata(body_obj, base_body_vertices):
     for face in body_obj.data.polygons:
         verts_coords = []
         for v_idx in face.vertices:
-            verts_coords.append(base_body_vertices[v_idx])
+            verts_coords.append(mathutils.Vector(base_body_vertices[v_idx]))
         bcenter = algorithms.average_center(verts_coords)
         research_tree.insert(bcenter, face.index)
     research_tree.balance()
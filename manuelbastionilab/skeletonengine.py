@@ -14,12 +14,101 @@
 #along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import bpy, os, json
+import hashlib
 import mathutils
+import numpy
 from . import algorithms
+from . import datacache
 
 import logging
 lab_logger = logging.getLogger('manuelbastionilab_logger')
 
+#Change it when the mapping algorithm changes, to discard the stored maps
+RETARGET_MAP_VERSION = 1
+
+SIDE_BONE_IDS = ["forearm","elbow","lowerarm","hand","wrist","finger","thumb","index","ring","pink",\
+                 "thigh","upperleg","upper_leg","leg","knee","shin","calf","lowerleg","lower_leg",\
+                 "toe","ball","foot"]
+
+SIDE_NAME_IDS = {
+    "RIGHT": ("r", "right", ["r.","r_"], ["_r",".r"]),
+    "LEFT": ("l", "left", ["l.","l_"], ["_l",".l"]),
+    }
+
+
+class ArmatureIndex:
+    """
+    Hierarchy of the source armature, read once when the
+    mapping starts: parent and children of each bone,
+    lowercase names and the side flags used to score the chains.
+    The chain helpers of the mapping read only this index.
+    """
+
+    def __init__(self, armat):
+        self.armat_name = armat.name
+        self.parent = {}
+        self.children = {}
+        self.lower_names = {}
+        for bn in armat.data.bones:
+            self.parent[bn.name] = bn.parent.name if bn.parent else None
+            self.children[bn.name] = [ch_bone.name for ch_bone in bn.children]
+            self.lower_names[bn.name] = bn.name.lower()
+        self.side_flags = {"RIGHT": {}, "LEFT": {}}
+
+    def get_lower_name(self, b_name):
+        if b_name in self.lower_names:
+            return self.lower_names[b_name]
+        return b_name.lower()
+
+    def get_ending_bones(self):
+        return set(b_name for b_name, childr in self.children.items() if len(childr) == 0)
+
+    def get_chain(self, b_name):
+        chain = [b_name]
+        parent_name = self.parent[b_name]
+        while parent_name != None:
+            chain.append(parent_name)
+            parent_name = self.parent[parent_name]
+        return chain
+
+    def get_side_flags(self, b_name, side):
+        """
+        Return (named, combo): named is True when the name has
+        a side prefix, suffix or word, combo when it matches
+        a side letter joined to a limb ID.
+        """
+        side_flags = self.side_flags[side]
+        if b_name not in side_flags:
+            ID_side1, ID_side2, ID_side3, ID_side4 = SIDE_NAME_IDS[side]
+            b_lower = self.get_lower_name(b_name)
+            named = len(b_lower) > 3 and (b_lower[:2] in ID_side3 or b_lower[-2:] in ID_side4 or ID_side2 in b_lower)
+            combo = False
+            for b_ID in SIDE_BONE_IDS:
+                if b_lower in (ID_side1 + b_ID)[:len(b_name)] or b_lower in (b_ID + ID_side1)[len(b_name):]:
+                    combo = True
+                    break
+            side_flags[b_name] = (named, combo)
+        return side_flags[b_name]
+
+    def side_score(self, bone_names, side):
+        if len(bone_names) == 0:
+            return 0
+        flags = [self.get_side_flags(b_name, side) for b_name in bone_names]
+        if any(combo for named, combo in flags):
+            score_level = sum(1.0 for b_name in bone_names if len(self.get_lower_name(b_name)) > 3)
+        else:
+            score_level = sum(1.0 for named, combo in flags if named)
+        return score_level/len(bone_names)
+
+    def has_ID(self, bone_names, IDs):
+        for b_ID in IDs:
+            b_ID = b_ID.lower()
+            for b_name in bone_names:
+                if b_ID in self.get_lower_name(b_name):
+                    return True
+        return False
+
+
 class SkeletonEngine:
 
     def __init__(self, obj_body, data_path):
@@ -37,6 +126,8 @@ class SkeletonEngine:
             gender_type = obj_body.name.split("_")[1]
 
             self.knowledge_path = os.path.join(data_path,"retarget_knowledge.json")
+            self.cache_path = datacache.get_cache_dir(data_path)
+            self.retarget_maps_path = os.path.join(self.cache_path, "retarget_maps")
 
             self.armature_modifier_name = "mbastlab_armature"
             self.joints_filename = character_type+"_"+gender_type+"_joints.json"
@@ -65,7 +156,16 @@ class SkeletonEngine:
 
 
             self.jointsDatabase = self.load_joints_database(self.joints_data_path)
+            self.compiled_joints = algorithms.compile_joints(self.jointsDatabase)
+            #Indices of the joints shared by connected bones, by armature
+            self.shared_joints = {}
+            #Bones are moved only if their joints move more than this
+            self.joints_tolerance = 0.00001
             self.knowledge_database = algorithms.load_json_data(self.knowledge_path,"Skeleton knowledge data")
+            self.knowledge_signature = ""
+            if os.path.isfile(self.knowledge_path):
+                self.knowledge_signature = datacache.file_hash(self.knowledge_path)
+            self.skeleton_data = self.load_skeleton_data(self.skeleton_data_path)
 
             if self.check_skeleton(obj_body):
                 obj_armat = obj_body.parent
@@ -83,6 +183,7 @@ class SkeletonEngine:
             self.load_groups(self.vgroup_data_path)
             self.add_armature_modifier()
             self.skeleton_mapped = {}
+            self.armature_index = None
 
 
 
@@ -135,54 +236,86 @@ class SkeletonEngine:
         lab_logger.error("Database file not found: {0}".format(algorithms.simple_path(path)))
 
 
-    def align_bones_z_axis(self):
-        bones_data = algorithms.load_json_data(self.skeleton_data_path,"Z alignment data")
-        armat = self.get_armature()
+    def load_skeleton_data(self, data_path):
+        """
+        The rest data of the bones (head, tail, z axis, parent and
+        connection) are parsed once and shared by all the methods.
+        """
+        bones_data = algorithms.load_json_data(data_path,"Skeleton data")
+        if not bones_data:
+            return []
+        return bones_data
+
+    def get_bones_z_axis(self):
+        """
+        Return the dict of the z axis of the bones, from the source
+        armature if there is one, else from the skeleton data.
+        """
         source_armat = self.get_source_armature()
         armature_z_axis = {}
 
-        if armat:
-
-            if source_armat:
-                lab_logger.info("Aligning Z axis of {0} with Z axis of {1}".format(armat.name,source_armat.name))
-                algorithms.select_and_change_mode(source_armat,'EDIT')
-                for b_name in self.default_bone_names:
-                    source_bone_name = self.mapped_name(b_name)
-                    if source_bone_name != None:
-                        armature_z_axis[b_name] = source_armat.data.edit_bones[source_bone_name].z_axis.copy()
-                    else:
-                        lab_logger.debug("Bone {0} non mapped".format(b_name))
-                algorithms.select_and_change_mode(source_armat,'POSE')
-            else:
-                if bones_data:
-                    for nbone in bones_data:
-                        armature_z_axis[nbone['name']] = mathutils.Vector(nbone['z_axis'])
-
+        if source_armat:
+            lab_logger.info("Aligning Z axis of {0} with Z axis of {1}".format(self.armature_name,source_armat.name))
+            algorithms.select_and_change_mode(source_armat,'EDIT')
+            for b_name in self.default_bone_names:
+                source_bone_name = self.mapped_name(b_name)
+                if source_bone_name != None:
+                    armature_z_axis[b_name] = source_armat.data.edit_bones[source_bone_name].z_axis.copy()
+                else:
+                    lab_logger.debug("Bone {0} non mapped".format(b_name))
+            algorithms.select_and_change_mode(source_armat,'POSE')
+        else:
+            for nbone in self.skeleton_data:
+                armature_z_axis[nbone['name']] = mathutils.Vector(nbone['z_axis'])
+        return armature_z_axis
+
+    def align_edit_bones_z_axis(self, armat, armature_z_axis):
+        """
+        The armature must be in edit mode
+        """
+        for armat_bone in armat.data.edit_bones:
+            if armat_bone.name in armature_z_axis:
+                z_axis = armature_z_axis[armat_bone.name]
+                armat_bone.align_roll(z_axis)
+
+    def set_edit_bones_rest_position(self, armat):
+        """
+        The armature must be in edit mode
+        """
+        for nbone in self.skeleton_data:
+            if nbone['name'] in armat.data.edit_bones:
+                armat_bone = armat.data.edit_bones[nbone['name']]
+                armat_bone.head = mathutils.Vector(nbone['head'])
+                armat_bone.tail = mathutils.Vector(nbone['tail'])
 
+    def align_bones_z_axis(self):
+        armat = self.get_armature()
+        if armat:
+            armature_z_axis = self.get_bones_z_axis()
             algorithms.select_and_change_mode(armat,'EDIT')
-            for armat_bone in armat.data.edit_bones:
-                if armat_bone.name in armature_z_axis:
-                    z_axis = armature_z_axis[armat_bone.name]
-                    armat_bone.align_roll(z_axis)
+            self.align_edit_bones_z_axis(armat, armature_z_axis)
             algorithms.select_and_change_mode(armat,'POSE')
 
 
-    def load_bones_position(self):
-        bones_data = algorithms.load_json_data(self.skeleton_data_path)
+    def load_bones_position(self, align_z_axis=False):
+        """
+        Restore the rest position of the bones. With align_z_axis
+        the rolls are aligned in the same edit mode pass.
+        """
         armat = self.get_armature()
-        if bones_data and armat:
+        if self.skeleton_data and armat:
+            if align_z_axis:
+                armature_z_axis = self.get_bones_z_axis()
             algorithms.select_and_change_mode(armat,'EDIT')
-            for nbone in bones_data:
-                if nbone['name'] in armat.data.edit_bones:
-                    armat_bone = armat.data.edit_bones[nbone['name']]
-                    armat_bone.head = mathutils.Vector(nbone['head'])
-                    armat_bone.tail = mathutils.Vector(nbone['tail'])
+            self.set_edit_bones_rest_position(armat)
+            if align_z_axis:
+                self.align_edit_bones_z_axis(armat, armature_z_axis)
             algorithms.select_and_change_mode(armat,'POSE')
 
 
     def load_bones(self):
 
-        bones_data = algorithms.load_json_data(self.skeleton_data_path,"Skeleton data")
+        bones_data = self.skeleton_data
         if bones_data:
             scene = bpy.context.scene
             new_armat_data = bpy.data.armatures.new("human_skeleton")
@@ -217,29 +350,41 @@ class SkeletonEngine:
         return None
 
     def load_groups(self,filepath,use_weights = True,clear_all=True):
-
+        """
+        The groups are read from the compiled cache and the
+        verts with the same weight are added with a single call.
+        """
         obj = self.get_body()
-        g_data = algorithms.load_json_data(filepath,"Vertgroups data")
+        g_pack = datacache.load_vgroups(filepath, self.cache_path)
+        if g_pack is None:
+            lab_logger.warning("Vertgroups not loaded from {0}".format(algorithms.simple_path(filepath)))
+            return
+        g_arrays, g_meta = g_pack
 
         if clear_all:
             obj.vertex_groups.clear()
 
-        group_names = sorted(g_data.keys())
-        for group_name in group_names:
+        indptr = g_arrays["indptr"]
+        n_calls = 0
+        for n, group_name in enumerate(g_meta["names"]):
             new_group = obj.vertex_groups.new(name=group_name)
-            for vert_data in g_data[group_name]:
-                if use_weights:
-                    if type(vert_data) == list:
-                        new_group.add([vert_data[0]], vert_data[1], 'REPLACE')
-                    else:
-                        lab_logger.info("Error: wrong format for vert weight")
-                else:
-                    if type(vert_data) == int:
-                        new_group.add([vert_data], 1.0, 'REPLACE')
-                    else:
-                        lab_logger.info("Error: wrong format for vert group")
+            group_indices = g_arrays["indices"][int(indptr[n]):int(indptr[n+1])]
+            group_weights = g_arrays["weights"][int(indptr[n]):int(indptr[n+1])]
+            has_weight = ~numpy.isnan(group_weights)
+            if use_weights:
+                if not has_weight.all():
+                    lab_logger.info("Error: wrong format for vert weight")
+                for weight, w_indices in algorithms.weight_buckets(group_indices[has_weight], group_weights[has_weight]):
+                    new_group.add(w_indices, weight, 'REPLACE')
+                    n_calls += 1
+            else:
+                if has_weight.any():
+                    lab_logger.info("Error: wrong format for vert group")
+                if not has_weight.all():
+                    new_group.add(group_indices[~has_weight].tolist(), 1.0, 'REPLACE')
+                    n_calls += 1
 
-        lab_logger.info("Group loaded from {0}".format(algorithms.simple_path(filepath)))
+        lab_logger.info("Group loaded from {0} with {1} calls".format(algorithms.simple_path(filepath), n_calls))
 
 
     def get_body(self):
@@ -280,14 +425,104 @@ class SkeletonEngine:
         return joint_data
 
 
+    def are_joints_affected(self, verts_indices):
+        """
+        Return True if some joint depends on the verts.
+        """
+        if not self.has_data:
+            return False
+        return bool(algorithms.joints_of_verts(self.compiled_joints, verts_indices).any())
+
+    def get_joints_of_verts(self, verts_indices):
+        joints_mask = algorithms.joints_of_verts(self.compiled_joints, verts_indices)
+        return [joint_name for joint_name, is_affected in zip(self.compiled_joints["names"], joints_mask.tolist()) if is_affected]
+
+    def calculate_joints_positions(self, body):
+        n_verts = len(body.data.vertices)
+        verts_coords = numpy.zeros(n_verts*3, dtype=numpy.float32)
+        body.data.vertices.foreach_get("co", verts_coords)
+        return algorithms.calculate_joints(verts_coords.reshape(-1,3), self.compiled_joints)
+
+    def get_moved_joints(self, armat, joints_positions, ignored_bones=()):
+        """
+        Return the dict of the new positions of the joints that are
+        farther than joints_tolerance from the bones of the armature.
+        The rest positions of the bones are read without edit mode.
+        The joints of ignored_bones are placed by other steps of the
+        fit, so they are not compared, but they are returned with
+        the others if some joint is moved.
+        """
+        bones = armat.data.bones
+        n_bones = len(bones)
+        bones_coords = {
+            "head": numpy.zeros(n_bones*3, dtype=numpy.float32),
+            "tail": numpy.zeros(n_bones*3, dtype=numpy.float32)}
+        bones.foreach_get("head_local", bones_coords["head"])
+        bones.foreach_get("tail_local", bones_coords["tail"])
+        bones_index = dict((b_name, b_index) for b_index, b_name in enumerate(bones.keys()))
+
+        current_positions = numpy.array(joints_positions)
+        for j_index, (bone_name, bone_end) in enumerate(zip(self.compiled_joints["bone_names"], self.compiled_joints["bone_ends"])):
+            if bone_name in bones_index and bone_end in bones_coords:
+                b_index = bones_index[bone_name]
+                current_positions[j_index] = bones_coords[bone_end][b_index*3:b_index*3+3]
+        moved_mask = numpy.abs(joints_positions-current_positions).max(axis=1) > self.joints_tolerance
+        ignored_mask = numpy.array([bone_name in ignored_bones for bone_name in self.compiled_joints["bone_names"]], dtype=bool)
+        moved_mask[ignored_mask] = False
+        if not moved_mask.any():
+            return {}
+        moved_mask[ignored_mask] = True
+        for shared_indices in self.get_shared_joints(armat):
+            if moved_mask[shared_indices].any():
+                moved_mask[shared_indices] = True
+        moved_joints = {}
+        for j_index in numpy.nonzero(moved_mask)[0].tolist():
+            moved_joints[self.compiled_joints["names"][j_index]] = mathutils.Vector(joints_positions[j_index])
+        return moved_joints
+
+    def get_shared_joints(self, armat):
+        """
+        Return the lists of indices of the joints that are the same
+        point of the armature: the tail of a bone and the heads of its
+        connected children. Moving one of them moves the others, so
+        they are fitted together, in the same order of a full fit.
+        The lists are calculated once for armature.
+        """
+        if armat.name not in self.shared_joints:
+            joints_index = dict((j_name, j_index) for j_index, j_name in enumerate(self.compiled_joints["names"]))
+            shared_joints = {}
+            for a_bone in armat.data.bones:
+                if a_bone.use_connect and a_bone.parent:
+                    tail_name = "".join((a_bone.parent.name, "_tail"))
+                    if tail_name not in shared_joints:
+                        shared_joints[tail_name] = [tail_name]
+                    shared_joints[tail_name].append("".join((a_bone.name, "_head")))
+            self.shared_joints[armat.name] = [
+                [joints_index[j_name] for j_name in joint_names if j_name in joints_index]
+                for joint_names in shared_joints.values()]
+        return self.shared_joints[armat.name]
+
     def fit_joints(self):
         armat = self.get_armature()
         body = self.get_body()
 
         if armat and body:
 
+            #All the joints are calculated with one product on the verts,
+            #and edit mode is used only if some bone must be moved
+            joints_positions = self.calculate_joints_positions(body)
+            source_armat = self.get_source_armature()
+            ignored_bones = ()
+            if source_armat:
+                #use_animation_pelvis moves the pelvis after the fit
+                ignored_bones = ("pelvis",)
+            moved_joints = self.get_moved_joints(armat, joints_positions, ignored_bones)
+            if not moved_joints:
+                lab_logger.debug("Armature {0} already fitted".format(armat.name))
+                return
+
             algorithms.force_visible_object(armat)
-            lab_logger.debug("Fitting armature {0}".format(armat.name))
+            lab_logger.debug("Fitting {0} joints of armature {1}".format(len(moved_joints), armat.name))
             if armat.data.use_mirror_x == True:
                 armat.data.use_mirror_x = False
 
@@ -296,32 +531,30 @@ class SkeletonEngine:
             #...armature.data.edit_bones is empty
 
             current_active_obj = bpy.context.scene.objects.active
+            if not source_armat:
+                armature_z_axis = self.get_bones_z_axis()
             algorithms.select_and_change_mode(armat,"EDIT")
 
             for a_bone in armat.data.edit_bones:
                 tail_name = "".join((a_bone.name, "_tail"))
                 head_name = "".join((a_bone.name, "_head"))
 
-                if tail_name in self.jointsDatabase:
-                    joint_verts_coords = []
-                    for v_idx in self.jointsDatabase[tail_name]:
-                        joint_verts_coords.append(body.data.vertices[v_idx].co)
-                    tail_position = algorithms.average_center(joint_verts_coords)
-                    a_bone.tail = tail_position
-
-                if head_name in self.jointsDatabase:
-                    joint_verts_coords = []
-                    for v_idx in self.jointsDatabase[head_name]:
-                        joint_verts_coords.append(body.data.vertices[v_idx].co)
-                    head_position = algorithms.average_center(joint_verts_coords)
-                    a_bone.head = head_position
+                if tail_name in moved_joints:
+                    a_bone.tail = moved_joints[tail_name]
 
-            algorithms.select_and_change_mode(armat,"OBJECT")
+                if head_name in moved_joints:
+                    a_bone.head = moved_joints[head_name]
 
-            source_armat = self.get_source_armature()
             if source_armat:
+                #The pelvis and the z axis depend on the source
+                #armature, that needs its own edit mode
+                algorithms.select_and_change_mode(armat,"OBJECT")
                 self.use_animation_pelvis(armat,source_armat)
-            self.align_bones_z_axis()
+                self.align_bones_z_axis()
+            else:
+                #Positions and rolls in the same edit mode pass
+                self.align_edit_bones_z_axis(armat, armature_z_axis)
+                algorithms.select_and_change_mode(armat,'POSE')
             bpy.context.scene.objects.active = current_active_obj
 
 
@@ -331,7 +564,7 @@ class SkeletonEngine:
         armat = self.get_armature()
 
         if armat:
-            matrix_data = algorithms.load_json_data(data_path,"Pose data")
+            matrix_data = algorithms.load_cached_json_data(data_path,"Pose data")
             algorithms.force_visible_object(armat)
             algorithms.select_and_change_mode(armat,"POSE")
             for a_bone in armat.pose.bones:
@@ -378,8 +611,7 @@ class SkeletonEngine:
         armat = self.get_armature()
         reset_quat =  mathutils.Quaternion((1.0, 0.0, 0.0, 0.0))        
         if armat:            
-            self.load_bones_position()
-            self.align_bones_z_axis()
+            self.load_bones_position(align_z_axis=True)
             for a_bone in armat.pose.bones:
                 a_bone.rotation_quaternion = reset_quat
                 if a_bone.name == "pelvis":
@@ -409,6 +641,7 @@ class SkeletonEngine:
 
         self.reset_skeleton_mapped()
         self.already_mapped_bones = []
+        self.armature_index = None
         self.spine_bones_names = None
         self.rarm_bones_names = None
         self.larm_bones_names = None
@@ -437,7 +670,53 @@ class SkeletonEngine:
         self.lfinger3_bones_names = None
         self.lfinger4_bones_names = None
 
+        map_signature = self.get_skeleton_signature(source_armat)
+        if self.load_skeleton_map(map_signature):
+            lab_logger.info("Bones map of {0} loaded from cache".format(source_armat.name))
+            return
         self.map_main_bones(source_armat)
+        self.save_skeleton_map(map_signature)
+
+    def get_skeleton_signature(self, source_armat):
+        """
+        The mapping depends only on the names and the hierarchy
+        of the source bones, and on the knowledge database.
+        """
+        bones_hierarchy = []
+        for s_bone in source_armat.data.bones:
+            parent_name = None
+            if s_bone.parent:
+                parent_name = s_bone.parent.name
+            bones_hierarchy.append([s_bone.name, parent_name, [c_bone.name for c_bone in s_bone.children]])
+        signature_data = json.dumps([RETARGET_MAP_VERSION, self.knowledge_signature, bones_hierarchy])
+        return hashlib.sha1(signature_data.encode("utf-8")).hexdigest()
+
+    def get_skeleton_map_path(self, map_signature):
+        return os.path.join(self.retarget_maps_path, map_signature+".json")
+
+    def load_skeleton_map(self, map_signature):
+        map_path = self.get_skeleton_map_path(map_signature)
+        if os.path.isfile(map_path):
+            try:
+                with open(map_path, "r") as map_file:
+                    self.skeleton_mapped = json.load(map_file)
+                return True
+            except (OSError, ValueError):
+                lab_logger.warning("Corrupted bones map {0}".format(algorithms.simple_path(map_path)))
+                self.reset_skeleton_mapped()
+        return False
+
+    def save_skeleton_map(self, map_signature):
+        map_path = self.get_skeleton_map_path(map_signature)
+        try:
+            if not os.path.isdir(self.retarget_maps_path):
+                os.makedirs(self.retarget_maps_path)
+            tmp_path = datacache.get_tmp_path(map_path)
+            with open(tmp_path, "w") as map_file:
+                json.dump(self.skeleton_mapped, map_file)
+            os.replace(tmp_path, map_path)
+        except OSError as err:
+            lab_logger.warning("Cannot store the bones map: {0}".format(err))
 
 
     def get_bone_by_exact_ID(self, bones_to_scan, bone_identifiers, side):
@@ -452,13 +731,13 @@ class SkeletonEngine:
             else:
                 side_id = [""]
                 junctions = [""]
-            name_combination = []
+            name_combination = set()
 
             for b_id in bone_identifiers:
                 for s_id in side_id:
                     for junct in junctions:
-                        name_combination.append(b_id+junct+s_id)
-                        name_combination.append(s_id+junct+b_id)
+                        name_combination.add(b_id+junct+s_id)
+                        name_combination.add(s_id+junct+b_id)
 
             for b_name in bones_to_scan:
                 if b_name.lower() in name_combination:
@@ -469,17 +748,18 @@ class SkeletonEngine:
 
     def get_bone_by_childr(self, armat, bones_to_scan, childr_identifiers, debug = False):
 
-        if len(childr_identifiers) > 0:
+        if len(childr_identifiers) > 0 and bones_to_scan:
+            armat_index = self.get_armature_index(armat)
+            bones_to_scan_set = set(bones_to_scan)
             for bone_name in bones_to_scan:
-                x_bone = self.get_bone(armat,bone_name)
-                if x_bone:
-                    for ch_bone in x_bone.children:
-                        for ch_ID in childr_identifiers:
-                            c1 = algorithms.is_string_in_string(ch_ID,ch_bone.name)
-                            c2 = ch_bone.name in bones_to_scan
-                            c3 = algorithms.is_too_much_similar(x_bone.name,ch_bone.name)
-                            if c1 and c2 and not c3:
-                                return x_bone.name
+                if bone_name in armat_index.children:
+                    for ch_name in armat_index.children[bone_name]:
+                        if ch_name in bones_to_scan_set:
+                            for ch_ID in childr_identifiers:
+                                c1 = algorithms.is_string_in_string(ch_ID,ch_name)
+                                c3 = algorithms.is_too_much_similar(bone_name,ch_name)
+                                if c1 and not c3:
+                                    return bone_name
         return None
 
 
@@ -511,8 +791,9 @@ class SkeletonEngine:
 
     def get_bones_by_parent(self, armat, bones_to_scan, parent_IDs):
         found_bones = set()
+        armat_index = self.get_armature_index(armat)
         for bone_name in bones_to_scan:
-            parent_name = self.bone_parent_name(armat,bone_name)
+            parent_name = armat_index.parent.get(bone_name)
             for pr_ID in parent_IDs:
                 if algorithms.is_string_in_string(pr_ID, parent_name):
                     found_bones.add(bone_name)
@@ -520,59 +801,12 @@ class SkeletonEngine:
 
 
     def get_bone_chains(self, armat, bone_names):
-        found_chains = []
-        for bone_name in bone_names:
-            bn = armat.data.bones[bone_name]
-            chain_names = [b.name for b in bn.parent_recursive]
-            chain = [bone_name]+chain_names
-            found_chains.append(chain)
-        return found_chains
-
-
-    def is_in_side(self,bone_names,side):
-
-        bone_IDs = ["forearm","elbow","lowerarm","hand","wrist","finger","thumb","index","ring","pink",\
-                    "thigh","upperleg","upper_leg","leg","knee","shin","calf","lowerleg","lower_leg",\
-                    "toe","ball","foot"]
-
-        combo_bones_start = []
-        combo_bones_end = []
-
-        score_level = 0.0
-
-        if side == "RIGHT":
-            ID_side1 = "r"
-            ID_side2 = "right"
-            ID_side3 = ["r.","r_"]
-            ID_side4 = ["_r",".r"]
-
-        if side == "LEFT":
-            ID_side1 = "l"
-            ID_side2 = "left"
-            ID_side3 = ["l.","l_"]
-            ID_side4 = ["_l",".l"]
-
-        for b_ID in bone_IDs:
-            combo_bones_start.append(ID_side1 + b_ID)
-            combo_bones_end.append(b_ID + ID_side1)
-
-        for bone_name in bone_names:
-            bone_name = bone_name.lower()
-
-            if len(bone_name) > 3:
-                c1 = bone_name[:2] in ID_side3
-                c2 = bone_name[-2:] in ID_side4
-                c3 = ID_side2 in bone_name
-                c4 = algorithms.is_in_list(bone_names,combo_bones_start,"START")
-                c5 = algorithms.is_in_list(bone_names,combo_bones_end,"END")
-                if  c1 or c2 or c3 or c4 or c5:
-                    score_level += 1
-
-        if len(bone_names) != 0:
-            final_score = score_level/len(bone_names)
-        else:
-            return 0
-        return final_score
+        armat_index = self.get_armature_index(armat)
+        return [armat_index.get_chain(bone_name) for bone_name in bone_names]
+
+
+    def is_in_side(self,armat,bone_names,side):
+        return self.get_armature_index(armat).side_score(bone_names,side)
 
     def order_with_list(self,bones_set,bones_list):
         ordered_bones = []
@@ -583,21 +817,12 @@ class SkeletonEngine:
 
     def chains_intersection(self,chains):
 
-        chain_sets = []
-        chain_inters = None
-        result_chain = []
-
-        for chain in chains:
-            chain_sets.append(set(chain))
-
-        for i,chain in enumerate(chain_sets):
-            if chain_inters == None:
-                chain_inters = chain
-            else:
-                chain_inters = chain_inters.intersection(chain)
-            result_chain = self.order_with_list(chain_inters,chains[i])
-
-        return result_chain
+        if len(chains) == 0:
+            return []
+        chain_inters = set(chains[0])
+        for chain in chains[1:]:
+            chain_inters.intersection_update(chain)
+        return self.order_with_list(chain_inters,chains[-1])
 
     def filter_chains_by_max_length(self,chains):
         longer_chains = []
@@ -617,15 +842,17 @@ class SkeletonEngine:
         d_chain = chain_set.difference(subchain_set)
         return self.order_with_list(d_chain,chain_list)
 
-    def filter_chains_by_side(self,chains):
+    def filter_chains_by_side(self,armat,chains):
 
 
         left_chains = []
         right_chains = []
         center_chains = []
+        chain_scores = []
         for chain in chains:
-            score_left = self.is_in_side(chain,"LEFT")
-            score_right = self.is_in_side(chain,"RIGHT")
+            score_left = self.is_in_side(armat,chain,"LEFT")
+            score_right = self.is_in_side(armat,chain,"RIGHT")
+            chain_scores.append((score_left,score_right))
 
             if score_left > 0:
                 left_chains.append(chain)
@@ -636,9 +863,7 @@ class SkeletonEngine:
 
         if len(center_chains) == 0:
             score_threshold = 0
-            for chain in chains:
-                score_left = self.is_in_side(chain,"LEFT")
-                score_right = self.is_in_side(chain,"RIGHT")
+            for chain,(score_left,score_right) in zip(chains,chain_scores):
                 score_center = 1.0-score_left-score_right
                 if score_center > score_threshold:
                     score_threshold = score_center
@@ -648,19 +873,19 @@ class SkeletonEngine:
         return left_chains,center_chains,right_chains
 
 
-    def filter_chains_by_tail(self,chains,chain_IDs):
+    def filter_chains_by_tail(self,armat,chains,chain_IDs):
         target_chains_lists = []
         if chains:
             for chain in chains:
                 chain_tail = chain[0]
-                if algorithms.is_in_list(chain_IDs,[chain_tail]):
+                if self.chain_has_ID(armat,[chain_tail],chain_IDs):
                     target_chains_lists.append(chain)
         return target_chains_lists
 
-    def filter_chains_by_ID(self,chains,chain_IDs):
+    def filter_chains_by_ID(self,armat,chains,chain_IDs):
         target_chains_lists = []
         for chain in chains:
-            if algorithms.is_in_list(chain_IDs,chain):
+            if self.chain_has_ID(armat,chain,chain_IDs):
                 target_chains_lists.append(chain)
         return target_chains_lists
 
@@ -699,7 +924,7 @@ class SkeletonEngine:
         return result_chain
 
 
-    def identify_bone_chains(self,chains, debug = False):
+    def identify_bone_chains(self,armat,chains, debug = False):
         arm_chain_IDs = ["arm","elbow","hand","wrist","finger","thumb","index","ring","pink","mid"]
         leg_chain_IDs = ["thigh","upperleg","upper_leg","leg","knee","shin","calf","lowerleg","lower_leg","foot","ankle","toe","ball"]
         head_chain_IDs = ["head","neck","skull","face","spine"]
@@ -715,34 +940,34 @@ class SkeletonEngine:
         max_left_finger_chains = []
         max_right_finger_chains = []
 
-        left_chains,center_chains,right_chains = self.filter_chains_by_side(chains)
+        left_chains,center_chains,right_chains = self.filter_chains_by_side(armat,chains)
 
-        head_tail_chains = self.filter_chains_by_ID(center_chains,head_chain_IDs)
+        head_tail_chains = self.filter_chains_by_ID(armat,center_chains,head_chain_IDs)
         head_tail_chains = self.filter_chains_by_max_length(head_tail_chains)
 
-        arms_tail_chains = self.filter_chains_by_ID(chains,arm_chain_IDs)
+        arms_tail_chains = self.filter_chains_by_ID(armat,chains,arm_chain_IDs)
         arms_tail_chains = self.filter_chains_by_max_length(arms_tail_chains)
 
-        right_arm_tail_chains = self.filter_chains_by_tail(right_chains,arm_chain_IDs)
+        right_arm_tail_chains = self.filter_chains_by_tail(armat,right_chains,arm_chain_IDs)
         right_arm_tail_chains = self.filter_chains_by_max_length(right_arm_tail_chains)
 
-        left_arm_tail_chains = self.filter_chains_by_tail(left_chains,arm_chain_IDs)
+        left_arm_tail_chains = self.filter_chains_by_tail(armat,left_chains,arm_chain_IDs)
         left_arm_tail_chains = self.filter_chains_by_max_length(left_arm_tail_chains)
 
-        right_fingers_tail_chains = self.filter_chains_by_tail(right_chains,finger_chain_IDs)
-        left_fingers_tail_chains = self.filter_chains_by_tail(left_chains,finger_chain_IDs)
+        right_fingers_tail_chains = self.filter_chains_by_tail(armat,right_chains,finger_chain_IDs)
+        left_fingers_tail_chains = self.filter_chains_by_tail(armat,left_chains,finger_chain_IDs)
 
-        right_foot_tail_chains = self.filter_chains_by_tail(right_chains,foot_chain_IDs)
+        right_foot_tail_chains = self.filter_chains_by_tail(armat,right_chains,foot_chain_IDs)
         right_foot_tail_chains.sort()
         self.rtoe_and_leg_names = right_foot_tail_chains[0]
         right_foot_tail_chains = self.filter_chains_by_max_length(right_foot_tail_chains)
 
-        left_foot_tail_chains = self.filter_chains_by_tail(left_chains,foot_chain_IDs)
+        left_foot_tail_chains = self.filter_chains_by_tail(armat,left_chains,foot_chain_IDs)
         left_foot_tail_chains.sort()
         self.ltoe_and_leg_names = left_foot_tail_chains[0]
         left_foot_tail_chains = self.filter_chains_by_max_length(left_foot_tail_chains)
 
-        feet_tail_chains = self.filter_chains_by_tail(chains,foot_chain_IDs)
+        feet_tail_chains = self.filter_chains_by_tail(armat,chains,foot_chain_IDs)
 
         spine_chain = self.chains_intersection(arms_tail_chains)
 
@@ -807,11 +1032,15 @@ class SkeletonEngine:
         self.lfinger4_bones_names = l_finger4_chain
 
     def get_ending_bones(self, armat):
-        found_bones = set()
-        for bn in armat.data.bones:
-            if len(bn.children) == 0:
-                found_bones.add(bn.name)
-        return found_bones
+        return self.get_armature_index(armat).get_ending_bones()
+
+    def get_armature_index(self, armat):
+        if self.armature_index == None or self.armature_index.armat_name != armat.name:
+            self.armature_index = ArmatureIndex(armat)
+        return self.armature_index
+
+    def chain_has_ID(self, armat, chain, chain_IDs):
+        return self.get_armature_index(armat).has_ID(chain,chain_IDs)
 
 
     def get_bone_by_similar_ID(self, bones_to_scan, bone_identifiers1, bone_identifiers2):
@@ -934,11 +1163,7 @@ class SkeletonEngine:
 
 
     def bone_parent_name(self,armat,b_name):
-        x_bone = self.get_bone(armat,b_name)
-        if x_bone:
-            if x_bone.parent:
-                return x_bone.parent.name
-        return None
+        return self.get_armature_index(armat).parent.get(b_name)
 
     def get_bone(self,armat,b_name,b_type = "TARGET"):
         if armat:
@@ -1001,10 +1226,11 @@ class SkeletonEngine:
 
     def map_main_bones(self,armat):
 
+        self.armature_index = ArmatureIndex(armat)
         ending_bones = self.get_ending_bones(armat)
         chains = self.get_bone_chains(armat,ending_bones)
 
-        self.identify_bone_chains(chains,False)
+        self.identify_bone_chains(armat,chains,False)
         self.map_bone(armat,"clavicle_L","LCLAVICLE","by_exact_name")
         self.map_bone(armat,"clavicle_R","RCLAVICLE","by_exact_name")
         self.map_bone(armat,"head","HEAD","by_exact_name")
@@ -0,0 +1,42 @@
+#ManuelbastioniLAB - Copyright (C) 2015-2017 Manuel Bastioni
+#Official site: www.manuelbastioni.com
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#The tests use only the modules that don't need bpy (algorithms,
+#datacache and headless), imported as plain modules like in
+#"python headless.py": the package __init__ needs Blender.
+
+import os
+import sys
+
+import pytest
+
+ADDON_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "manuelbastionilab")
+if ADDON_PATH not in sys.path:
+    sys.path.insert(0, ADDON_PATH)
+
+
+@pytest.fixture
+def cache_dir(tmpdir, monkeypatch):
+    """
+    Empty cache folder, used also by get_cache_dir.
+    """
+    cache_path = str(tmpdir.mkdir("cache"))
+    monkeypatch.setenv("MANUELBASTIONILAB_CACHE", cache_path)
+    return cache_path
+
+
+@pytest.fixture
+def data_path():
+    return os.path.join(ADDON_PATH, "data")
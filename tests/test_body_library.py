@@ -0,0 +1,239 @@
+#ManuelbastioniLAB - Copyright (C) 2015-2017 Manuel Bastioni
+#Official site: www.manuelbastioni.com
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import shutil
+
+import numpy
+import pytest
+
+import datacache
+
+TOLERANCE = 0.025
+PROPORTION_NAMES = ["body_height_Z", "chest_girth", "waist_girth", "neck_girth", "feet_length"]
+SCORE_WEIGHTS = {"body_height_Z": 1, "chest_girth": 3, "waist_girth": 3, "neck_girth": 0.5, "feet_length": 0.5}
+
+
+def write_body(bodies_path, file_name, proportions, mtime=1000000000, structural=None):
+    body_path = os.path.join(bodies_path, file_name)
+    body_data = {
+        "manuellab_vers": [1, 6, 1],
+        "proportions": proportions,
+        "structural": structural or {"Body_Size": 0.5},
+        "metaproperties": {"character_age": 0.0},
+        "materialproperties": {}}
+    with open(body_path, "w") as b_file:
+        json.dump(body_data, b_file)
+    os.utime(body_path, (mtime, mtime))
+    return body_path
+
+
+def random_proportions(rng):
+    return dict((p_name, round(rng.uniform(0.1, 0.2), 3)) for p_name in PROPORTION_NAMES)
+
+
+def score_file(body_path, proportions, score_weights):
+    """
+    The old MorphingEngine.calculate_matching_score on a body file.
+    """
+    with open(body_path, "r") as b_file:
+        body_proportions = json.load(b_file)["proportions"]
+    data_score = 0
+    for p, v in body_proportions.items():
+        if p in proportions:
+            if p != "body_height_Z":
+                proportion_score = 1
+                if abs(proportions[p]-v) > TOLERANCE:
+                    proportion_score = 0
+                data_score += proportion_score*score_weights[p]
+    return data_score
+
+
+def score_folder(bodies_path, proportions, score_weights):
+    """
+    The old compare_data_proportions: score every file, best first.
+    """
+    scores = []
+    for database_file in sorted(os.listdir(bodies_path)):
+        if os.path.splitext(database_file)[1] == ".json":
+            body_path = os.path.join(bodies_path, database_file)
+            scores.append((score_file(body_path, proportions, score_weights), body_path))
+    scores.sort(key=lambda score: score[0], reverse=True)
+    return scores
+
+
+def check_query(library, bodies_path, proportions, score_weights):
+    results = library.query(proportions, score_weights, TOLERANCE)
+    expected = score_folder(bodies_path, proportions, score_weights)
+    assert dict((path, score) for score, path in results) == dict((path, score) for score, path in expected)
+    result_scores = [score for score, path in results]
+    assert result_scores == sorted(result_scores, reverse=True)
+    for n_results in (1, 3, 10):
+        assert library.query(proportions, score_weights, TOLERANCE, n_results) == results[:n_results]
+    return results
+
+
+@pytest.fixture
+def bodies_path(tmpdir):
+    b_path = str(tmpdir.mkdir("bodies"))
+    rng = numpy.random.RandomState(0)
+    for n in range(20):
+        write_body(b_path, "body{0:02d}.json".format(n), random_proportions(rng))
+    return b_path
+
+
+@pytest.fixture
+def library_path(tmpdir):
+    return str(tmpdir.join("library"))
+
+
+def test_ingest(bodies_path, library_path):
+    library = datacache.BodyLibrary(library_path, bodies_path)
+    assert library.ingest([bodies_path]) == 20
+    assert library.get_bodies_number() == 20
+    assert library.active_bodies.tolist() == [True]*20
+    body_path = os.path.join(bodies_path, "body03.json")
+    with open(body_path, "r") as b_file:
+        assert library.get_body(body_path) == json.load(b_file)
+    #Nothing changed
+    assert library.ingest([bodies_path]) == 0
+
+
+def test_query_matches_the_file_scores(bodies_path, library_path):
+    library = datacache.load_body_library(bodies_path, os.path.dirname(library_path))
+    rng = numpy.random.RandomState(1)
+    for trial in range(20):
+        check_query(library, bodies_path, random_proportions(rng), SCORE_WEIGHTS)
+    #Tied scores keep the order of the files
+    proportions = dict((p_name, 1.0) for p_name in PROPORTION_NAMES)
+    results = check_query(library, bodies_path, proportions, SCORE_WEIGHTS)
+    assert [path for score, path in results] == [path for score, path in score_folder(bodies_path, proportions, SCORE_WEIGHTS)]
+
+
+def test_modified_body(bodies_path, library_path):
+    library = datacache.BodyLibrary(library_path, bodies_path)
+    library.ingest([bodies_path])
+    proportions = dict((p_name, 0.5) for p_name in PROPORTION_NAMES)
+    body_path = write_body(bodies_path, "body05.json", proportions, mtime=1000000100)
+    assert library.sync(bodies_path) == 1
+    assert library.get_bodies_number() == 20
+    assert len(library.bodies) == 20
+    assert library.get_body(body_path)["proportions"] == proportions
+    check_query(library, bodies_path, proportions, SCORE_WEIGHTS)
+
+
+def test_deleted_and_restored_body(bodies_path, library_path, tmpdir):
+    library = datacache.BodyLibrary(library_path, bodies_path)
+    library.ingest([bodies_path])
+    body_path = os.path.join(bodies_path, "body07.json")
+    kept_path = str(tmpdir.join("body07.json"))
+    shutil.move(body_path, kept_path)
+    library.sync(bodies_path)
+    assert library.get_bodies_number() == 19
+    assert library.get_body(body_path) is None
+    assert library.active_bodies.tolist() == [not body["removed"] for body in library.bodies]
+    rng = numpy.random.RandomState(2)
+    results = check_query(library, bodies_path, random_proportions(rng), SCORE_WEIGHTS)
+    assert body_path not in [path for score, path in results]
+
+    shutil.move(kept_path, body_path)
+    library.sync(bodies_path)
+    assert library.get_bodies_number() == 20
+    assert library.active_bodies.all()
+    check_query(library, bodies_path, random_proportions(rng), SCORE_WEIGHTS)
+
+
+def test_many_deleted_bodies_are_compacted(bodies_path, library_path):
+    library = datacache.BodyLibrary(library_path, bodies_path)
+    library.ingest([bodies_path])
+    for n in range(15):
+        os.remove(os.path.join(bodies_path, "body{0:02d}.json".format(n)))
+    library.sync(bodies_path)
+    assert len(library.bodies) == 5
+    assert library.get_bodies_number() == 5
+    assert library.matrices["proportions"].shape[0] == 5
+    reloaded = datacache.BodyLibrary(library_path, bodies_path)
+    assert reloaded.get_bodies_number() == 5
+    check_query(reloaded, bodies_path, random_proportions(numpy.random.RandomState(3)), SCORE_WEIGHTS)
+
+
+def test_new_column(bodies_path, library_path):
+    library = datacache.BodyLibrary(library_path, bodies_path)
+    library.ingest([bodies_path])
+    proportions = random_proportions(numpy.random.RandomState(4))
+    proportions["hands_length"] = 0.05
+    new_path = write_body(bodies_path, "body_new.json", proportions)
+    assert library.sync(bodies_path) == 1
+    assert "hands_length" in library.sections["proportions"]
+    assert library.get_body(new_path)["proportions"] == proportions
+    #The old bodies don't have the new value
+    assert "hands_length" not in library.get_body(os.path.join(bodies_path, "body00.json"))["proportions"]
+    score_weights = dict(SCORE_WEIGHTS, hands_length=1)
+    check_query(library, bodies_path, proportions, score_weights)
+    reloaded = datacache.BodyLibrary(library_path, bodies_path)
+    assert reloaded.sections == library.sections
+    check_query(reloaded, bodies_path, proportions, score_weights)
+
+
+def test_reload(bodies_path, library_path):
+    library = datacache.BodyLibrary(library_path, bodies_path)
+    library.ingest([bodies_path])
+    os.remove(os.path.join(bodies_path, "body02.json"))
+    write_body(bodies_path, "body09.json", random_proportions(numpy.random.RandomState(5)), mtime=1000000100)
+    library.sync(bodies_path)
+    reloaded = datacache.BodyLibrary(library_path, bodies_path)
+    assert reloaded.bodies == library.bodies
+    assert reloaded.active_bodies.tolist() == library.active_bodies.tolist()
+    for section in datacache.BODY_SECTIONS:
+        numpy.testing.assert_array_equal(reloaded.matrices[section], library.matrices[section])
+    assert reloaded.sync(bodies_path) == 0
+    proportions = random_proportions(numpy.random.RandomState(6))
+    assert reloaded.query(proportions, SCORE_WEIGHTS) == library.query(proportions, SCORE_WEIGHTS)
+
+
+def test_moved_bodies_folder(bodies_path, library_path, tmpdir):
+    library = datacache.BodyLibrary(library_path, bodies_path)
+    library.ingest([bodies_path])
+    moved_path = str(tmpdir.join("moved_bodies"))
+    shutil.move(bodies_path, moved_path)
+    moved_library = datacache.BodyLibrary(library_path, moved_path)
+    assert moved_library.sync(moved_path) == 0
+    assert moved_library.get_bodies_number() == 20
+    check_query(moved_library, moved_path, random_proportions(numpy.random.RandomState(7)), SCORE_WEIGHTS)
+
+
+@pytest.mark.parametrize("bodies_folder, measures_file", [
+    ("human_female_base_bodies", "human_female_measures.json"),
+    ("human_male_base_bodies", "human_male_measures.json")])
+def test_shipped_bodies(bodies_folder, measures_file, data_path, cache_dir):
+    bodies_path = os.path.join(data_path, "shared_bodies", bodies_folder)
+    with open(os.path.join(data_path, "shared_measures", measures_file), "r") as m_file:
+        score_weights = json.load(m_file)["score_weights"]
+    library = datacache.load_body_library(bodies_path, cache_dir)
+    rng = numpy.random.RandomState(8)
+    body_files = datacache.get_body_files(bodies_path)
+    for trial in range(5):
+        body_path = os.path.join(bodies_path, body_files[rng.randint(len(body_files))])
+        with open(body_path, "r") as b_file:
+            proportions = json.load(b_file)["proportions"]
+        if not proportions:
+            continue
+        proportions = dict((p_name, value+rng.uniform(-0.01, 0.01)) for p_name, value in proportions.items())
+        results = library.query(proportions, score_weights, TOLERANCE)
+        expected = score_folder(bodies_path, proportions, score_weights)
+        #The files without proportions are not in the library
+        expected = [(score, path) for score, path in expected if library.get_body(path) is not None]
+        assert results == expected
@@ -0,0 +1,81 @@
+#ManuelbastioniLAB - Copyright (C) 2015-2017 Manuel Bastioni
+#Official site: www.manuelbastioni.com
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy
+import pytest
+
+import algorithms
+
+
+def random_morph(rng, n_verts, n_deltas):
+    indices = rng.randint(0, n_verts, n_deltas).astype(numpy.int32)
+    deltas = rng.randn(n_deltas, 3).astype(numpy.float32)
+    return (indices, deltas)
+
+
+def apply_morphs_per_delta(form, morphs, weights):
+    """
+    The old MorphingEngine.calculate_morph: one delta at a time.
+    """
+    for (indices, deltas), weight in zip(morphs, weights):
+        for i, delta in zip(indices.tolist(), deltas.astype(numpy.float64)):
+            form[i] = form[i] + delta*weight
+    return form
+
+
+def combo_values(values):
+    return [[algorithms.function_modifier_a(val), algorithms.function_modifier_b(val)] for val in values]
+
+
+def test_add_weighted_morphs_matches_per_delta_sum():
+    rng = numpy.random.RandomState(0)
+    n_verts = 200
+    base_form = rng.randn(n_verts, 3)
+    #Repeated indices, in the same morph and in different morphs
+    morphs = [random_morph(rng, n_verts, rng.randint(1, 300)) for m in range(12)]
+    weights = rng.uniform(-1.0, 1.0, len(morphs)).tolist()
+
+    form = base_form.copy()
+    modified = algorithms.add_weighted_morphs(form, morphs, weights)
+    expected = apply_morphs_per_delta(base_form.copy(), morphs, weights)
+
+    numpy.testing.assert_allclose(form, expected, rtol=0, atol=1e-9)
+    assert set(modified.tolist()) == set(numpy.concatenate([m[0] for m in morphs]).tolist())
+
+
+def test_add_weighted_morphs_without_morphs():
+    form = numpy.ones((5,3))
+    modified = algorithms.add_weighted_morphs(form, [], [])
+    assert len(modified) == 0
+    numpy.testing.assert_array_equal(form, numpy.ones((5,3)))
+
+
+@pytest.mark.parametrize("n_values", [1, 2, 3, 4, 5])
+def test_smart_combo_names(n_values):
+    names, weights = algorithms.smart_combo("Prefix_mod", combo_values([0.5]*n_values))
+    assert algorithms.smart_combo_names("Prefix_mod", n_values) == names
+
+
+@pytest.mark.parametrize("n_values", [1, 2, 3, 4, 5])
+def test_smart_combo_weights_match_smart_combo(n_values):
+    rng = numpy.random.RandomState(n_values)
+    samples = [rng.uniform(0.0, 1.0, n_values).tolist() for s in range(50)]
+    #Neutral values (all weights zero) and the extremes
+    samples += [[0.5]*n_values, [0.0]*n_values, [1.0]*n_values]
+    samples += [rng.choice([0.0, 0.5, 1.0], n_values).tolist() for s in range(20)]
+    for values in samples:
+        names, weights = algorithms.smart_combo("Prefix_mod", combo_values(values))
+        new_weights = algorithms.smart_combo_weights(combo_values(values))
+        numpy.testing.assert_allclose(new_weights, weights, rtol=1e-12, atol=1e-12)
@@ -0,0 +1,178 @@
+#ManuelbastioniLAB - Copyright (C) 2015-2017 Manuel Bastioni
+#Official site: www.manuelbastioni.com
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import json
+
+import numpy
+import pytest
+
+import datacache
+
+
+def write_json(json_path, j_data):
+    with open(json_path, "w") as j_file:
+        json.dump(j_data, j_file)
+
+
+def set_mtime(file_path, mtime):
+    os.utime(file_path, (mtime, mtime))
+
+
+@pytest.fixture
+def source_path(tmpdir):
+    s_path = str(tmpdir.join("source.json"))
+    write_json(s_path, {"a": [1, 2, 3]})
+    set_mtime(s_path, 1000000000)
+    return s_path
+
+
+def save_test_pack(cache_dir, source_path, value=1.0):
+    arrays = {
+        "coords": numpy.full((4,3), value, dtype=numpy.float32),
+        "indices": numpy.arange(5, dtype=numpy.int32)}
+    assert datacache.save_pack(cache_dir, "test_pack", [source_path], arrays, {"names": ["x", "y"]})
+    return arrays
+
+
+def test_pack_round_trip(cache_dir, source_path):
+    arrays = save_test_pack(cache_dir, source_path)
+    loaded_arrays, meta = datacache.load_pack(cache_dir, "test_pack", [source_path])
+    assert meta == {"names": ["x", "y"]}
+    assert sorted(loaded_arrays.keys()) == ["coords", "indices"]
+    for array_name, array_data in arrays.items():
+        assert loaded_arrays[array_name].dtype == array_data.dtype
+        numpy.testing.assert_array_equal(loaded_arrays[array_name], array_data)
+    #Memory-mapped in read only mode
+    with pytest.raises(ValueError):
+        loaded_arrays["coords"][0,0] = 2.0
+
+
+def test_pack_missing_or_other_version(cache_dir, source_path):
+    assert datacache.load_pack(cache_dir, "test_pack", [source_path]) is None
+    save_test_pack(cache_dir, source_path)
+    manifest_path = os.path.join(cache_dir, "test_pack", datacache.MANIFEST_NAME)
+    with open(manifest_path, "r") as m_file:
+        manifest = json.load(m_file)
+    manifest["version"] = datacache.CACHE_VERSION+1
+    write_json(manifest_path, manifest)
+    assert datacache.load_pack(cache_dir, "test_pack", [source_path]) is None
+
+
+def test_pack_other_sources(cache_dir, source_path, tmpdir):
+    save_test_pack(cache_dir, source_path)
+    other_path = str(tmpdir.join("other.json"))
+    write_json(other_path, {})
+    assert datacache.load_pack(cache_dir, "test_pack", [source_path, other_path]) is None
+
+
+def test_pack_stale_size(cache_dir, source_path):
+    save_test_pack(cache_dir, source_path)
+    write_json(source_path, {"a": [1, 2, 3, 4]})
+    set_mtime(source_path, 1000000000)
+    assert datacache.load_pack(cache_dir, "test_pack", [source_path]) is None
+
+
+def test_pack_stale_content_same_size(cache_dir, source_path):
+    save_test_pack(cache_dir, source_path)
+    write_json(source_path, {"a": [1, 2, 4]})
+    set_mtime(source_path, 1000000100)
+    assert datacache.load_pack(cache_dir, "test_pack", [source_path]) is None
+
+
+def test_pack_touched_source(cache_dir, source_path, monkeypatch):
+    save_test_pack(cache_dir, source_path)
+    set_mtime(source_path, 1000000100)
+    #Same content: the sha1 is compared and the pack is still valid
+    assert datacache.load_pack(cache_dir, "test_pack", [source_path]) is not None
+    #The new mtime is stored, so the next load doesn't hash the file
+    def fail_hash(filepath):
+        raise AssertionError("file hashed")
+    monkeypatch.setattr(datacache, "file_hash", fail_hash)
+    assert datacache.load_pack(cache_dir, "test_pack", [source_path]) is not None
+
+
+def test_pack_replaced_under_mapped_arrays(cache_dir, source_path):
+    save_test_pack(cache_dir, source_path, 1.0)
+    old_arrays, meta = datacache.load_pack(cache_dir, "test_pack", [source_path])
+    write_json(source_path, {"b": [3, 2, 1]})
+    set_mtime(source_path, 1000000100)
+    save_test_pack(cache_dir, source_path, 2.0)
+    new_arrays, meta = datacache.load_pack(cache_dir, "test_pack", [source_path])
+    #The new files are renamed over the old ones: the arrays
+    #already mapped keep their data
+    numpy.testing.assert_array_equal(old_arrays["coords"], numpy.full((4,3), 1.0))
+    numpy.testing.assert_array_equal(new_arrays["coords"], numpy.full((4,3), 2.0))
+    pack_files = os.listdir(os.path.join(cache_dir, "test_pack"))
+    assert sorted(pack_files) == ["coords.npy", "indices.npy", datacache.MANIFEST_NAME]
+
+
+def test_interrupted_save_leaves_invalid_pack(cache_dir, source_path, monkeypatch):
+    save_test_pack(cache_dir, source_path, 1.0)
+    save_array = datacache.save_array
+    def failing_save_array(array_path, array_data):
+        if array_path.endswith("indices.npy"):
+            raise OSError("disk full")
+        save_array(array_path, array_data)
+    monkeypatch.setattr(datacache, "save_array", failing_save_array)
+    arrays = {
+        "coords": numpy.zeros((4,3), dtype=numpy.float32),
+        "indices": numpy.zeros(5, dtype=numpy.int32)}
+    assert not datacache.save_pack(cache_dir, "test_pack", [source_path], arrays)
+    assert datacache.load_pack(cache_dir, "test_pack", [source_path]) is None
+
+
+def test_load_compiled_reads_the_json_once(cache_dir, tmpdir, monkeypatch):
+    morphs_path = str(tmpdir.join("morphs.json"))
+    m_data = {
+        "Body_max": [[0, 0.1, 0.2, 0.3], [5, -1.0, 0.0, 1.0]],
+        "Body_min": [[2, 0.5, 0.5, 0.5]],
+        "Empty_max": []}
+    write_json(morphs_path, m_data)
+    morphs = datacache.load_morphs(morphs_path, cache_dir)
+    def fail_read(json_path, data_info="Json data"):
+        raise AssertionError("json parsed again")
+    monkeypatch.setattr(datacache, "read_json", fail_read)
+    cached_morphs = datacache.load_morphs(morphs_path, cache_dir)
+    for loaded in (morphs, cached_morphs):
+        assert [m[0] for m in loaded] == list(m_data.keys())
+        for morph_name, indices, deltas in loaded:
+            expected = numpy.array(m_data[morph_name], dtype=numpy.float64).reshape(-1,4)
+            numpy.testing.assert_array_equal(indices, expected[:,0])
+            numpy.testing.assert_allclose(deltas, expected[:,1:], rtol=1e-6)
+    assert datacache.load_morph_names(morphs_path, cache_dir) == list(m_data.keys())
+
+
+def test_cache_dir_from_environment(tmpdir, monkeypatch):
+    env_path = str(tmpdir.join("env_cache"))
+    monkeypatch.setenv(datacache.CACHE_ENV_VAR, env_path)
+    assert datacache.get_cache_dir(str(tmpdir)) == env_path
+    assert os.path.isdir(env_path)
+
+
+@pytest.mark.skipif(sys.platform.startswith("win") or sys.platform == "darwin", reason="XDG cache folder")
+def test_cache_dir_in_user_cache(tmpdir, monkeypatch):
+    monkeypatch.delenv(datacache.CACHE_ENV_VAR, raising=False)
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmpdir.join("user_cache")))
+    data_1 = str(tmpdir.mkdir("data_1"))
+    data_2 = str(tmpdir.mkdir("data_2"))
+    cache_1 = datacache.get_cache_dir(data_1)
+    assert os.path.isdir(cache_1)
+    assert cache_1.startswith(str(tmpdir.join("user_cache", "manuelbastionilab")))
+    assert not cache_1.startswith(data_1)
+    #One folder for each data folder
+    assert datacache.get_cache_dir(data_1) == cache_1
+    assert datacache.get_cache_dir(data_2) != cache_1
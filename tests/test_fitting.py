@@ -0,0 +1,75 @@
+#ManuelbastioniLAB - Copyright (C) 2015-2017 Manuel Bastioni
+#Official site: www.manuelbastioni.com
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy
+import pytest
+
+import algorithms
+
+TOLERANCE = 1e-7
+
+
+def random_problem(rng, n_rows, n_vars):
+    matrix_a = rng.randn(n_rows, n_vars)
+    vector_b = rng.randn(n_rows)*3.0
+    lower = -rng.uniform(0.0, 1.0, n_vars)
+    upper = rng.uniform(0.0, 1.0, n_vars)
+    return matrix_a, vector_b, lower, upper
+
+
+def check_kkt(matrix_a, vector_b, lower, upper, x_sol):
+    """
+    Optimality of min |Ax-b|^2 with bounds: zero gradient for the
+    free variables, gradient pointing outside for the bounded ones.
+    """
+    gradient = matrix_a.T.dot(matrix_a.dot(x_sol)-vector_b)
+    scale = max(1.0, numpy.abs(matrix_a).max()*numpy.abs(vector_b).max())
+    at_lower = x_sol <= lower+TOLERANCE
+    at_upper = x_sol >= upper-TOLERANCE
+    free = ~(at_lower | at_upper)
+    assert numpy.all(numpy.abs(gradient[free]) <= TOLERANCE*scale)
+    assert numpy.all(gradient[at_lower & ~at_upper] >= -TOLERANCE*scale)
+    assert numpy.all(gradient[at_upper & ~at_lower] <= TOLERANCE*scale)
+
+
+@pytest.mark.parametrize("n_rows, n_vars", [(5, 3), (20, 8), (33, 30), (8, 12), (1, 1)])
+def test_bounded_least_squares_kkt(n_rows, n_vars):
+    rng = numpy.random.RandomState(n_rows*100+n_vars)
+    for trial in range(50):
+        matrix_a, vector_b, lower, upper = random_problem(rng, n_rows, n_vars)
+        x_sol = algorithms.bounded_least_squares(matrix_a, vector_b, lower, upper)
+        assert numpy.all(x_sol >= lower) and numpy.all(x_sol <= upper)
+        check_kkt(matrix_a, vector_b, lower, upper, x_sol)
+
+
+def test_bounded_least_squares_not_worse_than_feasible_points():
+    rng = numpy.random.RandomState(7)
+    for trial in range(20):
+        matrix_a, vector_b, lower, upper = random_problem(rng, 15, 6)
+        x_sol = algorithms.bounded_least_squares(matrix_a, vector_b, lower, upper)
+        best_cost = numpy.sum((matrix_a.dot(x_sol)-vector_b)**2)
+        samples = rng.uniform(lower, upper, (500, len(lower)))
+        sample_costs = numpy.sum((samples.dot(matrix_a.T)-vector_b)**2, axis=1)
+        assert best_cost <= sample_costs.min()+1e-9
+
+
+def test_bounded_least_squares_unconstrained_solution():
+    #With bounds far away it's the plain least squares solution
+    rng = numpy.random.RandomState(3)
+    matrix_a = rng.randn(10, 4)
+    vector_b = rng.randn(10)
+    x_sol = algorithms.bounded_least_squares(matrix_a, vector_b, [-1e6]*4, [1e6]*4)
+    expected = numpy.linalg.lstsq(matrix_a, vector_b, rcond=-1)[0]
+    numpy.testing.assert_allclose(x_sol, expected, rtol=1e-9, atol=1e-12)
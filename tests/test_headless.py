@@ -0,0 +1,153 @@
+#ManuelbastioniLAB - Copyright (C) 2015-2017 Manuel Bastioni
+#Official site: www.manuelbastioni.com
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import math
+
+import numpy
+import pytest
+
+import algorithms
+import headless
+
+CHARACTER_NAMES = ["human_female_base01", "human_male_base01"]
+
+
+def read_json(json_path):
+    with open(json_path, "r") as j_file:
+        return json.load(j_file)
+
+
+class ReferenceCharacter:
+    """
+    The evaluation of the old Humanoid and MorphingEngine, from the
+    json files: modifiers from the morph names, smart_combo weights
+    and the deltas of each morph added one by one.
+    """
+
+    def __init__(self, character_name, data_path):
+        paths = headless.get_character_paths(character_name, data_path)
+        self.base_form = numpy.array(read_json(paths["vertices"]), dtype=numpy.float64).reshape(-1,3)
+        self.morph_data = {}
+        for morph_path in paths["morphs"]+[paths["expressions"]]:
+            if os.path.isfile(morph_path):
+                self.morph_data.update(read_json(morph_path))
+        self.modifiers = {}
+        self.character_data = {}
+        for morph_name in self.morph_data.keys():
+            components = morph_name.split("_")
+            if components[0][:4] not in "BasisAsymTest" and len(components) == 3:
+                modifier_name = components[0]+"_"+components[1]
+                properties = self.modifiers.setdefault(modifier_name, [])
+                for element in components[1].split("-"):
+                    prop = components[0]+"_"+element
+                    if prop not in properties:
+                        properties.append(prop)
+                    self.character_data[prop] = 0.5
+        self.measures_data = read_json(paths["measures"])["measures"]
+
+    def load_character(self, charac_data):
+        for prop in self.character_data.keys():
+            self.character_data[prop] = 0.5
+        for prop, value in charac_data.get("structural", {}).items():
+            if prop in self.character_data:
+                self.character_data[prop] = value
+
+    def calculate_vertices(self):
+        form = self.base_form.copy()
+        for modifier_name, properties in self.modifiers.items():
+            values = []
+            for prop in properties:
+                val = min(1.0, max(0.0, self.character_data[prop]))
+                values.append([algorithms.function_modifier_a(val), algorithms.function_modifier_b(val)])
+            names, weights = algorithms.smart_combo(modifier_name, values)
+            for morph_name, weight in zip(names, weights):
+                if weight != 0.0 and morph_name in self.morph_data:
+                    d_data = numpy.array(self.morph_data[morph_name], dtype=numpy.float64).reshape(-1,4)
+                    numpy.add.at(form, d_data[:,0].astype(int), d_data[:,1:]*weight)
+        return form
+
+    def calculate_measures(self, vert_coords):
+        measures = {}
+        for measure_name, indices in self.measures_data.items():
+            axis = "XYZ".find(measure_name[-1])
+            strip_length = 0.0
+            for index_1, index_2 in zip(indices[:-1], indices[1:]):
+                v1 = vert_coords[index_1]
+                v2 = vert_coords[index_2]
+                if axis < 0:
+                    strip_length += math.sqrt(sum((v1[i]-v2[i])**2 for i in range(3)))
+                else:
+                    strip_length += abs(v1[axis]-v2[axis])
+            measures[measure_name] = strip_length
+        return measures
+
+
+def get_test_characters(character_name, data_path):
+    """
+    The phenotypes of the character, and random values
+    out of [0,1] too, to check the clamping.
+    """
+    phenotypes_path = os.path.join(data_path, character_name, "phenotypes")
+    characters = [{"structural": {}}]
+    for p_file in sorted(os.listdir(phenotypes_path))[:3]:
+        characters.append(read_json(os.path.join(phenotypes_path, p_file)))
+    rng = numpy.random.RandomState(0)
+    reference = ReferenceCharacter(character_name, data_path)
+    for trial in range(2):
+        characters.append({"structural": dict(
+            (prop, float(rng.uniform(-0.2, 1.2))) for prop in sorted(reference.character_data.keys()))})
+    return characters
+
+
+@pytest.mark.parametrize("character_name", CHARACTER_NAMES)
+def test_character_data_match_the_humanoid_rules(character_name, data_path, cache_dir):
+    character = headless.HeadlessCharacter(character_name, data_path)
+    reference = ReferenceCharacter(character_name, data_path)
+    assert character.character_data == reference.character_data
+    assert character.modifiers == reference.modifiers
+
+
+@pytest.mark.parametrize("character_name", CHARACTER_NAMES)
+def test_vertices_and_measures_match_the_reference(character_name, data_path, cache_dir):
+    character = headless.HeadlessCharacter(character_name, data_path)
+    reference = ReferenceCharacter(character_name, data_path)
+    for charac_data in get_test_characters(character_name, data_path):
+        assert character.load_character(charac_data)
+        reference.load_character(charac_data)
+        verts = character.calculate_vertices()
+        reference_verts = reference.calculate_vertices()
+        assert verts.dtype == numpy.float32
+        numpy.testing.assert_allclose(verts, reference_verts, rtol=0, atol=1e-5)
+
+        measures = character.calculate_measures(verts)
+        reference_measures = reference.calculate_measures(reference_verts)
+        assert sorted(measures.keys()) == sorted(reference_measures.keys())
+        for measure_name, value in reference_measures.items():
+            assert measures[measure_name] == pytest.approx(value, rel=1e-5, abs=1e-6)
+
+
+def test_evaluate_character_from_file(data_path, cache_dir, tmpdir):
+    charac_data = {"structural": {"Body_Size": 0.8}, "metaproperties": {"character_age": 0.3}}
+    json_path = str(tmpdir.join("character.json"))
+    with open(json_path, "w") as j_file:
+        json.dump(charac_data, j_file)
+    verts, measures = headless.evaluate_character("human_female_base01", json_path, data_path)
+    reference = ReferenceCharacter("human_female_base01", data_path)
+    reference.load_character(charac_data)
+    numpy.testing.assert_allclose(verts, reference.calculate_vertices(), rtol=0, atol=1e-5)
+    assert measures["body_height_Z"] == pytest.approx(
+        reference.calculate_measures(verts)["body_height_Z"], rel=1e-5)
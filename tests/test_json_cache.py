@@ -0,0 +1,55 @@
+#ManuelbastioniLAB - Copyright (C) 2015-2017 Manuel Bastioni
+#Official site: www.manuelbastioni.com
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+
+import algorithms
+
+
+def write_json(json_path, j_data, mtime):
+    with open(json_path, "w") as j_file:
+        json.dump(j_data, j_file)
+    os.utime(json_path, (mtime, mtime))
+
+
+def test_cached_data_are_copied(tmpdir):
+    json_path = str(tmpdir.join("preset.json"))
+    write_json(json_path, {"structural": {"Body_Size": 0.3}}, 1000000000)
+    first = algorithms.load_cached_json_data(json_path)
+    first["structural"]["Body_Size"] = 1.0
+    second = algorithms.load_cached_json_data(json_path)
+    assert second == {"structural": {"Body_Size": 0.3}}
+    assert second is not first
+
+
+def test_changed_file_is_read_again(tmpdir):
+    json_path = str(tmpdir.join("pose.json"))
+    write_json(json_path, {"a": 1}, 1000000000)
+    assert algorithms.load_cached_json_data(json_path) == {"a": 1}
+    write_json(json_path, {"a": 2}, 1000000100)
+    assert algorithms.load_cached_json_data(json_path) == {"a": 2}
+
+
+def test_prefetch_fills_the_cache(tmpdir, monkeypatch):
+    folder_path = str(tmpdir.mkdir("poses"))
+    for n in range(3):
+        write_json(os.path.join(folder_path, "pose{0}.json".format(n)), {"n": n}, 1000000000)
+    algorithms.prefetch_json_folders([folder_path]).join()
+    def fail_load(json_path, data_info=None):
+        raise AssertionError("json parsed again")
+    monkeypatch.setattr(algorithms, "load_json_data", fail_load)
+    for n in range(3):
+        assert algorithms.load_cached_json_data(os.path.join(folder_path, "pose{0}.json".format(n))) == {"n": n}
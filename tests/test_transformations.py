@@ -0,0 +1,98 @@
+#ManuelbastioniLAB - Copyright (C) 2015-2017 Manuel Bastioni
+#Official site: www.manuelbastioni.com
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy
+import pytest
+
+import algorithms
+import headless
+
+SLIDER_VALUES = [0.0, 0.3, 1.0, -0.2, -1.0, -0.4, 0.7, 0.0, -0.6, 0.6, 0.6]
+
+
+def apply_transformation_per_row(character_data, tr_data, current_tr_factor, previous_tr_factor):
+    """
+    The old Humanoid.calculate_transformation: every row
+    of the table is checked against every property.
+    """
+    if current_tr_factor >= 0:
+        transformation_2 = current_tr_factor
+        transformation_1 = 0
+    else:
+        transformation_2 = 0
+        transformation_1 = -current_tr_factor
+    if previous_tr_factor >= 0:
+        last_transformation_2 = previous_tr_factor
+        last_transformation_1 = 0
+    else:
+        last_transformation_2 = 0
+        last_transformation_1 = -previous_tr_factor
+    for prop in character_data:
+        for tr_parameter in tr_data:
+            if tr_parameter[0] in prop:
+                linear_factor = tr_parameter[1]*transformation_1 + tr_parameter[2]*transformation_2 - tr_parameter[1]*last_transformation_1 - tr_parameter[2]*last_transformation_2
+                character_data[prop] = character_data[prop] + linear_factor
+
+
+def apply_transformation_compiled(character_data, c_transformation, value, previous_value):
+    deltas = algorithms.transformation_deltas(c_transformation, value, previous_value)
+    for prop, delta in zip(c_transformation[0], deltas.tolist()):
+        character_data[prop] = character_data[prop] + delta
+
+
+def check_slider_sequence(tr_data, prop_names):
+    c_transformation = algorithms.compile_transformation(tr_data, prop_names)
+    old_data = dict((prop, 0.5) for prop in prop_names)
+    new_data = dict(old_data)
+    previous_value = 0.0
+    for value in SLIDER_VALUES:
+        apply_transformation_per_row(old_data, tr_data, value, previous_value)
+        apply_transformation_compiled(new_data, c_transformation, value, previous_value)
+        previous_value = value
+        for prop in prop_names:
+            assert new_data[prop] == pytest.approx(old_data[prop], abs=1e-12)
+
+
+def test_compile_transformation_sums_the_matching_rows():
+    tr_data = [["Arm", 0.1, 0.2], ["Leg", -0.3, 0.4], ["Length", 1.0, -1.0]]
+    prop_names = ["Arms_Length", "Legs_Length", "Head_Size", "Legs_Mass"]
+    affected_props, coefficients_1, coefficients_2 = algorithms.compile_transformation(tr_data, prop_names)
+    assert affected_props == ["Arms_Length", "Legs_Length", "Legs_Mass"]
+    numpy.testing.assert_allclose(coefficients_1, [1.1, 0.7, -0.3])
+    numpy.testing.assert_allclose(coefficients_2, [-0.8, -0.6, 0.4])
+
+
+def test_compile_transformation_without_affected_props():
+    c_transformation = algorithms.compile_transformation([["Arm", 0.1, 0.2]], ["Head_Size"])
+    assert c_transformation[0] == []
+    assert len(algorithms.transformation_deltas(c_transformation, 0.5, -0.5)) == 0
+
+
+def test_random_tables_match_the_per_row_rules():
+    rng = numpy.random.RandomState(0)
+    parts = ["Arm", "Leg", "Neck", "Length", "Mass", "Size"]
+    prop_names = ["{0}s_{1}".format(part_1, part_2) for part_1 in parts for part_2 in parts]
+    for trial in range(20):
+        tr_data = [[parts[rng.randint(len(parts))], rng.uniform(-1, 1), rng.uniform(-1, 1)] for row in range(8)]
+        check_slider_sequence(tr_data, prop_names)
+
+
+@pytest.mark.parametrize("character_name", ["human_female_base01", "human_male_base01"])
+def test_shipped_tables_match_the_per_row_rules(character_name, data_path, cache_dir):
+    character = headless.HeadlessCharacter(character_name, data_path)
+    prop_names = sorted(character.character_data.keys())
+    assert character.transformations_data
+    for transformation_id, tr_data in character.transformations_data.items():
+        check_slider_sequence(tr_data, prop_names)
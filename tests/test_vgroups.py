@@ -0,0 +1,88 @@
+#ManuelbastioniLAB - Copyright (C) 2015-2017 Manuel Bastioni
+#Official site: www.manuelbastioni.com
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+
+import numpy
+import pytest
+
+import algorithms
+import datacache
+
+
+def add_replace(group, indices, weight):
+    """
+    vertex_group.add(indices, weight, 'REPLACE') on a dict.
+    """
+    for vert_index in indices:
+        group[vert_index] = weight
+
+
+def load_group_per_vert(vert_list):
+    """
+    The old SkeletonEngine.load_groups: one add for each vert.
+    """
+    group = {}
+    for vert_data in vert_list:
+        add_replace(group, [vert_data[0]], vert_data[1])
+    return group
+
+
+def load_group_buckets(indices, weights):
+    group = {}
+    n_calls = 0
+    for weight, w_indices in algorithms.weight_buckets(indices, weights):
+        add_replace(group, w_indices, weight)
+        n_calls += 1
+    return group, n_calls
+
+
+def test_weight_buckets_keep_the_last_weight():
+    indices = [3, 1, 3, 2, 1, 5]
+    weights = [0.5, 0.2, 0.7, 0.2, 0.5, 0.7]
+    buckets = algorithms.weight_buckets(indices, weights)
+    assert buckets == [(0.2, [2]), (0.5, [1]), (0.7, [3, 5])]
+
+
+def test_weight_buckets_without_verts():
+    assert algorithms.weight_buckets([], []) == []
+
+
+def test_weight_buckets_match_sequential_replace():
+    rng = numpy.random.RandomState(0)
+    for trial in range(50):
+        n_entries = rng.randint(1, 400)
+        indices = rng.randint(0, 100, n_entries)
+        weights = rng.choice([0.0, 0.1, 0.25, 0.5, 1.0, rng.rand()], n_entries)
+        vert_list = [[int(i), float(w)] for i, w in zip(indices, weights)]
+        group, n_calls = load_group_buckets(indices, weights)
+        assert group == load_group_per_vert(vert_list)
+        assert n_calls == len(set(group.values()))
+
+
+@pytest.mark.parametrize("groups_file", ["human_female_vgroups.json", "anime_female_vgroups.json"])
+def test_shipped_groups_match_sequential_replace(groups_file, data_path, cache_dir):
+    groups_path = os.path.join(data_path, "shared_vgroups", groups_file)
+    with open(groups_path, "r") as g_file:
+        g_data = json.load(g_file)
+    g_arrays, g_meta = datacache.load_vgroups(groups_path, cache_dir)
+    assert g_meta["names"] == sorted(g_data.keys())
+    indptr = g_arrays["indptr"]
+    for n, group_name in enumerate(g_meta["names"]):
+        group_indices = g_arrays["indices"][int(indptr[n]):int(indptr[n+1])]
+        group_weights = g_arrays["weights"][int(indptr[n]):int(indptr[n+1])]
+        group, n_calls = load_group_buckets(group_indices, group_weights)
+        assert group == load_group_per_vert(g_data[group_name])